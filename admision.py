@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+CONTROL DE ADMISIÓN DEL LLM
+===========================
+Se consulta antes de generar_respuesta_ia para que un contacto spammer o un
+grupo no quemen el rate limit de Groq que comparten todos los clientes.
+
+Decisiones (en este orden):
+  ignorar   -> contacto en contactos_ignorados (no se responde nada)
+  limitar   -> el remitente vació su token bucket: se guarda el mensaje, se le avisa
+               una vez por ráfaga y el turno se responde cuando se recarga
+  diferir   -> cola muy cargada: "ya te respondemos"
+  fija      -> cola cargada o sin cupo de LLM: respuesta armada con la agenda real
+  llm       -> camino normal
+
+Todo se configura en la tabla config (se relee solo cuando cambia su versión):
+  admision_tokens_minuto       recarga del bucket por remitente (default 6)
+  admision_rafaga              capacidad del bucket (default 4)
+  admision_llm_concurrentes    llamadas al LLM en vuelo (default 4); con ESTADO_COMPARTIDO
+                               el tope es de todo el despliegue, si no de este proceso
+  admision_espera_llm_seg      cuánto esperar un cupo antes de degradar (default 5)
+  admision_cola_fija           turnos encolados para pasar a respuesta fija (default 20)
+  admision_cola_diferir        turnos encolados para pasar a diferir (default 60)
+  contactos_ignorados          lista JSON (la migra migrar_config.py)
+"""
+
+import collections
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+from bitacora import get_logger
+from metricas import registro
+import plazos
+
+log = get_logger('admision')
+
+DEFAULTS = {
+    'admision_tokens_minuto': 6.0,
+    'admision_rafaga': 4.0,
+    'admision_llm_concurrentes': 4,
+    'admision_espera_llm_seg': 5.0,
+    'admision_cola_fija': 20,
+    'admision_cola_diferir': 60,
+}
+# Buckets de remitentes inactivos que dejamos de recordar
+MAX_BUCKETS = 10000
+# Textos retenidos por remitente limitado (se responden los últimos)
+MAX_RETENIDOS = 10
+# Cupo compartido: cada cuánto volver a pedirlo mientras está lleno
+SONDEO_CUPO_SEG = 0.1
+
+MENSAJE_DIFERIDO = "¡Recibimos tu mensaje! 🙌 Estamos con mucha demanda, en un ratito te respondemos."
+
+DECISIONES = registro.contador(
+    'bot_admision_total', 'Decisiones del control de admisión', ('decision',))
+LLM_EN_VUELO = registro.medidor('bot_llm_en_vuelo', 'Turnos con cupo de LLM tomado')
+
+
+def normalizar_contacto(contacto):
+    return str(contacto).strip().replace('+', '').replace('@c.us', '').replace('@s.whatsapp.net', '')
+
+
+class ControlAdmision:
+    def __init__(self, db, pendientes=lambda: 0, estado=None):
+        self.db = db
+        self.pendientes = pendientes
+        # EstadoCompartido: buckets coherentes entre workers de gunicorn
+        self.estado = estado
+        self._lock = threading.Lock()
+        self._version_config = None
+        self._ajustes = dict(DEFAULTS)
+        self._ignorados = frozenset()
+        # remitente -> (tokens, último relleno); el menos usado primero
+        self._buckets = collections.OrderedDict()
+        # remitente -> textos de turnos limitados, a la espera del reintento
+        self._retenidos = {}
+        # Semáforo redimensionable: el límite se lee de config en cada intento
+        self._cupo = threading.Condition()
+        self._en_vuelo = 0
+
+    # === CONFIGURACIÓN (CACHEADA POR VERSIÓN) ===
+    def ajustes(self):
+        version = self.db.version('config')
+        if version != self._version_config:
+            self._recargar(version)
+        return self._ajustes
+
+    def _recargar(self, version):
+        config = self.db.get_all_config()
+        ajustes = {}
+        for clave, default in DEFAULTS.items():
+            try:
+                ajustes[clave] = type(default)(config.get(clave, default))
+            except (TypeError, ValueError):
+                log.warning(f"⚠️ Config inválida {clave}={config.get(clave)!r}, uso {default}")
+                ajustes[clave] = default
+        try:
+            ignorados = json.loads(config.get('contactos_ignorados') or '[]')
+        except ValueError:
+            ignorados = config['contactos_ignorados'].split(',')
+        if isinstance(ignorados, str):
+            ignorados = ignorados.split(',')
+        with self._lock:
+            self._ajustes = ajustes
+            self._ignorados = frozenset(normalizar_contacto(c) for c in ignorados if str(c).strip())
+            self._version_config = version
+
+    def es_ignorado(self, remitente):
+        self.ajustes()
+        return normalizar_contacto(remitente) in self._ignorados
+
+    # === TOKEN BUCKET POR REMITENTE ===
+    def _tomar_token(self, remitente, ajustes):
+        ahora = time.monotonic()
+        capacidad = ajustes['admision_rafaga']
+        por_segundo = ajustes['admision_tokens_minuto'] / 60.0
+        if self.estado is not None:
+            return self.estado.tomar_token(remitente, capacidad, por_segundo)
+        with self._lock:
+            tokens, ultimo = self._buckets.pop(remitente, (capacidad, ahora))
+            tokens = min(capacidad, tokens + (ahora - ultimo) * por_segundo)
+            permitido = tokens >= 1
+            if permitido:
+                tokens -= 1
+            self._buckets[remitente] = (tokens, ahora)
+            while len(self._buckets) > MAX_BUCKETS:
+                self._buckets.popitem(last=False)
+        return permitido
+
+    # === TURNOS LIMITADOS ===
+    def retener(self, remitente, textos):
+        """Guarda los textos de un turno limitado; True si es el primero de la ráfaga (hay que avisar)"""
+        with self._lock:
+            lista = self._retenidos.get(remitente)
+            primero = lista is None
+            if primero:
+                lista = self._retenidos[remitente] = []
+            lista.extend(textos)
+            del lista[:-MAX_RETENIDOS]
+        return primero
+
+    def retomar(self, remitente):
+        """Textos retenidos del remitente, para responderlos junto con su turno (los saca)"""
+        with self._lock:
+            return self._retenidos.pop(remitente, [])
+
+    def hay_retenidos(self, remitente):
+        with self._lock:
+            return remitente in self._retenidos
+
+    def espera_recarga(self):
+        """Segundos hasta que el bucket de un remitente vacío tiene un token"""
+        return 60.0 / max(self.ajustes()['admision_tokens_minuto'], 0.1)
+
+    # === DECISIÓN ===
+    def decidir(self, remitente):
+        ajustes = self.ajustes()
+        if normalizar_contacto(remitente) in self._ignorados:
+            decision = 'ignorar'
+        elif not self._tomar_token(remitente, ajustes):
+            decision = 'limitar'
+        else:
+            encolados = self.pendientes()
+            if encolados >= ajustes['admision_cola_diferir']:
+                decision = 'diferir'
+            elif encolados >= ajustes['admision_cola_fija']:
+                decision = 'fija'
+            else:
+                decision = 'llm'
+        DECISIONES.inc(decision=decision)
+        return decision
+
+    @contextmanager
+    def cupo_llm(self):
+        """Cupo de LLM (de todos los workers con estado compartido); entrega False si no se liberó uno a tiempo"""
+        ajustes = self.ajustes()
+        limite = ajustes['admision_llm_concurrentes']
+        espera = plazos.restante(ajustes['admision_espera_llm_seg'])
+        cupo = None
+        if self.estado is not None:
+            cupo = self._esperar_cupo_compartido(limite, espera)
+            tomado = cupo is not None
+        with self._cupo:
+            if self.estado is None:
+                tomado = self._cupo.wait_for(lambda: self._en_vuelo < limite, timeout=espera)
+            if tomado:
+                self._en_vuelo += 1
+                LLM_EN_VUELO.set(self._en_vuelo)
+        if not tomado:
+            DECISIONES.inc(decision='sin_cupo')
+        try:
+            yield tomado
+        finally:
+            if tomado:
+                if cupo is not None:
+                    self.estado.soltar_cupo_llm(cupo)
+                with self._cupo:
+                    self._en_vuelo -= 1
+                    LLM_EN_VUELO.set(self._en_vuelo)
+                    self._cupo.notify()
+
+    def _esperar_cupo_compartido(self, limite, espera):
+        """Lo suelta otro proceso: no hay Condition que nos avise, se vuelve a pedir cada SONDEO_CUPO_SEG"""
+        fin = time.monotonic() + espera
+        while True:
+            cupo = self.estado.tomar_cupo_llm(limite)
+            if cupo is not None or time.monotonic() >= fin:
+                return cupo
+            time.sleep(min(SONDEO_CUPO_SEG, max(0.0, fin - time.monotonic())))
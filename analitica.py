@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+ANALÍTICA (ROLLUPS INCREMENTALES)
+=================================
+Agregados por día y por servicio que se actualizan en la misma transacción que
+la escritura original (reserva, cancelación, mensaje), así /api/analytics
+responde un mes o un año leyendo unas cientos de filas en vez de recorrer
+citas y mensajes.
+
+- analitica_dia: reservas, cancelaciones, ingreso estimado, mensajes y tipo de turno
+- analitica_servicio: reservas, cancelaciones e ingreso por (fecha, servicio)
+- Turnos ofrecidos: salen del calendario (lunes a sábado, 10 por día), no se guardan
+- La consulta agrupa en Python las filas diarias (un año = 365 filas) por día, semana ISO, mes o año
+
+Las citas cuentan en el día del turno; los mensajes en el día local (UTC-4).
+Precios: config 'precios' (JSON servicio -> Gs.) y 'precio_defecto'.
+El SQL es común a SQLite y PostgreSQL salvo las fechas (ver DIALECTO).
+
+Reconstruir desde el historial: python analitica.py
+"""
+
+import collections
+import datetime
+import json
+
+from bitacora import get_logger
+
+log = get_logger('analitica')
+
+PRECIO_DEFECTO = 40000
+# Mismas horas que obtener_estado_agenda: 09 a 19 sin el almuerzo
+TURNOS_POR_DIA = len([h for h in range(9, 20) if h != 12])
+# Respuesta fija de conflicto (api_server.preparar_turno): la reconstrucción la reconoce por el texto
+PREFIJO_CONFLICTO = '⚠️ Disculpa, justo se ocupó'
+COLUMNA_TURNO = {'llm': 'turnos_llm', 'conflicto': 'turnos_conflicto'}
+# Período de la serie: largo del prefijo de la fecha ISO (la semana es ISO, aparte)
+LARGO_PERIODO = {'dia': 10, 'mes': 7, 'anio': 4}
+AGRUPACIONES = ('dia', 'semana', 'mes', 'anio')
+MAX_DIAS_CONSULTA = 3660
+CAMPOS = ('citas_reservadas', 'citas_canceladas', 'ingresos_estimados', 'mensajes_cliente', 'mensajes_bot',
+          'turnos_llm', 'turnos_conflicto', 'turnos_degradados')
+# Día local de "ahora" y de un timestamp guardado (CURRENT_TIMESTAMP es UTC), por motor
+DIALECTO = {
+    'sqlite': {
+        'hoy_local': "date('now', '-4 hours')",
+        'dia_local': "date(timestamp, '-4 hours')",
+        'existe': "SELECT 1 FROM sqlite_master WHERE name = ?",
+    },
+    'postgres': {
+        'hoy_local': "to_char(now() AT TIME ZONE 'UTC' - interval '4 hours', 'YYYY-MM-DD')",
+        'dia_local': "to_char(timestamp::timestamp - interval '4 hours', 'YYYY-MM-DD')",
+        'existe': "SELECT to_regclass(?)",
+    },
+}
+
+
+def dialecto(conn):
+    """Las conexiones de database_postgres.py traen 'dialecto'; las de sqlite3 no"""
+    return DIALECTO[getattr(conn, 'dialecto', 'sqlite')]
+
+
+def crear_tablas(cursor):
+    """Dentro de init_db; True si las tablas son nuevas (hay que reconstruir)"""
+    fila = cursor.execute(dialecto(cursor)['existe'], ('analitica_dia',)).fetchone()
+    nuevas = not (fila and fila[0])
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS analitica_dia (
+            fecha TEXT PRIMARY KEY,
+            citas_reservadas INTEGER NOT NULL DEFAULT 0,
+            citas_canceladas INTEGER NOT NULL DEFAULT 0,
+            ingresos_estimados INTEGER NOT NULL DEFAULT 0,
+            mensajes_cliente INTEGER NOT NULL DEFAULT 0,
+            mensajes_bot INTEGER NOT NULL DEFAULT 0,
+            turnos_llm INTEGER NOT NULL DEFAULT 0,
+            turnos_conflicto INTEGER NOT NULL DEFAULT 0,
+            turnos_degradados INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS analitica_servicio (
+            fecha TEXT NOT NULL,
+            servicio TEXT NOT NULL,
+            citas_reservadas INTEGER NOT NULL DEFAULT 0,
+            citas_canceladas INTEGER NOT NULL DEFAULT 0,
+            ingresos_estimados INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (fecha, servicio)
+        )
+    ''')
+    return nuevas
+
+
+def precio(conn, servicio):
+    fila = conn.execute("SELECT clave, valor FROM config WHERE clave IN ('precios', 'precio_defecto')").fetchall()
+    config = {r[0]: r[1] for r in fila}
+    try:
+        precios = {k.lower(): int(v) for k, v in json.loads(config.get('precios') or '{}').items()}
+        defecto = int(config.get('precio_defecto') or PRECIO_DEFECTO)
+    except (ValueError, TypeError, AttributeError):
+        log.warning("⚠️ Config de precios inválida, uso el precio por defecto")
+        precios, defecto = {}, PRECIO_DEFECTO
+    return precios.get((servicio or '').strip().lower(), defecto)
+
+
+# === ACTUALIZACIÓN INCREMENTAL (misma transacción que la escritura) ===
+def sumar_cita(conn, fecha, servicio, signo):
+    """signo=+1 reserva, -1 cancelación"""
+    servicio = servicio or 'Sin servicio'
+    importe = precio(conn, servicio) * signo
+    reservadas, canceladas = (1, 0) if signo > 0 else (-1, 1)
+    conn.execute('''
+        INSERT INTO analitica_dia (fecha, citas_reservadas, citas_canceladas, ingresos_estimados) VALUES (?, ?, ?, ?)
+        ON CONFLICT(fecha) DO UPDATE SET citas_reservadas = analitica_dia.citas_reservadas + excluded.citas_reservadas,
+            citas_canceladas = analitica_dia.citas_canceladas + excluded.citas_canceladas,
+            ingresos_estimados = analitica_dia.ingresos_estimados + excluded.ingresos_estimados
+    ''', (fecha, reservadas, canceladas, importe))
+    conn.execute('''
+        INSERT INTO analitica_servicio (fecha, servicio, citas_reservadas, citas_canceladas, ingresos_estimados)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(fecha, servicio) DO UPDATE SET
+            citas_reservadas = analitica_servicio.citas_reservadas + excluded.citas_reservadas,
+            citas_canceladas = analitica_servicio.citas_canceladas + excluded.citas_canceladas,
+            ingresos_estimados = analitica_servicio.ingresos_estimados + excluded.ingresos_estimados
+    ''', (fecha, servicio, reservadas, canceladas, importe))
+
+
+def sumar_mensaje(conn, es_bot, tipo_turno=None):
+    """tipo_turno (solo respuestas del bot): 'llm', 'conflicto' o el motivo de la degradación"""
+    columnas = ['mensajes_bot' if es_bot else 'mensajes_cliente']
+    if tipo_turno:
+        columnas.append(COLUMNA_TURNO.get(tipo_turno, 'turnos_degradados'))
+    nombres = ", ".join(columnas)
+    sumas = ", ".join(f"{c} = analitica_dia.{c} + 1" for c in columnas)
+    conn.execute(f'''
+        INSERT INTO analitica_dia (fecha, {nombres}) VALUES ({dialecto(conn)['hoy_local']}{", 1" * len(columnas)})
+        ON CONFLICT(fecha) DO UPDATE SET {sumas}
+    ''')
+
+
+# === RECONSTRUCCIÓN (BACKFILL) ===
+def reconstruir(conn):
+    """Recalcula desde citas y mensajes lo que se puede derivar de ellos.
+
+    Cancelaciones y degradaciones no dejan rastro en esas tablas: se conservan
+    las que ya se contaron incrementalmente.
+    """
+    conn.execute("UPDATE analitica_dia SET citas_reservadas = 0, ingresos_estimados = 0, mensajes_cliente = 0, "
+                 "mensajes_bot = 0, turnos_llm = 0, turnos_conflicto = 0")
+    conn.execute("UPDATE analitica_servicio SET citas_reservadas = 0, ingresos_estimados = 0")
+    grupos = conn.execute('''
+        SELECT fecha, COALESCE(servicio, 'Sin servicio') AS servicio, count(*) AS cantidad
+        FROM citas WHERE estado = 'Confirmado' GROUP BY 1, 2
+    ''').fetchall()
+    for fecha, servicio, cantidad in grupos:
+        conn.execute('''
+            INSERT INTO analitica_servicio (fecha, servicio, citas_reservadas, ingresos_estimados) VALUES (?, ?, ?, ?)
+            ON CONFLICT(fecha, servicio) DO UPDATE SET
+                citas_reservadas = analitica_servicio.citas_reservadas + excluded.citas_reservadas,
+                ingresos_estimados = analitica_servicio.ingresos_estimados + excluded.ingresos_estimados
+        ''', (fecha, servicio, cantidad, precio(conn, servicio) * cantidad))
+    conn.execute('''
+        INSERT INTO analitica_dia (fecha, citas_reservadas, ingresos_estimados)
+        SELECT fecha, sum(citas_reservadas), sum(ingresos_estimados) FROM analitica_servicio WHERE true GROUP BY fecha
+        ON CONFLICT(fecha) DO UPDATE SET citas_reservadas = excluded.citas_reservadas,
+            ingresos_estimados = excluded.ingresos_estimados
+    ''')
+    # Tipo de turno aproximado: conflicto por el texto fijo, el resto de respuestas como LLM (menos las degradadas)
+    conn.execute(f'''
+        INSERT INTO analitica_dia (fecha, mensajes_cliente, mensajes_bot, turnos_llm, turnos_conflicto)
+        SELECT {dialecto(conn)['dia_local']} AS dia, sum(CASE WHEN es_bot = 0 THEN 1 ELSE 0 END),
+               sum(CASE WHEN es_bot = 1 THEN 1 ELSE 0 END),
+               sum(CASE WHEN es_bot = 1 AND contenido NOT LIKE ? || '%' THEN 1 ELSE 0 END),
+               sum(CASE WHEN es_bot = 1 AND contenido LIKE ? || '%' THEN 1 ELSE 0 END)
+        FROM mensajes WHERE timestamp IS NOT NULL GROUP BY dia
+        ON CONFLICT(fecha) DO UPDATE SET mensajes_cliente = excluded.mensajes_cliente,
+            mensajes_bot = excluded.mensajes_bot,
+            turnos_llm = CASE WHEN excluded.turnos_llm > analitica_dia.turnos_degradados
+                              THEN excluded.turnos_llm - analitica_dia.turnos_degradados ELSE 0 END,
+            turnos_conflicto = excluded.turnos_conflicto
+    ''', (PREFIJO_CONFLICTO, PREFIJO_CONFLICTO))
+    dias = conn.execute("SELECT count(*) FROM analitica_dia").fetchone()[0]
+    log.info(f"📊 Analítica reconstruida: {dias} días")
+    return dias
+
+
+# === CONSULTA ===
+def periodo(fecha, agrupar):
+    if agrupar == 'semana':
+        anio, semana, _ = fecha.isocalendar()
+        return f"{anio}-W{semana:02d}"
+    return fecha.isoformat()[:LARGO_PERIODO[agrupar]]
+
+
+def consultar(conn, desde, hasta, agrupar='dia'):
+    """Serie por período + totales + desglose por servicio para [desde, hasta] (YYYY-MM-DD)"""
+    inicio, fin = datetime.date.fromisoformat(desde), datetime.date.fromisoformat(hasta)
+    if not 0 <= (fin - inicio).days < MAX_DIAS_CONSULTA:
+        raise ValueError(f"Rango inválido (máximo {MAX_DIAS_CONSULTA} días)")
+
+    # Un mes = ~30 filas, un año = ~365: se agrupa acá, con el calendario para los turnos ofrecidos
+    series = collections.OrderedDict()
+    dia = inicio
+    while dia <= fin:
+        fila = series.setdefault(periodo(dia, agrupar), dict.fromkeys(CAMPOS + ('turnos_ofrecidos',), 0))
+        if dia.weekday() != 6:
+            fila['turnos_ofrecidos'] += TURNOS_POR_DIA
+        dia += datetime.timedelta(days=1)
+
+    for r in conn.execute(f"SELECT fecha, {', '.join(CAMPOS)} FROM analitica_dia WHERE fecha BETWEEN ? AND ?",
+                          (desde, hasta)):
+        try:
+            fila = series[periodo(datetime.date.fromisoformat(r['fecha']), agrupar)]
+        except (KeyError, ValueError):
+            continue
+        for campo in CAMPOS:
+            fila[campo] += r[campo]
+
+    serie = [dict(periodo=clave, **fila) for clave, fila in series.items()]
+    totales = {c: sum(f[c] for f in serie) for c in CAMPOS + ('turnos_ofrecidos',)}
+    totales['ocupacion'] = (round(totales['citas_reservadas'] / totales['turnos_ofrecidos'], 4)
+                            if totales['turnos_ofrecidos'] else None)
+
+    servicios = [dict(r) for r in conn.execute('''
+        SELECT servicio, sum(citas_reservadas) AS citas_reservadas, sum(citas_canceladas) AS citas_canceladas,
+               sum(ingresos_estimados) AS ingresos_estimados
+        FROM analitica_servicio WHERE fecha BETWEEN ? AND ?
+        GROUP BY servicio ORDER BY ingresos_estimados DESC
+    ''', (desde, hasta))]
+    return {'desde': desde, 'hasta': hasta, 'agrupar': agrupar,
+            'totales': totales, 'serie': serie, 'servicios': servicios}
+
+
+if __name__ == '__main__':
+    from database import db
+    db.reconstruir_analitica()
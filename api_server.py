@@ -1,19 +1,47 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 from groq import Groq
 import datetime
+import collections
 import re
 import json
-from database import db
+from database import db, BarridoSesiones
+from eventos import bus
+from estaticos import ManifiestoEstaticos
+from bitacora import get_logger, iniciar_traza, cerrar_traza, muestrear, truncar
+import perfilador
+from idempotencia import Deduplicador, clave_evento
+from entrada_webhook import normalizar_payload, agrupar_por_remitente
+from despachador import Despachador
+from admision import ControlAdmision, MENSAJE_DIFERIDO
+import plazos
+from estado_compartido import RotacionClaves, PuenteEventos
+import fragmentos
+import resolutor_fechas
+import salida_llm
+import enrutador_modelos
+import analitica
+from pipeline_async import PipelineAsync, PIPELINE_ASYNC
+from recordatorios import Recordatorios, RECORDATORIOS
+from lista_espera import ListaEspera
+from respaldos import Respaldos, RESPALDOS
+from metricas import (registro, medir, cronometrar, observar_etapa, LLM_LATENCIA, LLM_LLAMADAS,
+                      RESPUESTAS_RAPIDAS, CONFLICTOS_RESERVA, TURNOS_EN_CURSO)
 import os
+import sys
 import requests
 import time
+import threading
+import logging
 from dotenv import load_dotenv
 
 # Cargar variables de entorno
 load_dotenv()
 
+# Logging estructurado (JSON, no bloqueante)
+log = get_logger('api')
+
 # Use absolute path for static folder to avoid CWD issues
 # UPDATE: Renaming to 'web' to match standard Flutter build output
 STATIC_FOLDER = os.path.join(os.getcwd(), 'web')
@@ -27,20 +55,30 @@ GROQ_API_KEYS = [
     os.environ.get('GROQ_API_KEY_2', ''),
 ]
 GROQ_API_KEYS = [k for k in GROQ_API_KEYS if k]
-current_key_index = 0
+# Rotación con enfriamiento de keys caídas; compartida entre workers bajo gunicorn
+rotacion_claves = RotacionClaves(max(1, len(GROQ_API_KEYS)), estado=db.estado)
+# Permite apuntar a un Groq falso/proxy (benchmarks/servicios_falsos.py)
+GROQ_BASE_URL = os.environ.get('GROQ_BASE_URL') or None
 
 # === CLIENTE WASENDER (NUEVO) ===
-WASENDER_URL = "https://wasenderapi.com/api/send-message"
-WASENDER_TOKEN = "23b0342bd631a643edbb96b4c9c2d29ae77fff50c1597fed8d3e92eeef5b6ebd"
+WASENDER_URL = os.environ.get('WASENDER_URL', "https://wasenderapi.com/api/send-message")
+WASENDER_TOKEN = os.environ.get('WASENDER_TOKEN', "23b0342bd631a643edbb96b4c9c2d29ae77fff50c1597fed8d3e92eeef5b6ebd")
+# Pausa antes de cada envío (anti-ban de WhatsApp)
+WASENDER_THROTTLE_SEG = float(os.environ.get('WASENDER_THROTTLE_SEG', '2'))
+
+# === PLAZOS POR ETAPA (TOPES; cada etapa usa lo que quede del plazo del turno) ===
+GROQ_TIMEOUT_SEG = 20
+WASENDER_TIMEOUT_SEG = 10
+# Aunque el plazo se haya agotado, la respuesta (aunque sea la fija) se intenta mandar
+WASENDER_TIMEOUT_MINIMO_SEG = 2
+# Con menos que esto no vale la pena intentar Groq: respuesta fija
+PLAZO_MINIMO_LLM_SEG = 1.5
 
 # LISTA NEGRA DE NOMBRES
 NAME_BLACKLIST = ['bro', 'man', 'kp', 'kape', 'amigo', 'hola', 'buenas', 'que tal', 'haupei', 'info', 'precio', 'sera']
 
-def enviar_mensaje_wasender(to, text):
-    """Envía mensaje usando WaSender con manejo de errores y throttling"""
-    # 1. Throttling (Seguridad)
-    time.sleep(2)
-
+def armar_envio_wasender(to, text):
+    """(destino, headers, payload) del envío; lo comparten los turnos y los recordatorios"""
     headers = {
         "Authorization": f"Bearer {WASENDER_TOKEN}",
         "Content-Type": "application/json"
@@ -56,20 +94,36 @@ def enviar_mensaje_wasender(to, text):
         "to": to,
         "text": text
     }
+    return to, headers, payload
+
+def preparar_envio_wasender(to, text):
+    """kwargs del POST de un turno (timeout según el plazo); lo comparten el envío con hilos y el async"""
+    to, headers, payload = armar_envio_wasender(to, text)
+    log.info(f"📤 ENVIANDO A WASENDER: {to} -> {text[:20]}...")
+    return {'json': payload, 'headers': headers,
+            'timeout': plazos.restante(WASENDER_TIMEOUT_SEG, minimo=WASENDER_TIMEOUT_MINIMO_SEG)}
+
+def resultado_envio_wasender(status_code, texto):
+    if status_code in [200, 201]:
+        log.info("✅ WaSender: Enviado OK")
+        return True
+    log.error(f"❌ WaSender Error {status_code}: {truncar(texto)}")
+    return False
 
-    try:
-        print(f"📤 ENVIANDO A WASENDER: {to} -> {text[:20]}...")
-        response = requests.post(WASENDER_URL, json=payload, headers=headers, timeout=10)
+def enviar_mensaje_wasender(to, text):
+    """Envía mensaje usando WaSender con manejo de errores y throttling"""
+    # 1. Throttling (Seguridad): entera aunque el plazo del turno se haya agotado, es lo que evita el ban
+    time.sleep(WASENDER_THROTTLE_SEG)
 
-        if response.status_code in [200, 201]:
-            print("✅ WaSender: Enviado OK")
-            return True
-        else:
-            print(f"❌ WaSender Error {response.status_code}: {response.text}")
-            return False
+    envio = preparar_envio_wasender(to, text)
+
+    try:
+        with medir('envio_wasender'):
+            response = requests.post(WASENDER_URL, **envio)
+        return resultado_envio_wasender(response.status_code, response.text)
 
     except Exception as e:
-        print(f"❌ WaSender Exception: {str(e)}")
+        log.error(f"❌ WaSender Exception: {str(e)}")
         return False
 
 # === MEMORIA DE ESTADO (CONVERSACIÓN + INTENCIÓN) ===
@@ -88,7 +142,7 @@ def obtener_mapa_dias(dias=7):
     return "\n".join(mapa)
 
 # === HELPER DISPONIBILIDAD INTELIGENTE ===
-def obtener_estado_agenda(dias=5):
+def obtener_estado_agenda(dias=5, fechas_extra=()):
     # Usar timezone UTC para evitar deprecation warning, luego restar 4 horas
     ahora = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=4)
     resumen = []
@@ -98,8 +152,15 @@ def obtener_estado_agenda(dias=5):
     # FIX: Opening at 09:00 AM as per updated instruction
     horas_totales = [f"{h:02d}:00" for h in range(9, 20) if h != 12]
 
-    for i in range(dias):
-        fecha_obj = ahora + datetime.timedelta(days=i)
+    fechas = [ahora + datetime.timedelta(days=i) for i in range(dias)]
+    # Fechas pedidas por el cliente fuera de la ventana (ej. "el 23" dentro de 2 semanas)
+    vistas = {f.strftime('%Y-%m-%d') for f in fechas}
+    for extra in fechas_extra:
+        if extra not in vistas and extra > ahora.strftime('%Y-%m-%d'):
+            fechas.append(datetime.datetime.strptime(extra, '%Y-%m-%d'))
+            vistas.add(extra)
+
+    for i, fecha_obj in enumerate(fechas):
         fecha_str = fecha_obj.strftime('%Y-%m-%d')
         dia_semana = fecha_obj.weekday()
 
@@ -159,47 +220,42 @@ def normalizar_hora_str(hora_raw):
     return None
 
 # === HELPER: DETECCIÓN DE CONFLICTOS ===
-def analizar_conflicto_horario(mensaje, estado_actual={}):
+# Para bloquear alcanza una sospecha razonable (la franja sola "a la tarde" no cuenta)
+UMBRAL_FECHA_CONFLICTO = 0.6
+UMBRAL_HORA_CONFLICTO = 0.5
+
+def analizar_conflicto_horario(mensaje, estado_actual={}, resolucion=None):
     """Revisa si el usuario pide (o tiene intención de) una hora que YA está ocupada"""
     try:
-        # 1. Determinar fecha (Hoy o Mañana)
+        # 1. Determinar fecha: la que dice el mensaje manda sobre la de memoria
         ahora = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=4)
-        target_date = ahora
-
-        msg_lower = mensaje.lower()
-        if 'mañana' in msg_lower:
-            target_date = ahora + datetime.timedelta(days=1)
+        if resolucion is None:
+            resolucion = resolutor_fechas.resolver(mensaje, ahora)
 
-        # TODO: Soportar fechas del estado_actual si existen (ej. fecha_intencion)
-        if estado_actual.get('fecha_intencion'):
-            # Si el estado tiene fecha explicita, usémosla (simplificado, asume formato YYYY-MM-DD)
+        fecha_str = resolucion.fecha(UMBRAL_FECHA_CONFLICTO)
+        if not fecha_str and estado_actual.get('fecha_intencion'):
             try:
                 # Validar formato
                 datetime.datetime.strptime(estado_actual['fecha_intencion'], '%Y-%m-%d')
                 fecha_str = estado_actual['fecha_intencion']
             except:
-                fecha_str = target_date.strftime('%Y-%m-%d')
-        else:
-            fecha_str = target_date.strftime('%Y-%m-%d')
+                pass
+        if not fecha_str:
+            fecha_str = ahora.strftime('%Y-%m-%d')
 
-        print(f"🔍 Analizando conflictos para fecha: {fecha_str}")
+        log.debug(f"🔍 Analizando conflictos para fecha: {fecha_str}")
 
         # 2. Identificar Horas Objetivo (Mensaje + Estado)
         targets = []
 
-        # A) Desde el mensaje
-        matches = re.findall(r'\b(\d{1,2})(?::(\d{2}))?\b', mensaje)
-        for m in matches:
-            h_str = m[0]
-            if m[1]: h_str += ":" + m[1]
-            norm = normalizar_hora_str(h_str)
-            if norm: targets.append(norm)
+        # A) Desde el mensaje (solo lo que el resolutor reconoce como hora, no "el 23" ni "3 perros")
+        targets.extend(c.valor for c in resolucion.horas if c.confianza >= UMBRAL_HORA_CONFLICTO)
 
         # B) Desde el estado (Intención previa)
         # Si el usuario dice "Seguro?" o "Confirma", valida la hora que ya tenemos.
         if not targets and estado_actual.get('hora_intencion'):
             targets.append(estado_actual['hora_intencion'])
-            print(f"   ↳ Usando hora de memoria: {estado_actual['hora_intencion']}")
+            log.debug(f"   ↳ Usando hora de memoria: {estado_actual['hora_intencion']}")
 
         if not targets:
             return None
@@ -207,7 +263,7 @@ def analizar_conflicto_horario(mensaje, estado_actual={}):
         # 3. Consultar DB
         citas = db.obtener_citas_por_fecha(fecha_str)
         ocupadas = [c['hora'][:5] for c in citas]
-        print(f"   ↳ Ocupadas en DB: {ocupadas}")
+        log.debug(f"   ↳ Ocupadas en DB: {ocupadas}")
 
         alertas = []
         for t in targets:
@@ -216,29 +272,25 @@ def analizar_conflicto_horario(mensaje, estado_actual={}):
 
         if alertas:
             lista_conflictos = ", ".join(alertas)
-            print(f"🚨 CONFLICTO DETECTADO: {lista_conflictos}")
+            log.warning(f"🚨 CONFLICTO DETECTADO: {lista_conflictos}")
             return f"""[ALERTA DE SISTEMA CRÍTICA]: El usuario preguntó por el horario: {lista_conflictos}.
             ESE HORARIO YA ESTÁ RESERVADO/OCUPADO en la base de datos.
             ⚠️ DEBES RESPONDER QUE NO ESTÁ DISPONIBLE y ofrecer otra hora cercana. NO CONFIRMES."""
 
     except Exception as e:
-        print(f"⚠️ Error analizando conflicto: {e}")
+        log.warning(f"⚠️ Error analizando conflicto: {e}")
 
     return None
 
 # === PROCESADOR DE MEMORIA LLM ===
 def procesar_memoria_ia(respuesta, estado_actual):
-    """Extrae y actualiza el estado basado en la respuesta JSON oculta del LLM"""
+    """Actualiza el estado con la memoria de la respuesta del LLM (texto crudo o ya interpretado)"""
     nuevo_estado = estado_actual.copy()
     try:
-        # Buscar bloque [MEMORIA]...[/MEMORIA]
-        match = re.search(r'\[MEMORIA\](.*?)\[/MEMORIA\]', respuesta, re.DOTALL)
-        if match:
-            json_str = match.group(1).strip()
-            # Intento de corrección de JSON común (comillas simples a dobles)
-            json_str = json_str.replace("'", '"')
-            datos = json.loads(json_str)
-
+        if not isinstance(respuesta, salida_llm.SalidaLLM):
+            respuesta = salida_llm.interpretar(respuesta)
+        datos = respuesta.memoria
+        if datos:
             # Actualizar campos si no están vacíos y son válidos
 
             # 1. Validación de NOMBRE (Blacklist)
@@ -247,7 +299,7 @@ def procesar_memoria_ia(respuesta, estado_actual):
                 if nombre_candidato.lower() not in NAME_BLACKLIST:
                     nuevo_estado['nombre'] = nombre_candidato
                 else:
-                    print(f"⚠️ Nombre '{nombre_candidato}' en lista negra. Ignorando.")
+                    log.warning(f"⚠️ Nombre '{nombre_candidato}' en lista negra. Ignorando.")
 
             if datos.get('fecha'): nuevo_estado['fecha_intencion'] = datos['fecha']
             if datos.get('servicio'): nuevo_estado['servicio'] = datos['servicio']
@@ -264,7 +316,7 @@ def procesar_memoria_ia(respuesta, estado_actual):
                     # Si es >= 20, está cerrado. Si es < 8, cerrado.
                     if h_check < 8 or h_check >= 20:
                         # Si está fuera de rango, NO lo guardamos (o lo borramos si existía)
-                        print(f"⚠️ Hora {hora_final} fuera de rango (8-20). Ignorando.")
+                        log.warning(f"⚠️ Hora {hora_final} fuera de rango (8-20). Ignorando.")
                         if 'hora_intencion' in nuevo_estado:
                             del nuevo_estado['hora_intencion']
                     else:
@@ -273,22 +325,52 @@ def procesar_memoria_ia(respuesta, estado_actual):
                     # Si no podemos validar, no guardamos basura
                     pass
 
-            print(f"🧠 MEMORIA ACTUALIZADA: {nuevo_estado}")
+            log.info(f"🧠 MEMORIA ACTUALIZADA: {nuevo_estado}")
     except Exception as e:
-        print(f"⚠️ Error procesando memoria IA: {e}")
+        log.warning(f"⚠️ Error procesando memoria IA: {e}")
 
     return nuevo_estado
 
+# === MEMORIA DESDE EL RESOLUTOR ===
+def recordar_fecha_hora(estado_actual, resolucion):
+    """Guarda en la sesión la fecha/hora que el resolutor entendió con confianza; True si cambió algo"""
+    cambio = False
+    if not resolucion.ambigua:
+        fecha = resolucion.fecha(resolutor_fechas.UMBRAL_MEMORIA)
+        # Domingo cerrado: mejor que el LLM lo explique a guardarlo
+        if fecha and datetime.date.fromisoformat(fecha).weekday() != 6 and estado_actual.get('fecha_intencion') != fecha:
+            estado_actual['fecha_intencion'] = fecha
+            cambio = True
+        hora = resolucion.hora(resolutor_fechas.UMBRAL_MEMORIA)
+        if hora and resolutor_fechas.APERTURA <= int(hora[:2]) < resolutor_fechas.CIERRE \
+                and estado_actual.get('hora_intencion') != hora:
+            estado_actual['hora_intencion'] = hora
+            cambio = True
+    if cambio:
+        log.info(f"🗓️ Fecha/hora resueltas del mensaje: {estado_actual.get('fecha_intencion')} {estado_actual.get('hora_intencion')}")
+    return cambio
+
 # === BOT LOGIC ===
-def generar_respuesta_ia(mensaje, cliente, push_name=None):
-    global current_key_index
-    
+# Un turno en tres pasos: preparar (DB + prompt), LLM, finalizar (memoria, cita, historial).
+# generar_respuesta_ia los encadena en un hilo; pipeline_async.py los reusa con Groq/DB async.
+# Si mensajes es None, respuesta ya es la final (bot apagado, conflicto, etc.)
+# ruta: modelo y max_tokens del turno (enrutador_modelos.py)
+TurnoPreparado = collections.namedtuple('TurnoPreparado', ['respuesta', 'mensajes', 'sesion', 'ruta'], defaults=(None,))
+
+# Modo JSON (salida_llm.py): el objeto suma unos tokens a la respuesta. LLM_JSON=0 lo apaga
+# para modelos sin response_format; el parser tolera igual el JSON suelto o sucio.
+# Modelo y max_tokens los pone la ruta de cada turno (enrutador_modelos.parametros)
+PARAMETROS_LLM = {"temperature": 0.5}
+if os.environ.get('LLM_JSON', '1').lower() not in ('0', 'false', 'no'):
+    PARAMETROS_LLM['response_format'] = {"type": "json_object"}
+
+def preparar_turno(mensaje, cliente, push_name=None):
     bot_encendido = db.get_config('bot_encendido', 'true')
     if bot_encendido != 'true':
-        return None
+        return TurnoPreparado(None, None, None)
     
     if not GROQ_API_KEYS:
-        return "Error: Sistema no configurado."
+        return TurnoPreparado("Error: Sistema no configurado.", None, None)
     
     config = db.get_all_config()
     nombre_negocio = config.get('nombre_negocio', 'Barbería Z')
@@ -309,16 +391,17 @@ def generar_respuesta_ia(mensaje, cliente, push_name=None):
     # Contexto de mapa de días para el LLM
     mapa_dias = obtener_mapa_dias(7)
 
-    print(f"🕒 SERVER TIME (UTC-4): {fecha_hoy} {hora_actual} ({dia_semana})")
+    log.debug(f"🕒 SERVER TIME (UTC-4): {fecha_hoy} {hora_actual} ({dia_semana})")
 
     # Recuperar sesión desde DB (Persistencia)
-    sesion = db.get_session(cliente)
+    with medir('carga_sesion'):
+        sesion = db.get_session(cliente)
     estado_actual = sesion['state']
 
     # RESET MANUAL POR PALABRAS CLAVE (ZOMBIE KILLER)
     msg_lower = mensaje.lower().strip()
     if msg_lower in ['hola', 'inicio', 'menu', 'menú', 'buenas', 'comenzar']:
-        print(f"🧹 Reiniciando sesión para {cliente} (Keyword: {msg_lower})")
+        log.info(f"🧹 Reiniciando sesión para {cliente} (Keyword: {msg_lower})")
         db.save_session_state(cliente, {})
         sesion = db.get_session(cliente) # Recargar limpia
         estado_actual = {}
@@ -327,12 +410,32 @@ def generar_respuesta_ia(mensaje, cliente, push_name=None):
     if not estado_actual.get('nombre') and push_name:
          # Filter pushname too
          if push_name.lower() not in NAME_BLACKLIST:
-             print(f"👤 Auto-detectando nombre de WhatsApp: {push_name}")
+             log.info(f"👤 Auto-detectando nombre de WhatsApp: {push_name}")
              estado_actual['nombre'] = push_name.title() # Title case fix
              # Guardamos inmediatamente para que el prompt lo use
              db.save_session_state(cliente, estado_actual)
 
-    estado_agenda = obtener_estado_agenda(5)
+    # Fecha/hora dichas en el mensaje, resueltas sin LLM ("el viernes a las 5" -> 2025-12-19 17:00)
+    with medir('resolver_fechas'):
+        resolucion = resolutor_fechas.resolver(mensaje, ahora)
+    if recordar_fecha_hora(estado_actual, resolucion):
+        db.save_session_state(cliente, estado_actual)
+
+    # Turno liberado que le ofrecimos (lista de espera): a la memoria, así su "sí" lo reserva
+    oferta = lista_espera.oferta_pendiente(cliente)
+    if oferta and estado_actual.get('oferta_espera') != oferta.id:
+        estado_actual.update(oferta_espera=oferta.id, fecha_intencion=oferta.fecha, hora_intencion=oferta.hora)
+        if oferta.nombre and not estado_actual.get('nombre'):
+            estado_actual['nombre'] = oferta.nombre
+        if oferta.servicio and not estado_actual.get('servicio'):
+            estado_actual['servicio'] = oferta.servicio
+        db.save_session_state(cliente, estado_actual)
+
+    with medir('disponibilidad'):
+        fecha_pedida = resolucion.fecha(UMBRAL_FECHA_CONFLICTO)
+        estado_agenda = obtener_estado_agenda(5, fechas_extra=[fecha_pedida] if fecha_pedida else ())
+
+    inicio_prompt = time.perf_counter()
 
     contexto_memoria = ""
     if estado_actual.get('nombre'):
@@ -347,7 +450,8 @@ def generar_respuesta_ia(mensaje, cliente, push_name=None):
     # === DETECCIÓN PROACTIVA DE CONFLICTOS (HARD BLOCK) ===
     # Si detectamos que el usuario pide algo ocupado, CORTAMOS aquí. No dejamos que el LLM alucine.
     # Pasamos estado_actual para validar intenciones previas ("Confirmame")
-    alerta_conflicto = analizar_conflicto_horario(mensaje, estado_actual)
+    with medir('conflictos'):
+        alerta_conflicto = analizar_conflicto_horario(mensaje, estado_actual, resolucion)
     if alerta_conflicto:
         # Extraer la hora del conflicto para el mensaje amigable
         # El string de alerta tiene formato: "... horario: 17:00 (2025-12-18)..."
@@ -358,8 +462,9 @@ def generar_respuesta_ia(mensaje, cliente, push_name=None):
         respuesta_directa = f"⚠️ Disculpa, justo se ocupó las {hora_ocupada}, tengo otros turnos libres. ¿Te sirve otro horario?"
 
         # Guardar en historial para contexto
-        db.agregar_mensaje(cliente, respuesta_directa, es_bot=True)
-        return respuesta_directa
+        db.agregar_mensaje(cliente, respuesta_directa, es_bot=True, tipo_turno='conflicto')
+        RESPUESTAS_RAPIDAS.inc(motivo='conflicto')
+        return TurnoPreparado(respuesta_directa, None, None)
 
     # === LÓGICA DE ESTADOS DINÁMICA (STATE MACHINE) ===
     # Determinamos qué falta para guiar al LLM con una instrucción ÚNICA y CLARA.
@@ -394,7 +499,7 @@ def generar_respuesta_ia(mensaje, cliente, push_name=None):
         OBJETIVO: CONFIRMAR CITA.
         - Tienes TODOS los datos.
         - Di: "Perfecto [Nombre], te anoto para el [Fecha] a las [Hora] hs entonces. ¿Te confirmo el turno?"
-        - Si responde SÍ/CONFIRMO: Genera el código [CITA]...[/CITA].
+        - Si responde SÍ/CONFIRMO: completa el campo "cita" del JSON.
         """
 
     system_prompt = f"""Eres el asistente virtual de {nombre_negocio}.
@@ -432,189 +537,378 @@ HORARIO OFICIAL: 09:00 AM a 20:00 PM. (Almuerzo 12:00 - 13:00 CERRADO)
    - Si NO está en la lista, di que no y ofrece las alternativas más cercanas.
    - NO alucines horarios ocupados si la lista dice que están libres.
 
-3. **GESTIÓN DE MEMORIA**: Al final de CADA respuesta, incluye SIEMPRE:
-   [MEMORIA]{{"nombre": "...", "fecha": "...", "hora": "...", "servicio": "..."}}[/MEMORIA]
-   - Copia los datos de la MEMORIA anterior.
-   - Agrega/Actualiza lo nuevo que diga el usuario.
+3. **FORMATO DE SALIDA (JSON)**: Responde SIEMPRE con un único objeto JSON, sin texto fuera de él:
+   {{"respuesta": "lo que le escribes al cliente",
+     "memoria": {{"nombre": "...", "fecha": "YYYY-MM-DD", "hora": "HH:MM", "servicio": "..."}},
+     "cita": null}}
+   - "memoria": copia los datos de la MEMORIA anterior y agrega/actualiza lo nuevo que diga el usuario.
    - "hora" debe ser en formato 24h (ej: 19:00).
-   - REGLA DE ORO: Si la hora detectada es menor a 09:00 o mayor a 20:00, NO LA GUARDES en memoria (déjala vacía o null).
+   - REGLA DE ORO: Si la hora detectada es menor a 09:00 o mayor a 20:00, NO LA GUARDES en memoria (déjala null).
 
 4. **CONFIRMACIÓN FINAL**:
-   Solo si el usuario confirma explícitamente y tienes todo:
-   [CITA]Nombre|Servicio|YYYY-MM-DD|HH:MM[/CITA]
+   Solo si el usuario confirma explícitamente y tienes todo, en lugar de null:
+   "cita": {{"nombre": "...", "servicio": "...", "fecha": "YYYY-MM-DD", "hora": "HH:MM"}}
+
+5. **LISTA DE ESPERA**: Si el día que quiere está [AGOTADO] (o no hay la hora que pide), ofrécele anotarlo.
+   Si acepta, agrega al JSON: "espera": {{"fecha": "YYYY-MM-DD", "desde": "HH:MM", "hasta": "HH:MM"}}
+   (el rango de horas que le sirve) y dile que le avisamos por acá si se libera un turno.
 """
 
     mensajes = [{"role": "system", "content": system_prompt}]
     mensajes.extend(sesion['history'])
-    
+    observar_etapa('armado_prompt', time.perf_counter() - inicio_prompt)
+    return TurnoPreparado(None, mensajes, sesion, enrutador_modelos.elegir(datos_faltantes, mensajes))
+
+def finalizar_turno(respuesta, cliente, sesion):
+    """Post-proceso de la respuesta del LLM (texto crudo o ya interpretado): historial, memoria, cita;
+    devuelve lo que ve el cliente"""
+    # Una sola lectura de la salida (JSON, sucia o con etiquetas viejas)
+    with medir('parseo_memoria'):
+        salida = respuesta if isinstance(respuesta, salida_llm.SalidaLLM) else salida_llm.interpretar(respuesta)
+        nuevo_estado = procesar_memoria_ia(salida, sesion['state'])
+    respuesta_visible = salida.respuesta or "Perdón, no te entendí bien 🙏 ¿Me lo repetís?"
+
+    # Guardar respuesta del bot en el historial (DB): el texto, no el JSON
+    db.agregar_mensaje(cliente, respuesta_visible, es_bot=True, tipo_turno='llm')
+
+    # GUARDAR ESTADO EN DB (PERSISTENCIA)
+    db.save_session_state(cliente, nuevo_estado)
+
+    if salida.espera:
+        lista_espera.anotar(cliente, salida.espera['fecha'], salida.espera['desde'], salida.espera['hasta'],
+                            nombre=nuevo_estado.get('nombre'), servicio=nuevo_estado.get('servicio'), origen='llm')
+
+    if salida.cita:
+        with medir('reserva_cita'):
+            try:
+                datos_cita = procesar_cita(salida.cita, cliente)
+                ocupado = datos_cita is None
+            except Exception as e:
+                log.error(f"❌ Error DB guardando la cita: {e}")
+                datos_cita, ocupado = None, False
+
+        if datos_cita:
+            # ÉXITO: Cita guardada
+            c_nombre = datos_cita['nombre'].title()
+            respuesta_visible = f"¡LISTO {c_nombre}! ✅ Tu turno quedó confirmado para el {datos_cita['fecha']} a las {datos_cita['hora']} hs. Te esperamos en Barbería Z. ¡Nos vemos!"
+
+            # Reset estado tras confirmar
+            db.save_session_state(cliente, {})
+        elif ocupado:
+            # FALLO: procesar_cita devolvió None (Ocupado) -> queda en lista de espera por si se libera
+            lista_espera.anotar(cliente, salida.cita['fecha'], salida.cita['hora'], nombre=salida.cita['nombre'],
+                                servicio=salida.cita['servicio'], origen='conflicto')
+            respuesta_visible = ("⚠️ Lo siento, ese turno se acaba de ocupar hace unos segundos. 😅 "
+                                 "Te anoté en la lista de espera: si se libera te aviso por acá. "
+                                 "Mientras, ¿querés elegir otro horario?")
+            # Mantenemos el estado para que el usuario pueda intentar otra hora inmediatamente
+            if 'hora_intencion' in nuevo_estado:
+                del nuevo_estado['hora_intencion']
+                db.save_session_state(cliente, nuevo_estado)
+        else:
+            # Error de la DB: el turno puede seguir libre, la memoria queda para reintentar la confirmación
+            respuesta_visible = ("⚠️ Tuvimos un problema guardando tu turno, todavía no quedó confirmado. 🙏 "
+                                 "¿Me lo confirmás de nuevo en un minuto?")
+
+    return respuesta_visible
+
+def conversar_con_groq(turno, cliente):
+    """Rotación de claves y escalado de modelo de un turno, sin hacer la llamada a Groq.
+
+    Generador: entrega (indice_clave, parametros) de cada llamada y recibe (chat_completion, error).
+    Lo recorren generar_respuesta_ia (hilos) y pipeline_async con avanzar_conversacion;
+    la respuesta final es su valor de retorno."""
     for intento in range(len(GROQ_API_KEYS)):
-        api_key = GROQ_API_KEYS[current_key_index]
-        try:
-            groq_client = Groq(api_key=api_key)
-            chat_completion = groq_client.chat.completions.create(
-                messages=mensajes,
-                model="llama-3.1-8b-instant",
-                max_tokens=300,
-                temperature=0.5
-            )
-            respuesta = chat_completion.choices[0].message.content
-            print(f"✅ GROQ respondió: {respuesta[:50]}...")
-
-            # Guardar respuesta del bot en el historial (DB)
-            db.agregar_mensaje(cliente, respuesta, es_bot=True)
-
-            # Procesar Memoria Oculta
-            nuevo_estado = procesar_memoria_ia(respuesta, sesion['state'])
-
-            # GUARDAR ESTADO EN DB (PERSISTENCIA)
-            db.save_session_state(cliente, nuevo_estado)
-            
-            # Limpiar bloque de memoria de la respuesta al usuario
-            # Limpieza NUCLEAR V2: Split string (Más robusto que Regex)
-            if '[MEMORIA]' in respuesta:
-                respuesta_visible = respuesta.split('[MEMORIA]')[0].strip()
+        # Sin presupuesto para otro intento: respuesta fija en vez de hacer esperar al cliente
+        if plazos.vencido(PLAZO_MINIMO_LLM_SEG):
+            log.warning(f"⏱️ Plazo agotado antes de Groq (intento {intento + 1}), respuesta fija")
+            return respuesta_degradada(cliente, 'plazo')
+
+        indice_clave = rotacion_claves.actual()
+        # Ruta elegida en preparar_turno; una respuesta que no valida se repite con el modelo fuerte
+        ruta, salida = turno.ruta, None
+        while ruta is not None:
+            inicio_llamada = time.perf_counter()
+            chat_completion, error = yield indice_clave, enrutador_modelos.parametros(ruta, PARAMETROS_LLM)
+            if error is None:
+                respuesta = chat_completion.choices[0].message.content
+                LLM_LLAMADAS.inc(clave=str(indice_clave), resultado='ok')
             else:
-                respuesta_visible = respuesta.strip()
-
-            if '[CITA]' in respuesta_visible and '[/CITA]' in respuesta_visible:
-                # Extraer datos de cita antes de limpiar
-                datos_cita = procesar_cita(respuesta_visible, cliente)
-
-                # BUGFIX: Limpieza de chat (Triple despedida)
-                match_cita = re.search(r'\[CITA\](.+?)\[/CITA\]', respuesta_visible)
-
-                if datos_cita:
-                    # ÉXITO: Cita guardada
-                    if match_cita:
-                        try:
-                            raw = match_cita.group(1).split('|')
-                            c_nombre = raw[0].strip().title()
-                            c_fecha = raw[2].strip()
-                            c_hora = raw[3].strip()
-                            respuesta_visible = f"¡LISTO {c_nombre}! ✅ Tu turno quedó confirmado para el {c_fecha} a las {c_hora} hs. Te esperamos en Barbería Z. ¡Nos vemos!"
-                        except:
-                            respuesta_visible = "¡LISTO! ✅ Tu turno quedó confirmado. ¡Te esperamos!"
-
-                    # Reset estado tras confirmar
-                    db.save_session_state(cliente, {})
-                else:
-                    # FALLO: procesar_cita devolvió None (Ocupado)
-                    respuesta_visible = "⚠️ Lo siento, ese turno se acaba de ocupar hace unos segundos. 😅 Por favor elige otro horario."
-                    # Mantenemos el estado para que el usuario pueda intentar otra hora inmediatamente
-                    # (Quizás borramos solo la hora de la intención?)
-                    if 'hora_intencion' in sesion['state']:
-                        del sesion['state']['hora_intencion']
-                        db.save_session_state(cliente, sesion['state'])
-
-            return respuesta_visible
-            
-        except Exception as e:
-            print(f"⚠️ GROQ Error: {str(e)}")
-            current_key_index = (current_key_index + 1) % len(GROQ_API_KEYS)
-    
+                # JSON inválido según Groq: la key anda y el texto se puede rescatar
+                chat_completion, respuesta = None, salida_llm.generacion_fallida(error)
+                if not respuesta:
+                    log.warning(f"⚠️ GROQ Error: {str(error)}")
+                    LLM_LLAMADAS.inc(clave=str(indice_clave), resultado='error')
+                    enrutador_modelos.registrar(ruta, time.perf_counter() - inicio_llamada, 'error')
+                    # Si ya respondió la primera llamada, la key anda: el error es del modelo fuerte
+                    if salida is None:
+                        rotacion_claves.fallo(indice_clave, str(error))
+                    break
+                LLM_LLAMADAS.inc(clave=str(indice_clave), resultado='json_invalido')
+            rotacion_claves.exito(indice_clave)
+            log.info(f"✅ GROQ respondió: {respuesta[:50]}...")
+            salida = salida_llm.interpretar(respuesta)
+            ruta = enrutador_modelos.revisar(ruta, salida, time.perf_counter() - inicio_llamada, chat_completion)
+            # Escalar solo si queda plazo para otra llamada
+            if ruta is not None and plazos.vencido(PLAZO_MINIMO_LLM_SEG):
+                ruta = None
+
+        # Si falló el modelo fuerte, la primera respuesta sirve más que otro intento
+        if salida is not None:
+            return finalizar_turno(salida, cliente, turno.sesion)
+
+    # Groq se comió el plazo (timeout): mejor la respuesta fija que "ocupado"
+    if plazos.vencido(PLAZO_MINIMO_LLM_SEG):
+        return respuesta_degradada(cliente, 'plazo')
     return "El sistema está ocupado."
 
-def procesar_cita(respuesta, telefono):
+def avanzar_conversacion(conversacion, resultado=None):
+    """Un paso de conversar_con_groq: (llamada, None) con la próxima llamada, o (None, respuesta) al terminar"""
     try:
-        match = re.search(r'\[CITA\](.+?)\[/CITA\]', respuesta)
-        if match:
-            datos = match.group(1).split('|')
-            if len(datos) >= 4:
-                hora_raw = datos[3].strip()
-                if len(hora_raw) == 4 and ':' in hora_raw:
-                    hora_raw = "0" + hora_raw
-
-                # Llamar a DB (Ahora retorna ID o None si falla)
-                cita_id = db.agregar_cita(
-                    fecha=datos[2].strip(),
-                    hora=hora_raw,
-                    cliente_nombre=datos[0].strip(),
-                    telefono=telefono,
-                    servicio=datos[1].strip()
-                )
-
-                if cita_id:
-                    print(f"✅ CITA GUARDADA EN DB (ID: {cita_id})")
-                    return datos # Retornar datos para uso en mensaje
-                else:
-                    print(f"🚫 FALLO AL GUARDAR CITA (Ocupado)")
-                    return None
-    except Exception as e:
-        print(f"❌ Error DB: {e}")
+        return conversacion.send(resultado), None
+    except StopIteration as fin:
+        return None, fin.value
+
+def generar_respuesta_ia(mensaje, cliente, push_name=None):
+    turno = preparar_turno(mensaje, cliente, push_name=push_name)
+    if turno.mensajes is None:
+        return turno.respuesta
+
+    conversacion = conversar_con_groq(turno, cliente)
+    llamada, respuesta = avanzar_conversacion(conversacion)
+    while llamada is not None:
+        indice_clave, parametros = llamada
+        # Sin reintentos internos del SDK: los reintentos son la rotación de claves, medidos contra el plazo
+        groq_client = Groq(api_key=GROQ_API_KEYS[indice_clave], base_url=GROQ_BASE_URL, max_retries=0)
+        try:
+            with cronometrar(LLM_LATENCIA, clave=str(indice_clave)):
+                resultado = groq_client.chat.completions.create(
+                    messages=turno.mensajes, timeout=plazos.restante(GROQ_TIMEOUT_SEG), **parametros), None
+        except Exception as e:
+            resultado = None, e
+        llamada, respuesta = avanzar_conversacion(conversacion, resultado)
+    return respuesta
+
+def procesar_cita(cita, telefono):
+    """cita: dict de salida_llm (o la respuesta cruda del LLM); devuelve la cita guardada o None si el
+    turno está ocupado. Los errores de la DB (lock vencido, conexión) se propagan: no son un turno ocupado"""
+    if isinstance(cita, str):
+        cita = salida_llm.interpretar(cita).cita
+    if not cita:
+        return None
+    hora_raw = cita['hora']
+    if len(hora_raw) == 4 and ':' in hora_raw:
+        hora_raw = "0" + hora_raw
+    cita = dict(cita, hora=hora_raw)
+
+    # Llamar a DB (ID, o None si el turno ya está tomado)
+    cita_id = db.agregar_cita(
+        fecha=cita['fecha'],
+        hora=hora_raw,
+        cliente_nombre=cita['nombre'],
+        telefono=telefono,
+        servicio=cita['servicio']
+    )
+
+    if cita_id:
+        log.info(f"✅ CITA GUARDADA EN DB (ID: {cita_id})")
+        return cita # Retornar datos para uso en mensaje
+    log.warning(f"🚫 FALLO AL GUARDAR CITA (Ocupado)")
+    CONFLICTOS_RESERVA.inc()
     return None
 
 # === WEBHOOK WASENDER (GENÉRICO) ===
+# Set de eventos ya vistos (memoria + tabla webhook_eventos)
+deduplicador = Deduplicador(db)
+
+# Respuesta fija con la agenda real: se recalcula solo cuando cambian las citas (o cada minuto por la hora)
+_cache_respuesta_fija = {'clave': None, 'texto': None}
+
+def respuesta_fija():
+    clave = (db.version('citas'), int(time.time() // 60))
+    if _cache_respuesta_fija['clave'] != clave:
+        _cache_respuesta_fija['texto'] = (
+            "¡Hola! 👋 Ahora mismo tenemos muchas consultas. Estos son los turnos libres:\n"
+            f"{obtener_estado_agenda(3)}\n"
+            "Decime día, hora y servicio y te lo reservamos apenas podamos. 💈")
+        _cache_respuesta_fija['clave'] = clave
+    return _cache_respuesta_fija['texto']
+
+def respuesta_degradada(remitente, decision):
+    """Respuesta sin LLM cuando la admisión degrada el turno"""
+    if db.get_config('bot_encendido', 'true') != 'true':
+        return None
+    respuesta = MENSAJE_DIFERIDO if decision in ('diferir', 'limitar') else respuesta_fija()
+    db.agregar_mensaje(remitente, respuesta, es_bot=True, tipo_turno=decision)
+    RESPUESTAS_RAPIDAS.inc(motivo=decision)
+    return respuesta
+
+def limitar_turno(remitente, mensajes):
+    """Remitente sin tokens: un solo aviso por ráfaga y el turno se reintenta cuando se recarga el bucket"""
+    primero = admision.retener(remitente, [m.mensaje for m in mensajes])
+    if primero:
+        respuesta = respuesta_degradada(remitente, 'limitar')
+        if respuesta:
+            enviar_mensaje_wasender(remitente, respuesta)
+    # Un reintento pendiente por remitente (el propio reintento limitado se reprograma)
+    if primero or not mensajes:
+        temporizador = threading.Timer(admision.espera_recarga(), reintentar_turno, (remitente,))
+        temporizador.daemon = True
+        temporizador.start()
+    log.info(f"🚦 Turno de {remitente} retenido (limitar)")
+
+def reintentar_turno(remitente):
+    """Vuelve a encolar el turno retenido, con traza y plazo propios"""
+    token_traza = iniciar_traza()
+    token_plazo = plazos.iniciar_plazo()
+    try:
+        despachador.encolar(remitente, [], time.perf_counter())
+    finally:
+        plazos.soltar_plazo(token_plazo)
+        cerrar_traza(token_traza)
+
+def confirmar_eventos(mensajes):
+    """El turno terminó: sus eventos de webhook quedan descartados también tras un reinicio"""
+    for m in mensajes:
+        deduplicador.confirmar(m.clave)
+
+def procesar_turno(remitente, mensajes, inicio_turno):
+    """Un turno por remitente: guarda todos sus mensajes del lote y responde una sola vez"""
+    # El perfil y el desglose por etapa son del turno, no del webhook que solo encoló
+    with perfilador.turno(remitente, inicio_turno):
+        _procesar_turno(remitente, mensajes, inicio_turno)
+
+def _procesar_turno(remitente, mensajes, inicio_turno):
+    observar_etapa('espera_cola', time.perf_counter() - inicio_turno)
+    TURNOS_EN_CURSO.inc()
+    try:
+        for m in mensajes:
+            db.agregar_mensaje(remitente, m.mensaje, es_bot=False)
+        # Reintento de un turno limitado que ya respondió un turno posterior: nada que hacer
+        if not mensajes and not admision.hay_retenidos(remitente):
+            return
+
+        # Admisión: spam, cola cargada o sin cupo de LLM -> degradamos en vez de llamar a Groq
+        decision = admision.decidir(remitente)
+        if decision == 'ignorar':
+            log.info(f"🚦 Turno de {remitente} sin respuesta ({decision})")
+            return
+        if decision == 'limitar':
+            limitar_turno(remitente, mensajes)
+            return
+
+        # Varios mensajes seguidos del mismo cliente = una sola consulta al LLM (con los que se retuvieron)
+        texto = "\n".join(admision.retomar(remitente) + [m.mensaje for m in mensajes])
+        push_name = next((m.push_name for m in reversed(mensajes) if m.push_name), None)
+        if decision == 'llm':
+            with admision.cupo_llm() as hay_cupo:
+                if hay_cupo:
+                    respuesta = generar_respuesta_ia(texto, remitente, push_name=push_name)
+                else:
+                    respuesta = respuesta_degradada(remitente, 'fija')
+        else:
+            respuesta = respuesta_degradada(remitente, decision)
+
+        if respuesta:
+            enviar_mensaje_wasender(remitente, respuesta)
+    finally:
+        confirmar_eventos(mensajes)
+        TURNOS_EN_CURSO.dec()
+        observar_etapa('turno_completo', time.perf_counter() - inicio_turno)
+
+# Un hilo por porción de remitentes: orden garantizado por cliente, el webhook no espera al LLM.
+# PIPELINE=async: mismo contrato, pero todos los turnos en un event loop (pipeline_async.py)
+if PIPELINE_ASYNC:
+    despachador = PipelineAsync(sys.modules[__name__])
+else:
+    despachador = Despachador(procesar_turno)
+registro.medidor('bot_turnos_encolados', 'Turnos esperando en el despachador',
+                 funcion=despachador.pendientes)
+admision = ControlAdmision(db, pendientes=despachador.pendientes, estado=db.estado)
+# Con FRAGMENTOS>0 (gunicorn) cada remitente se procesa siempre en el mismo proceso fragmento
+enrutador = fragmentos.Enrutador(db) if fragmentos.FRAGMENTOS > 0 else None
+
 @app.route("/wasender/webhook", methods=['POST'])
 def wasender_webhook():
+    inicio_turno = time.perf_counter()
+    # Trace ID del turno: viaja por contextvars hasta el envío a WaSender (también en el despachador)
+    token_traza = iniciar_traza(request.headers.get('X-Request-ID'))
+    # Plazo de punta a punta del turno (incluye la espera en el despachador)
+    token_plazo = plazos.iniciar_plazo()
     try:
         # Intentar leer JSON
         data = request.json
         if not data:
-            print("⚠️ Webhook vacío")
+            log.warning("⚠️ Webhook vacío")
             return 'OK', 200
 
-        print(f"📩 WEBHOOK RAW: {data}")
-        
-        # Lógica de parsing flexible
-        mensaje = ""
-        remitente = ""
-        push_name = None
-        
-        # Caso 1: Estructura plana
-        if 'message' in data and 'from' in data:
-            mensaje = data['message']
-            remitente = data['from']
-        # Caso 2: Estructura WaSender
-        elif 'data' in data and 'messages' in data['data']:
-            msg_data = data['data']['messages'][0] if isinstance(data['data']['messages'], list) else data['data']['messages']
-
-            # Extracción del mensaje
-            mensaje = msg_data.get('messageBody')
-            if not mensaje:
-                 contenido_msg = msg_data.get('message', {})
-                 mensaje = contenido_msg.get('conversation') or contenido_msg.get('extendedTextMessage', {}).get('text')
-
-            # Extracción del remitente
-            remitente = msg_data.get('remoteJid') or msg_data.get('key', {}).get('remoteJid')
-
-            # Extracción del PushName (Nombre Perfil)
-            push_name = msg_data.get('pushName')
-
-        # Caso 3: Estructura anidada genérica (fallback)
-        elif 'data' in data:
-            mensaje = data['data'].get('message') or data['data'].get('body')
-            remitente = data['data'].get('from') or data['data'].get('phone')
-
-        if not mensaje or not remitente:
-            print("⚠️ No se pudo extraer mensaje/remitente del JSON")
+        if log.isEnabledFor(logging.DEBUG) and muestrear():
+            log.debug("📩 WEBHOOK RAW", extra={'datos': truncar(data)})
+
+        # Todos los mensajes del lote (las tres formas de payload)
+        mensajes = list(normalizar_payload(data))
+        if not mensajes:
+            log.warning("⚠️ No se pudo extraer mensaje/remitente del JSON")
             return 'OK', 200
+        observar_etapa('parseo_webhook', time.perf_counter() - inicio_turno)
+
+        # Reintento de WaSender: cortamos antes de tocar DB o LLM (mensaje por mensaje)
+        nuevos = []
+        for m in mensajes:
+            # contactos_ignorados: set en memoria, ni DB ni cola
+            if admision.es_ignorado(m.remitente):
+                continue
+            clave = clave_evento(m.remitente, m.mensaje, m.msg_id, m.timestamp)
+            if clave and deduplicador.es_duplicado(clave):
+                log.info(f"♻️ Webhook duplicado descartado ({m.msg_id or 'sin id'})")
+            else:
+                # La clave viaja con el turno: se confirma en la tabla cuando termina (no al responder 200)
+                nuevos.append(m._replace(clave=clave))
+
+        for remitente, grupo in agrupar_por_remitente(nuevos).items():
+            if enrutador is None or not enrutador.enviar(remitente, grupo):
+                despachador.encolar(remitente, grupo, inicio_turno)
 
-        # Limpiar remitente
-        remitente = remitente.replace('@c.us', '').replace('+', '')
-        
-        # Procesar con IA
-        db.agregar_mensaje(remitente, mensaje, es_bot=False)
-        respuesta = generar_respuesta_ia(mensaje, remitente, push_name=push_name)
-        
-        if respuesta:
-            exito = enviar_mensaje_wasender(remitente, respuesta)
-        
         return 'OK', 200
-        
+
     except Exception as e:
-        print(f"❌ ERROR WEBHOOK: {str(e)}")
+        log.exception(f"❌ ERROR WEBHOOK: {str(e)}")
         return 'Error', 500
+    finally:
+        plazos.soltar_plazo(token_plazo)
+        cerrar_traza(token_traza)
+
+# === GET CONDICIONAL (ETAG) PARA EL PANEL ===
+MAX_RESULTADOS_BUSQUEDA = 100
+MAX_CONVERSACIONES_PAGINA = 100
+
+def responder_con_etag(etag, construir):
+    """Responde 304 si el panel ya tiene esta versión; si no, arma el JSON"""
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(construir())
+    response.set_etag(etag)
+    # El panel siempre revalida, pero sin bajar el payload si no cambió
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/api/stats', methods=['GET'])
 def api_stats():
-    config = db.get_all_config()
-    return jsonify({
-        'bot_encendido': config.get('bot_encendido', 'true') == 'true',
-        'nombre_negocio': config.get('nombre_negocio', 'Barbería Z'),
-        'total_citas': len(db.obtener_todas_las_citas()),
-        'citas_hoy': db.contar_citas_hoy(),
-        'mensajes_hoy': db.contar_mensajes_hoy()
-    })
+    # citas_hoy / mensajes_hoy dependen del día, va en el ETag
+    hoy = datetime.date.today().isoformat()
+    etag = f"stats-{hoy}-{db.version('citas', 'config', 'mensajes')}"
+
+    def construir():
+        config = db.get_all_config()
+        return {
+            'bot_encendido': config.get('bot_encendido', 'true') == 'true',
+            'nombre_negocio': config.get('nombre_negocio', 'Barbería Z'),
+            'total_citas': db.contar_citas(),
+            'citas_hoy': db.contar_citas_hoy(),
+            'mensajes_hoy': db.contar_mensajes_hoy()
+        }
+    return responder_con_etag(etag, construir)
 
 @app.route('/api/config', methods=['GET', 'POST'])
 def api_config():
@@ -623,7 +917,55 @@ def api_config():
         for key, value in data.items():
             db.set_config(key, str(value))
         return jsonify({'success': True})
-    return jsonify(db.get_all_config())
+    return responder_con_etag(f"config-{db.version('config')}", db.get_all_config)
+
+@app.route('/api/analytics', methods=['GET'])
+def api_analytics():
+    """?desde=2025-01-01&hasta=2025-12-31&agrupar=dia|semana|mes|anio (lee solo los rollups)"""
+    hoy = datetime.date.today()
+    desde = request.args.get('desde') or hoy.replace(day=1).isoformat()
+    hasta = request.args.get('hasta') or hoy.isoformat()
+    agrupar = request.args.get('agrupar', 'dia')
+    if agrupar not in analitica.AGRUPACIONES:
+        return jsonify({'error': f"agrupar tiene que ser uno de {', '.join(analitica.AGRUPACIONES)}"}), 400
+    etag = f"analytics-{desde}-{hasta}-{agrupar}-{db.version('citas', 'mensajes', 'config')}"
+    try:
+        return responder_con_etag(etag, lambda: db.consultar_analitica(desde, hasta, agrupar))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/conversaciones', methods=['GET'])
+def api_conversaciones():
+    """Bandeja paginada por cursor: ?limite=30&antes=<siguiente de la página anterior>"""
+    try:
+        limite = min(MAX_CONVERSACIONES_PAGINA, max(1, int(request.args.get('limite', 30))))
+        antes = int(request.args['antes']) if request.args.get('antes') else None
+    except ValueError:
+        return jsonify({'error': 'limite y antes tienen que ser números'}), 400
+    etag = f"conversaciones-{antes}-{limite}-{db.version('mensajes')}"
+    return responder_con_etag(etag, lambda: db.listar_conversaciones(limite, antes))
+
+@app.route('/api/conversaciones/<cliente_id>/leido', methods=['POST'])
+def api_conversacion_leida(cliente_id):
+    return jsonify({'success': True, 'cambio': db.marcar_conversacion_leida(cliente_id)})
+
+@app.route('/api/mensajes/search', methods=['GET'])
+def api_buscar_mensajes():
+    """?q=barba&cliente=595981...&desde=2025-12-01&hasta=2025-12-31&pagina=1&limite=20"""
+    texto = request.args.get('q', '').strip()
+    if not texto:
+        return jsonify({'error': 'Falta el parámetro q'}), 400
+    try:
+        pagina = max(1, int(request.args.get('pagina', 1)))
+        limite = min(MAX_RESULTADOS_BUSQUEDA, max(1, int(request.args.get('limite', 20))))
+    except ValueError:
+        return jsonify({'error': 'pagina y limite tienen que ser números'}), 400
+    with medir('busqueda_mensajes'):
+        resultado = db.buscar_mensajes(texto, cliente=request.args.get('cliente') or None,
+                                       desde=request.args.get('desde') or None,
+                                       hasta=request.args.get('hasta') or None,
+                                       limite=limite, pagina=pagina)
+    return jsonify(resultado)
 
 @app.route('/api/citas', methods=['GET', 'POST'])
 def api_citas():
@@ -638,21 +980,112 @@ def api_citas():
         )
         return jsonify({'success': True, 'id': cita_id})
     fecha = request.args.get('fecha', '')
+    etag = f"citas-{fecha or 'todas'}-{db.version('citas')}"
     if fecha:
-        citas = db.obtener_citas_por_fecha(fecha)
-    else:
-        citas = db.obtener_todas_las_citas()
-    return jsonify(citas)
+        return responder_con_etag(etag, lambda: db.obtener_citas_por_fecha(fecha))
+    return responder_con_etag(etag, db.obtener_todas_las_citas)
 
 @app.route('/api/citas/<int:cita_id>', methods=['DELETE'])
 def eliminar_cita_api(cita_id):
     db.eliminar_cita(cita_id)
     return jsonify({'success': True})
 
+@app.route('/api/lista_espera', methods=['GET', 'POST'])
+def api_lista_espera():
+    """GET ?fecha=2025-12-24 (activos); POST {telefono, fecha, hora_desde, hora_hasta, nombre, servicio}"""
+    if request.method == 'POST':
+        data = request.json or {}
+        if not (data.get('telefono') and data.get('fecha') and data.get('hora_desde')):
+            return jsonify({'error': 'Faltan telefono, fecha u hora_desde'}), 400
+        nuevo = lista_espera.anotar(data['telefono'], data['fecha'], data['hora_desde'], data.get('hora_hasta'),
+                                    nombre=data.get('nombre'), servicio=data.get('servicio'), origen='panel')
+        return jsonify({'success': True, 'nuevo': nuevo})
+    return jsonify(lista_espera.listar(request.args.get('fecha') or None))
+
 @app.route('/api/citas_hoy', methods=['GET'])
 def citas_hoy():
     hoy = datetime.date.today().isoformat()
-    return jsonify(db.obtener_citas_por_fecha(hoy))
+    etag = f"citas-{hoy}-{db.version('citas')}"
+    return responder_con_etag(etag, lambda: db.obtener_citas_por_fecha(hoy))
+
+# === FEED EN VIVO PARA EL PANEL (SSE) ===
+@app.route('/api/events', methods=['GET'])
+def api_events():
+    """Empuja cambios (citas, config, mensajes) en vez de que el panel haga polling"""
+    response = Response(stream_with_context(bus.escuchar()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Evita que nginx/proxies acumulen el stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# === WORKERS DE GUNICORN ===
+# Con varios procesos el bus es local: el puente avisa 'resync' si otro worker cambió algo
+puente_eventos = PuenteEventos(db, bus) if db.estado is not None else None
+
+# === LISTA DE ESPERA ===
+def soltar_sesion(cliente):
+    """Historial escrito fuera del fragmento dueño del cliente: que suelte su sesión cacheada"""
+    if enrutador is not None:
+        enrutador.soltar(cliente)
+
+# Escucha cita_eliminada en cada proceso y ofrece el turno por el mismo envío del bot
+lista_espera = ListaEspera(db, bus, enviar_mensaje_wasender, soltar_sesion)
+
+# === TAREAS DE FONDO (RECORDATORIOS, BARRIDO DE SESIONES, RESPALDOS) ===
+# Una sola instancia por despliegue: las arranca app.run o el master de gunicorn (when_ready)
+recordatorios = (Recordatorios(db, bus, armar_envio_wasender, WASENDER_URL, soltar_sesion=soltar_sesion)
+                 if RECORDATORIOS else None)
+barrido_sesiones = BarridoSesiones(db)
+respaldos = Respaldos(db) if RESPALDOS else None
+
+def iniciar_tareas_fondo():
+    # Una tarea que no arranca (config inválida, disco) no frena a las demás
+    for tarea in (barrido_sesiones, recordatorios, respaldos):
+        if tarea is None:
+            continue
+        try:
+            tarea.iniciar()
+        except Exception as e:
+            log.exception(f"❌ No arrancó {type(tarea).__name__}: {e}")
+
+def detener_tareas_fondo():
+    for tarea in (barrido_sesiones, recordatorios, respaldos):
+        if tarea is not None:
+            tarea.detener()
+
+def ejecutar_tareas_fondo():
+    """Proceso de tareas de fondo bajo gunicorn: sus hilos no pueden vivir en el master, que forkea
+    workers en cualquier momento (un hijo heredaría locks tomados)"""
+    master = os.getppid()
+    iniciar_tareas_fondo()
+    log.info(f"⏰ Tareas de fondo en el proceso {os.getpid()}")
+    try:
+        # Si el master muere sin avisar, no quedamos huérfanos
+        while os.getppid() == master:
+            time.sleep(5)
+    finally:
+        detener_tareas_fondo()
+
+def iniciar_worker():
+    """post_fork de gunicorn: los hilos no sobreviven al fork, se arrancan en cada worker"""
+    if puente_eventos is not None:
+        puente_eventos.iniciar()
+    log.info(f"👷 Worker {os.getpid()} listo")
+
+# === PERFILADOR OPCIONAL (PROFILING=1) ===
+perfilador.instalar(app)
+
+# === MÉTRICAS (PROMETHEUS) ===
+registro.medidor('bot_paneles_conectados', 'Paneles escuchando /api/events',
+                 funcion=bus.cantidad_suscriptores)
+registro.medidor('bot_recordatorios_programados', 'Recordatorios esperando en el heap',
+                 funcion=lambda: recordatorios.programados() if recordatorios is not None else 0)
+registro.medidor('bot_respaldo_ultimo_timestamp', 'Epoch del último snapshot de la DB en disco',
+                 funcion=lambda: respaldos.ultimo() if respaldos is not None else 0)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(registro.exponer(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/api/toggle_bot', methods=['POST'])
 def toggle_bot():
@@ -662,29 +1095,30 @@ def toggle_bot():
     return jsonify({'success': True, 'bot_encendido': estado == 'true'})
 
 # === RUTA CATCH-ALL PARA FRONTEND (Debe ir al final) ===
+# Manifiesto en memoria de web/ (precomprimido, con ETag y cache headers)
+estaticos = ManifiestoEstaticos(STATIC_FOLDER)
+
 @app.route('/')
 def serve_root():
-    print(f"🌐 Serving ROOT from {STATIC_FOLDER}")
-    if os.path.exists(os.path.join(STATIC_FOLDER, 'index.html')):
-        return send_from_directory(STATIC_FOLDER, 'index.html')
+    response = estaticos.servir('index.html', request)
+    if response is not None:
+        return response
+    # Debugging directory listing
+    msg = f"❌ Error: index.html not found in {STATIC_FOLDER}\n"
+    msg += f"📂 CWD: {os.getcwd()}\n"
+    if os.path.exists(STATIC_FOLDER):
+        msg += f"📂 Content of {STATIC_FOLDER}: {os.listdir(STATIC_FOLDER)}"
     else:
-        # Debugging directory listing
-        msg = f"❌ Error: index.html not found in {STATIC_FOLDER}\n"
-        msg += f"📂 CWD: {os.getcwd()}\n"
-        if os.path.exists(STATIC_FOLDER):
-            msg += f"📂 Content of {STATIC_FOLDER}: {os.listdir(STATIC_FOLDER)}"
-        else:
-            msg += f"⚠️ Folder {STATIC_FOLDER} does not exist"
-        return msg, 404
+        msg += f"⚠️ Folder {STATIC_FOLDER} does not exist"
+    return msg, 404
 
 @app.route('/<path:path>')
 def serve_static(path):
-    print(f"📂 Requesting static file: {path}")
-    if os.path.exists(os.path.join(STATIC_FOLDER, path)):
-        return send_from_directory(STATIC_FOLDER, path)
-    else:
-        print(f"⚠️ File not found: {path} - Serving index.html (SPA Fallback)")
-        return send_from_directory(STATIC_FOLDER, 'index.html')
+    # Lookup en memoria; si no existe, index.html (SPA Fallback)
+    response = estaticos.servir(path, request)
+    if response is not None:
+        return response
+    return f"❌ Error: index.html not found in {STATIC_FOLDER}", 404
 
 if __name__ == "__main__":
     port = int(os.environ.get('PORT', 5000))
@@ -697,4 +1131,5 @@ if __name__ == "__main__":
     else:
         print("⚠️ CARPETA 'web' NO EXISTE")
 
+    iniciar_tareas_fondo()
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+PRUEBA DE CARGA END-TO-END DEL WEBHOOK
+======================================
+Levanta Groq y WaSender falsos, arranca api_server.py contra una DB temporal
+(nunca agenda_final_2025.db) y reproduce charlas de varios turnos contra
+/wasender/webhook a una tasa objetivo.
+
+Mide:
+- throughput (respuestas/s)
+- latencia de respuesta p50/p95/p99 (POST del webhook -> mensaje recibido en WaSender)
+- latencia HTTP del webhook
+- espera por el lock de SQLite (leída de /metrics)
+
+El guion de cada cliente tiene más turnos seguidos que la ráfaga del token
+bucket de producción (admision.py): antes de cargar se suben los límites por
+remitente (--rafaga, --tokens-minuto) para medir el bot y no al limitador.
+--admision-produccion deja los de producción.
+
+Ejemplos:
+  python benchmarks/carga_webhook.py --tasa 5 --duracion 60
+  python benchmarks/carga_webhook.py --tasa 20 --groq-ms 900 --groq-error 0.05 --comparar benchmarks/resultados/carga-abc123.json
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from comun import (RAIZ_REPO, resumen, guardar_resultado, comparar, parsear_metricas,
+                   cuantil_histograma, suma_y_cantidad)
+from servicios_falsos import Distribucion, GroqFalso, WaSenderFalso
+
+NOMBRES = ['Lucas', 'Mati', 'Thiago', 'Kevin', 'Joaquin', 'Brian', 'Santi', 'Ian', 'Erick', 'Noa']
+HORAS = [f"{h:02d}:00" for h in range(9, 20) if h != 12]
+GUION = ["hola", "quiero un corte", "soy {nombre}", "para el {fecha} a las {hora}", "si, confirmo"]
+
+
+def _fechas_habiles(dias=5):
+    ahora = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=4)
+    fechas = []
+    for i in range(1, dias + 1):
+        f = ahora + datetime.timedelta(days=i)
+        if f.weekday() != 6:
+            fechas.append(f.strftime('%Y-%m-%d'))
+    return fechas
+
+
+class Conversacion:
+    """Un cliente que escribe un turno, espera la respuesta y sigue"""
+
+    def __init__(self, numero, fechas):
+        self.jid = f"5959{numero:08d}@s.whatsapp.net"
+        self.nombre = random.choice(NOMBRES)
+        fecha = random.choice(fechas)
+        hora = random.choice(HORAS)
+        self.guion = [t.format(nombre=self.nombre, fecha=fecha, hora=hora) for t in GUION]
+        self.turno = 0
+        self.enviado_en = None
+
+    @property
+    def terminada(self):
+        return self.turno >= len(self.guion)
+
+    def payload(self):
+        # Misma forma que manda WaSender (Caso 2 del webhook)
+        return {
+            'event': 'messages.upsert',
+            'data': {'messages': {
+                'key': {'id': uuid.uuid4().hex[:20].upper(), 'remoteJid': self.jid, 'fromMe': False},
+                'pushName': self.nombre,
+                'messageTimestamp': int(time.time()),
+                'message': {'conversation': self.guion[self.turno]},
+            }},
+        }
+
+
+class GeneradorCarga:
+    def __init__(self, url_webhook, tasa, duracion, concurrencia, timeout):
+        self.url_webhook = url_webhook
+        self.tasa = tasa
+        self.duracion = duracion
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=concurrencia)
+        self.sesion_http = requests.Session()
+        self.fechas = _fechas_habiles()
+
+        self._lock = threading.Lock()
+        self._libres = collections.deque()
+        self._esperando = {}  # jid -> Conversacion
+        self._contador = 0
+
+        self.latencias_respuesta = []
+        self.latencias_http = []
+        self.enviados = 0
+        self.errores_http = 0
+        self.timeouts = 0
+        self.respuestas_extra = 0
+        self.conversaciones_completas = 0
+
+    def al_recibir(self, to, texto, instante):
+        """Callback del WaSender falso"""
+        with self._lock:
+            conv = self._esperando.pop(to, None)
+            if conv is None:
+                self.respuestas_extra += 1
+                return
+            self.latencias_respuesta.append(instante - conv.enviado_en)
+            conv.turno += 1
+            if conv.terminada:
+                self.conversaciones_completas += 1
+            else:
+                self._libres.append(conv)
+
+    def _siguiente_conversacion(self):
+        with self._lock:
+            if self._libres:
+                return self._libres.popleft()
+            self._contador += 1
+            return Conversacion(self._contador, self.fechas)
+
+    def _enviar(self, conv):
+        inicio = time.perf_counter()
+        try:
+            r = self.sesion_http.post(self.url_webhook, json=conv.payload(), timeout=self.timeout)
+            ok = r.status_code == 200
+        except requests.RequestException:
+            ok = False
+        with self._lock:
+            self.latencias_http.append(time.perf_counter() - inicio)
+            if not ok:
+                self.errores_http += 1
+
+    def _vencer_esperas(self):
+        ahora = time.perf_counter()
+        with self._lock:
+            vencidas = [j for j, c in self._esperando.items() if ahora - c.enviado_en > self.timeout]
+            for jid in vencidas:
+                del self._esperando[jid]
+                self.timeouts += 1
+
+    def correr(self):
+        intervalo = 1.0 / self.tasa
+        inicio = time.perf_counter()
+        proximo = inicio
+        while time.perf_counter() - inicio < self.duracion:
+            conv = self._siguiente_conversacion()
+            with self._lock:
+                conv.enviado_en = time.perf_counter()
+                self._esperando[conv.jid] = conv
+                self.enviados += 1
+            self.pool.submit(self._enviar, conv)
+
+            proximo += intervalo
+            espera = proximo - time.perf_counter()
+            if espera > 0:
+                time.sleep(espera)
+            self._vencer_esperas()
+        self.segundos_carga = time.perf_counter() - inicio
+
+        # Drenar: esperamos las respuestas pendientes hasta el timeout
+        limite = time.perf_counter() + self.timeout
+        while self._esperando and time.perf_counter() < limite:
+            time.sleep(0.1)
+        self._vencer_esperas()
+        self.pool.shutdown(wait=True)
+        self.segundos_total = time.perf_counter() - inicio
+
+
+def _puerto_libre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def arrancar_servidor(groq, wasender, args, carpeta_tmp):
+    puerto = _puerto_libre()
+    env = dict(os.environ)
+    env.update({
+        'PORT': str(puerto),
+        'DB_PATH': os.path.join(carpeta_tmp, 'carga.db'),
+        'GROQ_API_KEY': 'clave-falsa-1',
+        'GROQ_API_KEY_2': 'clave-falsa-2',
+        'GROQ_BASE_URL': groq.url,
+        'WASENDER_URL': wasender.url,
+        'LOG_LEVEL': args.log_level,
+    })
+    if args.throttle is not None:
+        env['WASENDER_THROTTLE_SEG'] = str(args.throttle)
+    log_servidor = open(os.path.join(carpeta_tmp, 'servidor.log'), 'w')
+    proceso = subprocess.Popen([sys.executable, 'api_server.py'], cwd=RAIZ_REPO, env=env,
+                               stdout=log_servidor, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{puerto}"
+    for _ in range(100):
+        try:
+            requests.get(f"{url}/metrics", timeout=1)
+            return proceso, url
+        except requests.RequestException:
+            if proceso.poll() is not None:
+                break
+            time.sleep(0.2)
+    proceso.terminate()
+    raise RuntimeError(f"api_server no arrancó (ver {log_servidor.name})")
+
+
+def configurar_admision(url, args):
+    """Límites por remitente que dejan pasar el guion completo (se leen de config en caliente)"""
+    r = requests.post(f"{url}/api/config", timeout=5, json={
+        'admision_rafaga': max(args.rafaga, len(GUION)),
+        'admision_tokens_minuto': args.tokens_minuto,
+    })
+    r.raise_for_status()
+
+
+def metricas_servidor(url):
+    try:
+        muestras = parsear_metricas(requests.get(f"{url}/metrics", timeout=5).text)
+    except requests.RequestException:
+        return {}
+    suma, cantidad = suma_y_cantidad(muestras, 'bot_db_espera_lock_segundos')
+    suma_llm, cantidad_llm = suma_y_cantidad(muestras, 'bot_llm_segundos')
+    res = {
+        'db_espera_lock_ms': {
+            'n': int(cantidad),
+            'media': round(suma / cantidad * 1000, 3) if cantidad else None,
+            'p95': _ms(cuantil_histograma(muestras, 'bot_db_espera_lock_segundos', 0.95)),
+            'p99': _ms(cuantil_histograma(muestras, 'bot_db_espera_lock_segundos', 0.99)),
+        },
+        'llm_ms': {
+            'n': int(cantidad_llm),
+            'media': round(suma_llm / cantidad_llm * 1000, 3) if cantidad_llm else None,
+            'p95': _ms(cuantil_histograma(muestras, 'bot_llm_segundos', 0.95)),
+        },
+        'etapas_p95_ms': {},
+    }
+    etapas = sorted({e.get('etapa') for n, e, _ in muestras if n == 'bot_etapa_segundos_count'})
+    for etapa in etapas:
+        res['etapas_p95_ms'][etapa] = _ms(cuantil_histograma(muestras, 'bot_etapa_segundos', 0.95, {'etapa': etapa}))
+    return res
+
+
+def _ms(segundos):
+    return None if segundos is None else round(segundos * 1000, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga del webhook con Groq/WaSender falsos")
+    parser.add_argument('--tasa', type=float, default=5, help="turnos por segundo")
+    parser.add_argument('--duracion', type=float, default=30, help="segundos de carga")
+    parser.add_argument('--concurrencia', type=int, default=64, help="requests HTTP simultáneos máximos")
+    parser.add_argument('--timeout', type=float, default=30, help="segundos máximos esperando respuesta")
+    parser.add_argument('--groq-ms', type=float, default=600)
+    parser.add_argument('--groq-sigma', type=float, default=0.4)
+    parser.add_argument('--groq-error', type=float, default=0.0)
+    parser.add_argument('--groq-429', type=float, default=0.0)
+    parser.add_argument('--wasender-ms', type=float, default=150)
+    parser.add_argument('--wasender-sigma', type=float, default=0.3)
+    parser.add_argument('--wasender-error', type=float, default=0.0)
+    parser.add_argument('--throttle', type=float, default=None,
+                        help="WASENDER_THROTTLE_SEG del servidor (por defecto el de producción)")
+    parser.add_argument('--rafaga', type=float, default=10,
+                        help="admision_rafaga durante la carga (mínimo: los turnos del guion)")
+    parser.add_argument('--tokens-minuto', type=float, default=600, help="admision_tokens_minuto durante la carga")
+    parser.add_argument('--admision-produccion', action='store_true',
+                        help="no tocar la admisión (con el guion de 5 turnos el último queda limitado)")
+    parser.add_argument('--url', default=None,
+                        help="usar un servidor ya levantado (debe apuntar a los falsos)")
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--salida', default=None, help="ruta del JSON de resultados")
+    parser.add_argument('--comparar', default=None, help="JSON de una corrida anterior")
+    args = parser.parse_args()
+
+    generador = None
+    wasender = WaSenderFalso(Distribucion(args.wasender_ms, args.wasender_sigma, args.wasender_error),
+                             al_recibir=lambda *a: generador.al_recibir(*a))
+    groq = GroqFalso(Distribucion(args.groq_ms, args.groq_sigma, args.groq_error, args.groq_429))
+    groq.iniciar()
+    wasender.iniciar()
+
+    proceso = None
+    with tempfile.TemporaryDirectory(prefix='carga_bot_') as carpeta_tmp:
+        try:
+            if args.url:
+                url = args.url.rstrip('/')
+            else:
+                proceso, url = arrancar_servidor(groq, wasender, args, carpeta_tmp)
+            if not args.admision_produccion:
+                configurar_admision(url, args)
+            print(f"▶️  Carga: {args.tasa} turnos/s durante {args.duracion}s contra {url}")
+
+            generador = GeneradorCarga(f"{url}/wasender/webhook", args.tasa, args.duracion,
+                                       args.concurrencia, args.timeout)
+            generador.correr()
+            servidor = metricas_servidor(url)
+        finally:
+            if proceso:
+                proceso.terminate()
+                proceso.wait(timeout=10)
+            groq.detener()
+            wasender.detener()
+
+    respuestas = len(generador.latencias_respuesta)
+    resultado = {
+        'tipo': 'carga_webhook',
+        'parametros': {k: v for k, v in vars(args).items() if k not in ('salida', 'comparar', 'url')},
+        'totales': {
+            'turnos_enviados': generador.enviados,
+            'respuestas': respuestas,
+            'conversaciones_completas': generador.conversaciones_completas,
+            'timeouts': generador.timeouts,
+            'errores_http': generador.errores_http,
+            'respuestas_extra': generador.respuestas_extra,
+            'throughput_rps': round(respuestas / generador.segundos_total, 3),
+        },
+        'latencia_respuesta_ms': resumen(generador.latencias_respuesta),
+        'latencia_http_ms': resumen(generador.latencias_http),
+        'servidor': servidor,
+        'groq_status': groq.conteo_status,
+        'wasender_status': wasender.conteo_status,
+    }
+    ruta = guardar_resultado('carga', resultado, args.salida)
+    print(json.dumps({k: resultado[k] for k in ('totales', 'latencia_respuesta_ms', 'latencia_http_ms')},
+                     indent=2, ensure_ascii=False))
+    print(f"💾 Resultado: {ruta}")
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            base = json.load(f)
+        comparar(base, resultado, ['totales', 'latencia_respuesta_ms', 'latencia_http_ms', 'servidor'])
+
+
+if __name__ == '__main__':
+    main()
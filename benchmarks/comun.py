@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+UTILIDADES COMPARTIDAS DE BENCHMARKS
+====================================
+Percentiles, lectura de /metrics y guardado de resultados comparables entre commits.
+"""
+
+import datetime
+import json
+import math
+import os
+import platform
+import re
+import subprocess
+import sys
+
+RAIZ_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CARPETA_RESULTADOS = os.path.join(RAIZ_REPO, 'benchmarks', 'resultados')
+
+# Para poder importar database.py / api_server.py desde benchmarks/
+if RAIZ_REPO not in sys.path:
+    sys.path.insert(0, RAIZ_REPO)
+
+
+def percentil(valores, p):
+    """Percentil por rango más cercano (valores sin ordenar)"""
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    k = max(0, math.ceil(p / 100 * len(ordenados)) - 1)
+    return ordenados[k]
+
+
+def resumen(valores, escala=1000.0):
+    """p50/p95/p99/media/max en ms (los valores vienen en segundos)"""
+    if not valores:
+        return {'n': 0}
+    return {
+        'n': len(valores),
+        'p50': round(percentil(valores, 50) * escala, 3),
+        'p95': round(percentil(valores, 95) * escala, 3),
+        'p99': round(percentil(valores, 99) * escala, 3),
+        'media': round(sum(valores) / len(valores) * escala, 3),
+        'max': round(max(valores) * escala, 3),
+    }
+
+
+def commit_actual():
+    try:
+        sha = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=RAIZ_REPO,
+                                      stderr=subprocess.DEVNULL).decode().strip()
+        sucio = subprocess.call(['git', 'diff', '--quiet'], cwd=RAIZ_REPO, stderr=subprocess.DEVNULL) != 0
+        return sha + ('-dirty' if sucio else '')
+    except Exception:
+        return 'desconocido'
+
+
+def entorno():
+    return {
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def guardar_resultado(nombre, resultado, salida=None):
+    """Escribe el JSON del resultado. Por defecto benchmarks/resultados/<nombre>-<commit>.json"""
+    resultado = dict(resultado)
+    resultado.setdefault('commit', commit_actual())
+    resultado.setdefault('fecha', datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'))
+    resultado.setdefault('entorno', entorno())
+
+    if not salida:
+        os.makedirs(CARPETA_RESULTADOS, exist_ok=True)
+        salida = os.path.join(CARPETA_RESULTADOS, f"{nombre}-{resultado['commit']}.json")
+    with open(salida, 'w', encoding='utf-8') as f:
+        json.dump(resultado, f, indent=2, ensure_ascii=False)
+    return salida
+
+
+def _aplanar(datos, prefijo=''):
+    plano = {}
+    for clave, valor in datos.items():
+        ruta = f"{prefijo}{clave}"
+        if isinstance(valor, dict):
+            plano.update(_aplanar(valor, ruta + '.'))
+        elif isinstance(valor, (int, float)) and not isinstance(valor, bool):
+            plano[ruta] = valor
+    return plano
+
+
+def comparar(base, actual, secciones):
+    """Imprime las métricas numéricas de 'secciones' lado a lado con su variación"""
+    plano_base = _aplanar({k: base.get(k, {}) for k in secciones})
+    plano_actual = _aplanar({k: actual.get(k, {}) for k in secciones})
+    print(f"\n{'métrica':<55} {base.get('commit', 'base'):>14} {actual.get('commit', 'actual'):>14} {'Δ%':>8}")
+    for clave in sorted(set(plano_base) | set(plano_actual)):
+        a, b = plano_base.get(clave), plano_actual.get(clave)
+        if a is None or b is None:
+            delta = ''
+        elif a == 0:
+            delta = '' if b == 0 else '+inf'
+        else:
+            delta = f"{(b - a) / a * 100:+.1f}"
+        print(f"{clave:<55} {str(a):>14} {str(b):>14} {delta:>8}")
+
+
+# === LECTURA DE /metrics (FORMATO PROMETHEUS) ===
+_LINEA = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[^}]*\})?\s+(\S+)$')
+_ETIQUETA = re.compile(r'(\w+)="([^"]*)"')
+
+
+def parsear_metricas(texto):
+    """Devuelve lista de (nombre, {etiquetas}, valor)"""
+    muestras = []
+    for linea in texto.splitlines():
+        if not linea or linea.startswith('#'):
+            continue
+        m = _LINEA.match(linea)
+        if not m:
+            continue
+        etiquetas = dict(_ETIQUETA.findall(m.group(2) or ''))
+        muestras.append((m.group(1), etiquetas, float(m.group(3))))
+    return muestras
+
+
+def cuantil_histograma(muestras, nombre, q, filtro=None):
+    """Como histogram_quantile de Prometheus, sumando todas las series que pasan el filtro"""
+    buckets = {}
+    for metrica, etiquetas, valor in muestras:
+        if metrica != f"{nombre}_bucket":
+            continue
+        if filtro and any(etiquetas.get(k) != v for k, v in filtro.items()):
+            continue
+        le = float('inf') if etiquetas['le'] == '+Inf' else float(etiquetas['le'])
+        buckets[le] = buckets.get(le, 0) + valor
+    if not buckets:
+        return None
+    limites = sorted(buckets)
+    total = buckets[limites[-1]]
+    if total == 0:
+        return None
+    objetivo = q * total
+    anterior_limite, anterior_conteo = 0.0, 0.0
+    for limite in limites:
+        conteo = buckets[limite]
+        if conteo >= objetivo:
+            if math.isinf(limite):
+                return anterior_limite
+            if conteo == anterior_conteo:
+                return limite
+            return anterior_limite + (limite - anterior_limite) * (objetivo - anterior_conteo) / (conteo - anterior_conteo)
+        anterior_limite, anterior_conteo = limite, conteo
+    return limites[-1]
+
+
+def suma_y_cantidad(muestras, nombre, filtro=None):
+    suma = cantidad = 0.0
+    for metrica, etiquetas, valor in muestras:
+        if filtro and any(etiquetas.get(k) != v for k, v in filtro.items()):
+            continue
+        if metrica == f"{nombre}_sum":
+            suma += valor
+        elif metrica == f"{nombre}_count":
+            cantidad += valor
+    return suma, cantidad
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+MICROBENCHMARKS DE LAS PRIMITIVAS POR TURNO
+===========================================
+Genera una DB sintética en un directorio temporal (nunca agenda_final_2025.db)
+y mide:
+- database.Database: get_session, save_session_state, obtener_citas_por_fecha,
+  agregar_cita con contención entre hilos
+- api_server: obtener_estado_agenda, normalizar_hora_str, procesar_memoria_ia, procesar_cita,
+  salida_llm.interpretar (salida sucia)
+
+Ejemplos:
+  python benchmarks/micro_db.py --mensajes 10000
+  python benchmarks/micro_db.py --mensajes 1000000 --cache /tmp/bench_dbs
+  python benchmarks/micro_db.py --mensajes 10000000 --cache /tmp/bench_dbs --comparar benchmarks/resultados/micro-abc123.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from comun import resumen, guardar_resultado, comparar
+
+LOTE_INSERT = 50000
+
+
+def generar_db(ruta, mensajes, clientes, citas, semilla=42):
+    """Llena la DB con historial, sesiones y citas sintéticas (inserción por lotes)"""
+    from database import Database
+
+    Database(db_path=ruta)  # crea el esquema
+    rnd = random.Random(semilla)
+    conn = sqlite3.connect(ruta)
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA journal_mode = MEMORY")
+    ids_clientes = [f"5959{n:08d}@s.whatsapp.net" for n in range(clientes)]
+    inicio = datetime.datetime(2025, 1, 1)
+
+    restantes = mensajes
+    while restantes > 0:
+        lote = min(LOTE_INSERT, restantes)
+        filas = []
+        for _ in range(lote):
+            ts = inicio + datetime.timedelta(seconds=rnd.randrange(365 * 86400))
+            filas.append((rnd.choice(ids_clientes), "mensaje sintético " * rnd.randint(1, 6),
+                          rnd.randint(0, 1), ts.strftime('%Y-%m-%d %H:%M:%S')))
+        conn.executemany("INSERT INTO mensajes (cliente_nombre, contenido, es_bot, timestamp) VALUES (?, ?, ?, ?)", filas)
+        conn.commit()
+        restantes -= lote
+
+    estado = json.dumps({'nombre': 'Cliente', 'servicio': 'Corte', 'fecha_intencion': '2025-06-01'})
+    conn.executemany("INSERT OR REPLACE INTO sesiones_bot (cliente_id, estado_json) VALUES (?, ?)",
+                     [(c, estado) for c in ids_clientes])
+
+    horas = [f"{h:02d}:00" for h in range(9, 20) if h != 12]
+    slots = set()
+    while len(slots) < citas:
+        dia = inicio + datetime.timedelta(days=rnd.randrange(365))
+        slots.add((dia.strftime('%Y-%m-%d'), rnd.choice(horas)))
+    conn.executemany("INSERT INTO citas (cliente, telefono, fecha, hora, servicio) VALUES (?, ?, ?, ?, ?)",
+                     [("Sintético", rnd.choice(ids_clientes), f, h, "Corte") for f, h in slots])
+    conn.commit()
+    conn.close()
+    return ids_clientes
+
+
+def cronometrar_llamadas(funcion, repeticiones):
+    tiempos = []
+    for i in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion(i)
+        tiempos.append(time.perf_counter() - inicio)
+    return _resultado(tiempos)
+
+
+def _resultado(tiempos):
+    datos = resumen(tiempos, escala=1e6)  # microsegundos
+    total = sum(tiempos)
+    datos['ops_seg'] = round(len(tiempos) / total, 1) if total else None
+    return datos
+
+
+def bench_agregar_cita_contencion(db, hilos, intentos_por_hilo, slots):
+    """Varios hilos reservando el mismo puñado de horarios: mide espera y conflictos"""
+    tiempos = []
+    exitos = [0]
+    lock = threading.Lock()
+    barrera = threading.Barrier(hilos)
+
+    def trabajador(n):
+        locales = []
+        ok = 0
+        barrera.wait()
+        for i in range(intentos_por_hilo):
+            fecha, hora = slots[(n + i) % len(slots)]
+            inicio = time.perf_counter()
+            if db.agregar_cita(fecha, hora, f"Hilo {n}", "0", "Corte"):
+                ok += 1
+            locales.append(time.perf_counter() - inicio)
+        with lock:
+            tiempos.extend(locales)
+            exitos[0] += ok
+
+    ts = [threading.Thread(target=trabajador, args=(n,)) for n in range(hilos)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    datos = _resultado(tiempos)
+    datos['hilos'] = hilos
+    datos['reservas_ok'] = exitos[0]
+    datos['conflictos'] = len(tiempos) - exitos[0]
+    return datos
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks de Database y helpers de parsing")
+    parser.add_argument('--mensajes', type=int, default=10000, help="filas en mensajes (10k a 10M)")
+    parser.add_argument('--clientes', type=int, default=None, help="clientes distintos (default mensajes/20)")
+    parser.add_argument('--citas', type=int, default=2000)
+    parser.add_argument('--repeticiones', type=int, default=2000)
+    parser.add_argument('--hilos', type=int, default=8, help="hilos para agregar_cita con contención")
+    parser.add_argument('--cache', default=None,
+                        help="carpeta donde guardar/reusar las DB generadas (generar 10M tarda)")
+    parser.add_argument('--semilla', type=int, default=42)
+    parser.add_argument('--salida', default=None)
+    parser.add_argument('--comparar', default=None)
+    args = parser.parse_args()
+
+    clientes = args.clientes or max(10, args.mensajes // 20)
+    citas = min(args.citas, 365 * 10)
+    carpeta_tmp = tempfile.mkdtemp(prefix='micro_bot_')
+    ruta = os.path.join(carpeta_tmp, 'micro.db')
+
+    # La instancia global de database.py (y api_server) debe apuntar a la DB sintética
+    # ANTES del primer import, si no se crearía agenda_final_2025.db en el cwd
+    os.environ['DB_PATH'] = ruta
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+    nombre_cache = f"micro-{args.mensajes}-{clientes}-{citas}-{args.semilla}.db"
+    inicio_gen = time.perf_counter()
+    if args.cache and os.path.exists(os.path.join(args.cache, nombre_cache)):
+        shutil.copy(os.path.join(args.cache, nombre_cache), ruta)
+        ids_clientes = [f"5959{n:08d}@s.whatsapp.net" for n in range(clientes)]
+        print(f"♻️  DB reusada de {args.cache}")
+    else:
+        print(f"🏗️  Generando DB: {args.mensajes} mensajes, {clientes} clientes, {citas} citas...")
+        ids_clientes = generar_db(ruta, args.mensajes, clientes, citas, args.semilla)
+        if args.cache:
+            os.makedirs(args.cache, exist_ok=True)
+            shutil.copy(ruta, os.path.join(args.cache, nombre_cache))
+    segundos_generacion = time.perf_counter() - inicio_gen
+
+    from database import Database
+    import api_server
+
+    db = Database(db_path=ruta)
+    rnd = random.Random(args.semilla)
+    n = args.repeticiones
+    resultados = {}
+
+    try:
+        print("⏱️  Database...")
+        resultados['get_session'] = cronometrar_llamadas(
+            lambda i: db.get_session(rnd.choice(ids_clientes)), n)
+        estado = {'nombre': 'Ana', 'servicio': 'Corte', 'fecha_intencion': '2025-06-01', 'hora_intencion': '17:00'}
+        resultados['save_session_state'] = cronometrar_llamadas(
+            lambda i: db.save_session_state(rnd.choice(ids_clientes), estado), n)
+        fechas = [(datetime.date(2025, 1, 1) + datetime.timedelta(days=d)).isoformat() for d in range(365)]
+        resultados['obtener_citas_por_fecha'] = cronometrar_llamadas(
+            lambda i: db.obtener_citas_por_fecha(rnd.choice(fechas)), n)
+
+        # Contención: fechas futuras sin citas para que haya éxitos y conflictos reales
+        slots = [(f"2030-01-{d:02d}", f"{h:02d}:00") for d in range(1, 8) for h in (9, 10, 11)]
+        resultados['agregar_cita_contencion'] = bench_agregar_cita_contencion(
+            db, args.hilos, max(1, n // (args.hilos * 4)), slots)
+
+        print("⏱️  api_server...")
+        resultados['obtener_estado_agenda'] = cronometrar_llamadas(
+            lambda i: api_server.obtener_estado_agenda(5), max(1, n // 10))
+        horas = ['5', '17', '5:00', '10hs', '7pm', '19:30', '12', 'x']
+        resultados['normalizar_hora_str'] = cronometrar_llamadas(
+            lambda i: api_server.normalizar_hora_str(horas[i % len(horas)]), n * 10)
+        respuesta = ('{"respuesta": "Perfecto Ana, te anoto.", "memoria": {"nombre": "Ana", "fecha": "2025-06-01", '
+                     '"hora": "5", "servicio": "Corte"}, "cita": null}')
+        resultados['procesar_memoria_ia'] = cronometrar_llamadas(
+            lambda i: api_server.procesar_memoria_ia(respuesta, {}), n)
+        # Salida sucia (comillas simples, coma colgando, cortada por max_tokens): camino de reparación
+        sucia = "```json\n{'respuesta': 'Perfecto Ana', 'memoria': {'nombre': 'Ana', 'hora': '17:00',}, 'cita': nu"
+        resultados['interpretar_salida_sucia'] = cronometrar_llamadas(
+            lambda i: api_server.salida_llm.interpretar(sucia), n)
+        # Cada llamada reserva un horario nuevo (camino de éxito con escritura real)
+        base = datetime.date(2031, 1, 1)
+        resultados['procesar_cita'] = cronometrar_llamadas(
+            lambda i: api_server.procesar_cita(
+                {'nombre': 'Ana', 'servicio': 'Corte', 'fecha': str(base + datetime.timedelta(days=i // 10)),
+                 'hora': f"{9 + i % 10:02d}:00"}, "595900000000"), n)
+    finally:
+        shutil.rmtree(carpeta_tmp, ignore_errors=True)
+
+    resultado = {
+        'tipo': 'micro_db',
+        'parametros': {'mensajes': args.mensajes, 'clientes': clientes, 'citas': citas,
+                       'repeticiones': n, 'hilos': args.hilos, 'semilla': args.semilla},
+        'generacion_seg': round(segundos_generacion, 2),
+        'resultados_us': resultados,
+    }
+    ruta_salida = guardar_resultado('micro', resultado, args.salida)
+
+    print(f"\n{'primitiva':<28} {'p50 µs':>10} {'p95 µs':>10} {'p99 µs':>10} {'ops/s':>10}")
+    for nombre, datos in resultados.items():
+        print(f"{nombre:<28} {datos['p50']:>10} {datos['p95']:>10} {datos['p99']:>10} {datos['ops_seg']:>10}")
+    print(f"💾 Resultado: {ruta_salida}")
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            base = json.load(f)
+        comparar(base, resultado, ['resultados_us'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+GROQ Y WASENDER FALSOS (PARA PRUEBAS DE CARGA)
+==============================================
+Servidores HTTP locales que imitan:
+- Groq:     POST /openai/v1/chat/completions  (formato OpenAI, lo que usa el SDK)
+- WaSender: POST /api/send-message
+
+Latencia log-normal configurable (mediana + dispersión), tasa de errores 5xx y de 429.
+El Groq falso "entiende" la charla lo justo para que el bot llegue a reservar.
+
+Uso suelto (para apuntar un api_server a mano):
+  python benchmarks/servicios_falsos.py --groq-ms 600 --wasender-ms 150
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Distribucion:
+    """Latencia log-normal + probabilidad de error"""
+
+    def __init__(self, mediana_ms=0.0, sigma=0.0, tasa_error=0.0, tasa_429=0.0):
+        self.mediana_ms = mediana_ms
+        self.sigma = sigma
+        self.tasa_error = tasa_error
+        self.tasa_429 = tasa_429
+
+    def latencia(self):
+        if self.mediana_ms <= 0:
+            return 0.0
+        return self.mediana_ms * math.exp(self.sigma * random.gauss(0, 1)) / 1000.0
+
+    def status(self):
+        r = random.random()
+        if r < self.tasa_429:
+            return 429
+        if r < self.tasa_429 + self.tasa_error:
+            return 500
+        return 200
+
+
+# === GROQ FALSO ===
+def _memoria_del_prompt(system_prompt):
+    """Lee la sección de MEMORIA que arma generar_respuesta_ia"""
+    memoria = {}
+    for campo, clave in (('NOMBRE', 'nombre'), ('FECHA', 'fecha'), ('HORA', 'hora'), ('SERVICIO', 'servicio')):
+        m = re.search(rf'^- {campo}: (.+)$', system_prompt, re.MULTILINE)
+        if m:
+            memoria[clave] = m.group(1).strip()
+    return memoria
+
+
+def respuesta_groq_falsa(mensajes):
+    system_prompt = mensajes[0]['content'] if mensajes and mensajes[0]['role'] == 'system' else ''
+    memoria = _memoria_del_prompt(system_prompt)
+    usuario = [m['content'] for m in mensajes if m['role'] == 'user']
+    ultimo = usuario[-1].lower() if usuario else ''
+
+    for texto in usuario:
+        m = re.search(r'\bsoy (\w+)', texto, re.IGNORECASE)
+        if m:
+            memoria['nombre'] = m.group(1)
+        if 'corte' in texto.lower():
+            memoria['servicio'] = 'Corte'
+        m = re.search(r'(\d{4}-\d{2}-\d{2})', texto)
+        if m:
+            memoria['fecha'] = m.group(1)
+        m = re.search(r'a las (\d{1,2}:\d{2})', texto)
+        if m:
+            memoria['hora'] = m.group(1)
+
+    # Mismo objeto JSON que pide el bot (salida_llm.py)
+    completo = all(memoria.get(k) for k in ('nombre', 'servicio', 'fecha', 'hora'))
+    salida = {'respuesta': "¡Dale! Contame qué te falta para agendarte.", 'memoria': memoria, 'cita': None}
+    if completo and 'confirmo' in ultimo:
+        salida.update(respuesta="¡Listo!", cita=dict(memoria))
+    elif completo:
+        salida['respuesta'] = f"Perfecto {memoria['nombre']}, ¿te confirmo el turno?"
+    return json.dumps(salida, ensure_ascii=False)
+
+
+def _completion(contenido, modelo):
+    tokens_salida = max(1, len(contenido) // 4)
+    return {
+        'id': f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': modelo,
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': contenido},
+            'finish_reason': 'stop',
+        }],
+        'usage': {'prompt_tokens': 800, 'completion_tokens': tokens_salida, 'total_tokens': 800 + tokens_salida},
+    }
+
+
+class _Manejador(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _leer_json(self):
+        largo = int(self.headers.get('Content-Length') or 0)
+        cuerpo = self.rfile.read(largo) if largo else b''
+        return json.loads(cuerpo or b'{}')
+
+    def _responder(self, status, datos):
+        cuerpo = json.dumps(datos).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def do_POST(self):
+        servicio = self.server.servicio
+        datos = self._leer_json()
+        time.sleep(servicio.distribucion.latencia())
+        status = servicio.distribucion.status()
+        servicio.contar(status)
+        if status != 200:
+            self._responder(status, {'error': {'message': 'falla simulada', 'type': 'simulada'}})
+            return
+        self._responder(200, servicio.atender(self.path, datos))
+
+
+class ServicioFalso:
+    def __init__(self, distribucion, puerto=0):
+        self.distribucion = distribucion
+        self.conteo_status = {}
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', puerto), _Manejador)
+        self.httpd.daemon_threads = True
+        self.httpd.servicio = self
+        self.puerto = self.httpd.server_address[1]
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.puerto}"
+
+    def contar(self, status):
+        with self._lock:
+            self.conteo_status[status] = self.conteo_status.get(status, 0) + 1
+
+    def iniciar(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def detener(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class GroqFalso(ServicioFalso):
+    def atender(self, ruta, datos):
+        return _completion(respuesta_groq_falsa(datos.get('messages', [])), datos.get('model', 'falso'))
+
+
+class WaSenderFalso(ServicioFalso):
+    """Registra cada envío y avisa al generador de carga (al_recibir(to, texto, instante))"""
+
+    def __init__(self, distribucion, puerto=0, al_recibir=None):
+        super().__init__(distribucion, puerto)
+        self.al_recibir = al_recibir
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.puerto}/api/send-message"
+
+    def atender(self, ruta, datos):
+        if self.al_recibir:
+            self.al_recibir(datos.get('to', ''), datos.get('text', ''), time.perf_counter())
+        return {'success': True, 'data': {'msgId': uuid.uuid4().hex[:10]}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Groq y WaSender falsos para pruebas locales")
+    parser.add_argument('--groq-puerto', type=int, default=8901)
+    parser.add_argument('--wasender-puerto', type=int, default=8902)
+    parser.add_argument('--groq-ms', type=float, default=600)
+    parser.add_argument('--groq-sigma', type=float, default=0.4)
+    parser.add_argument('--groq-error', type=float, default=0.0)
+    parser.add_argument('--groq-429', type=float, default=0.0)
+    parser.add_argument('--wasender-ms', type=float, default=150)
+    parser.add_argument('--wasender-sigma', type=float, default=0.3)
+    parser.add_argument('--wasender-error', type=float, default=0.0)
+    args = parser.parse_args()
+
+    groq = GroqFalso(Distribucion(args.groq_ms, args.groq_sigma, args.groq_error, args.groq_429),
+                     args.groq_puerto).iniciar()
+    wasender = WaSenderFalso(Distribucion(args.wasender_ms, args.wasender_sigma, args.wasender_error),
+                             args.wasender_puerto).iniciar()
+    print(f"GROQ_BASE_URL={groq.url}")
+    print(f"WASENDER_URL={wasender.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+BITÁCORA (LOGGING ESTRUCTURADO)
+===============================
+- Una línea JSON por evento, con nivel y trace_id del turno
+- El trace_id se asigna en el webhook y viaja por contextvars
+  (generar_respuesta_ia, procesar_cita, enviar_mensaje_wasender lo heredan solos)
+- Los workers solo encolan: un hilo aparte escribe a stdout, nunca bloquea
+- Payloads grandes se muestrean y truncan
+
+Variables de entorno:
+  LOG_LEVEL        DEBUG / INFO / WARNING (default INFO)
+  LOG_SAMPLE_RATE  fracción de payloads crudos que se loguean en DEBUG (default 0.01)
+  LOG_MAX_CHARS    largo máximo de un payload logueado (default 500)
+"""
+
+import atexit
+import contextvars
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import traceback
+import uuid
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0.01'))
+LOG_MAX_CHARS = int(os.environ.get('LOG_MAX_CHARS', '500'))
+# Si la cola se llena (stdout trabado) descartamos en vez de frenar al bot
+LOG_MAX_COLA = 10000
+
+trace_id_actual = contextvars.ContextVar('trace_id', default='-')
+
+_listener = None
+
+
+def nuevo_trace_id():
+    return uuid.uuid4().hex[:16]
+
+
+def iniciar_traza(trace_id=None):
+    """Asigna un trace_id al contexto actual. Devuelve el token para cerrar_traza"""
+    return trace_id_actual.set(trace_id or nuevo_trace_id())
+
+
+def cerrar_traza(token):
+    trace_id_actual.reset(token)
+
+
+def truncar(valor, limite=None):
+    """Representación acotada de un payload para no inundar los logs"""
+    limite = limite or LOG_MAX_CHARS
+    texto = valor if isinstance(valor, str) else json.dumps(valor, ensure_ascii=False, default=str)
+    if len(texto) <= limite:
+        return texto
+    return f"{texto[:limite]}…(+{len(texto) - limite})"
+
+
+def muestrear(tasa=None):
+    return random.random() < (LOG_SAMPLE_RATE if tasa is None else tasa)
+
+
+class FormatoJSON(logging.Formatter):
+    def format(self, record):
+        linea = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            'nivel': record.levelname,
+            'logger': record.name,
+            'trace_id': getattr(record, 'trace_id', '-'),
+            'msg': record.getMessage(),
+        }
+        datos = getattr(record, 'datos', None)
+        if datos is not None:
+            linea['datos'] = datos
+        if record.exc_text:
+            linea['error'] = record.exc_text
+        return json.dumps(linea, ensure_ascii=False, default=str)
+
+
+class ManejadorCola(logging.handlers.QueueHandler):
+    """Encola sin bloquear; el formateo JSON lo hace el hilo que escribe"""
+
+    def __init__(self, cola):
+        super().__init__(cola)
+        self.descartados = 0
+
+    def prepare(self, record):
+        # Solo lo imprescindible en el hilo del worker: congelar mensaje, trace y traceback
+        record.trace_id = trace_id_actual.get()
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = "".join(traceback.format_exception(*record.exc_info))
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.descartados += 1
+
+
+def configurar(nivel=None):
+    """Instala el pipeline cola -> hilo escritor -> stdout. Idempotente"""
+    global _listener
+    if _listener is not None:
+        return
+
+    cola = queue.Queue(maxsize=LOG_MAX_COLA)
+    salida = logging.StreamHandler(sys.stdout)
+    salida.setFormatter(FormatoJSON())
+
+    raiz = logging.getLogger('bot')
+    raiz.setLevel(nivel or LOG_LEVEL)
+    raiz.handlers = [ManejadorCola(cola)]
+    raiz.propagate = False
+
+    _listener = logging.handlers.QueueListener(cola, salida)
+    _listener.start()
+    atexit.register(detener)
+
+
+def _tras_fork():
+    """El hilo escritor no sobrevive al fork (workers de gunicorn): cada hijo arma el suyo"""
+    global _listener
+    if _listener is not None:
+        _listener = None
+        configurar(logging.getLogger('bot').level)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_tras_fork)
+
+
+def detener():
+    """Vacía la cola pendiente y frena el hilo escritor"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_logger(nombre):
+    configurar()
+    return logging.getLogger(f"bot.{nombre}")
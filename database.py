@@ -1,26 +1,154 @@
 import sqlite3
 import datetime
 import json
+import re
 import os
 import time
+import threading
+import collections
+from contextlib import contextmanager
+from eventos import bus
+from metricas import DB_ESCRITURA, DB_ESPERA_LOCK, MENSAJES, registro
+from bitacora import get_logger
+from estado_compartido import EstadoCompartido, ESTADO_COMPARTIDO
+import analitica
+import lista_espera
+
+log = get_logger('db')
 
 # Nombre de la DB
 DB_NAME = "agenda_final_2025.db"
+# Tope de espera por el lock de SQLite (fuera de un turno se usa entero)
+SQLITE_TIMEOUT_SEG = 5.0
+# Mensajes del historial que van al prompt
+HISTORIAL_SESION = 6
+MAX_CACHE_SESIONES = 5000
+# Una sesión sin actividad por más de esto se olvida (config 'sesion_ttl_horas')
+SESION_TTL_HORAS = 24
+TTL_SESION_RELEER_SEG = 60
+BARRIDO_LOTE = 500
+BARRIDO_PAUSA_SEG = 0.05
+BARRIDO_INTERVALO_SEG = 600
+# Con términos muy comunes se puntúan solo las N coincidencias más recientes
+MAX_CANDIDATOS_BUSQUEDA = 2000
+
+SESIONES_VENCIDAS = registro.contador(
+    'bot_sesiones_vencidas_total', 'Sesiones olvidadas por TTL', ('origen',))
+SESIONES_CACHE = registro.contador(
+    'bot_cache_sesiones_total', 'Lecturas de sesión servidas por la cache del fragmento', ('resultado',))
+
+def consulta_fts(texto, max_terminos=10):
+    """Texto libre del panel -> consulta FTS5 segura: cada palabra entre comillas (todas tienen que estar)"""
+    # Sin prefijos ("barba"*): sin índice de prefijos recorren todo el vocabulario
+    terminos = re.findall(r'\w+', (texto or '').lower())[:max_terminos]
+    return " ".join(f'"{t}"' for t in terminos)
 
 class Database:
-    def __init__(self):
-        self.db_path = os.path.join(os.getcwd(), DB_NAME)
+    """Almacenamiento del bot sobre SQLite (motor por defecto).
+
+    Otro motor (database_postgres.py) hereda de esta clase y reemplaza solo lo que
+    depende del motor: conexión y escritura, esquema (init_db), búsqueda de texto,
+    lecturas grandes, _insertar, _bloquear_turno y las expresiones AHORA/HACE/PARA_ACTUALIZAR.
+    El resto (versiones, cache de sesiones, eventos del bus) es común.
+    """
+
+    # Momento actual y "hace N segundos" (parámetro) como texto UTC 'YYYY-MM-DD HH:MM:SS'
+    AHORA = "CURRENT_TIMESTAMP"
+    HACE = "datetime('now', '-' || ? || ' seconds')"
+    # BEGIN IMMEDIATE ya serializa las escrituras: SQLite no tiene bloqueo por fila
+    PARA_ACTUALIZAR = ""
+
+    def __init__(self, db_path=None, compartido=None):
+        # DB_PATH permite usar una DB aislada (tests, benchmarks)
+        self.db_path = db_path or os.environ.get('DB_PATH') or os.path.join(os.getcwd(), DB_NAME)
+        self._iniciar(compartido)
+
+    def _iniciar(self, compartido):
+        # Contadores de cambios por tabla (para ETags del panel)
+        # El arranque va en el ETag para que un reinicio invalide todo
+        self._arranque = format(int(time.time() * 1000), 'x')
+        self._versiones = {'citas': 0, 'config': 0, 'mensajes': 0}
+        self._versiones_lock = threading.Lock()
         self.init_db()
+        # Varios workers (gunicorn): versiones, keys y buckets pasan a tablas compartidas
+        if compartido is None:
+            compartido = ESTADO_COMPARTIDO
+        self.estado = EstadoCompartido(self) if compartido else None
+        # Cache de sesiones: solo en procesos dueños de sus remitentes (fragmentos.py)
+        self._cache_sesiones = None
+        self._cache_lock = threading.Lock()
+        self._ttl_sesion = SESION_TTL_HORAS * 3600
+        self._ttl_leido = 0.0
+
+    # === VERSIONES (CAMBIOS POR TABLA) ===
+    def marcar_cambio(self, tabla):
+        if self.estado is not None:
+            valor = self.estado.incrementar(f"version_{tabla}")
+            with self._versiones_lock:
+                self._versiones[tabla] = max(self._versiones[tabla], valor)
+            return
+        with self._versiones_lock:
+            self._versiones[tabla] += 1
+
+    def version(self, *tablas):
+        """Firma barata del estado de las tablas indicadas (sin tocar la DB salvo en modo compartido)"""
+        if self.estado is not None:
+            valores = self.estado.leer(['epoca'] + [f"version_{t}" for t in tablas])
+            partes = [f"{t}{valores[f'version_{t}']}" for t in tablas]
+            return format(valores['epoca'], 'x') + "-" + "-".join(partes)
+        partes = [f"{t}{self._versiones[t]}" for t in tablas]
+        return f"{self._arranque}-" + "-".join(partes)
+
+    def sincronizar_versiones(self):
+        """Modo compartido: tablas que otro worker cambió desde la última vez que miramos"""
+        if self.estado is None:
+            return []
+        valores = self.estado.leer([f"version_{t}" for t in self._versiones])
+        cambiadas = []
+        with self._versiones_lock:
+            for tabla, local in self._versiones.items():
+                if valores[f"version_{tabla}"] > local:
+                    self._versiones[tabla] = valores[f"version_{tabla}"]
+                    cambiadas.append(tabla)
+        return cambiadas
 
     def get_connection(self):
         """Crea una conexión a la base de datos"""
-        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        # Busy timeout fijo, no el plazo del turno: guardar mensajes y reservas no es opcional,
+        # y un lock vencido no se puede confundir con un turno ocupado
+        conn = sqlite3.connect(self.db_path, timeout=SQLITE_TIMEOUT_SEG, check_same_thread=False)
         conn.row_factory = sqlite3.Row
         return conn
 
+    @contextmanager
+    def escritura(self, operacion):
+        """Conexión de escritura medida: espera del lock (BEGIN IMMEDIATE) y duración total"""
+        inicio = time.perf_counter()
+        conn = self.get_connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            DB_ESPERA_LOCK.observe(time.perf_counter() - inicio, operacion=operacion)
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+            DB_ESCRITURA.observe(time.perf_counter() - inicio, operacion=operacion)
+
+    def _insertar(self, conn, sql, params):
+        """INSERT que devuelve el id de la fila nueva"""
+        return conn.execute(sql, params).lastrowid
+
+    def _bloquear_turno(self, conn, fecha, hora):
+        """Exclusión entre reservas del mismo turno (en SQLite ya la da BEGIN IMMEDIATE)"""
+
     def init_db(self):
         """Inicializa tablas y carga datos del video"""
         conn = self.get_connection()
+        # WAL (persistente en el archivo): los lectores no bloquean al escritor (panel, respaldos.py)
+        conn.execute("PRAGMA journal_mode=WAL")
         cursor = conn.cursor()
         
         # 1. Tabla Citas
@@ -56,6 +184,44 @@ class Database:
             )
         ''')
 
+        # Historial por cliente (sesión) y fecha -> rango de ids (búsqueda)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_mensajes_cliente ON mensajes (cliente_nombre, id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_mensajes_timestamp ON mensajes (timestamp)")
+
+        # 3b. Búsqueda de texto (FTS5) sobre mensajes, sincronizada por triggers
+        # content='mensajes': el índice no duplica el texto, solo los términos.
+        # cliente_nombre va indexado para filtrar por cliente dentro del índice.
+        existia_fts = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'mensajes_fts'").fetchone()
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS mensajes_fts USING fts5(
+                contenido, cliente_nombre, content='mensajes', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS mensajes_fts_insert AFTER INSERT ON mensajes BEGIN
+                INSERT INTO mensajes_fts (rowid, contenido, cliente_nombre)
+                VALUES (new.id, new.contenido, new.cliente_nombre);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS mensajes_fts_delete AFTER DELETE ON mensajes BEGIN
+                INSERT INTO mensajes_fts (mensajes_fts, rowid, contenido, cliente_nombre)
+                VALUES ('delete', old.id, old.contenido, old.cliente_nombre);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS mensajes_fts_update AFTER UPDATE OF contenido, cliente_nombre ON mensajes BEGIN
+                INSERT INTO mensajes_fts (mensajes_fts, rowid, contenido, cliente_nombre)
+                VALUES ('delete', old.id, old.contenido, old.cliente_nombre);
+                INSERT INTO mensajes_fts (rowid, contenido, cliente_nombre)
+                VALUES (new.id, new.contenido, new.cliente_nombre);
+            END
+        ''')
+        if not existia_fts:
+            # DB existente: indexar el historial una sola vez
+            cursor.execute("INSERT INTO mensajes_fts (mensajes_fts) VALUES ('rebuild')")
+
         # 4. Tabla Sesiones (Memoria IA)
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS sesiones_bot (
@@ -64,6 +230,54 @@ class Database:
                 updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
             )
         ''')
+
+        # 6. Bandeja de conversaciones: un resumen por cliente, se actualiza con cada mensaje
+        existia_bandeja = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'conversaciones'").fetchone()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS conversaciones (
+                cliente_id TEXT PRIMARY KEY,
+                ultimo_id INTEGER NOT NULL,
+                ultimo_mensaje TEXT,
+                ultimo_timestamp DATETIME,
+                ultimo_es_bot INTEGER DEFAULT 0,
+                total_mensajes INTEGER DEFAULT 0,
+                mensajes_bot INTEGER DEFAULT 0,
+                no_leidos INTEGER DEFAULT 0,
+                estado_json TEXT
+            )
+        ''')
+        # Paginación por cursor (keyset): el id del último mensaje ordena la bandeja
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_conversaciones_ultimo ON conversaciones (ultimo_id)")
+        if not existia_bandeja:
+            # DB existente: armar la bandeja desde el historial una sola vez (todo leído)
+            cursor.execute('''
+                INSERT INTO conversaciones (cliente_id, ultimo_id, ultimo_mensaje, ultimo_timestamp, ultimo_es_bot,
+                                            total_mensajes, mensajes_bot, estado_json)
+                SELECT g.cliente_nombre, m.id, m.contenido, m.timestamp, m.es_bot, g.total, g.bot, s.estado_json
+                FROM (SELECT cliente_nombre, max(id) AS ultimo, count(*) AS total, sum(es_bot) AS bot
+                      FROM mensajes WHERE cliente_nombre IS NOT NULL GROUP BY cliente_nombre) g
+                JOIN mensajes m ON m.id = g.ultimo
+                LEFT JOIN sesiones_bot s ON s.cliente_id = g.cliente_nombre
+            ''')
+
+        # Barrido de sesiones vencidas sin recorrer la tabla
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sesiones_updated ON sesiones_bot (updated_at)")
+
+        # 5. Tabla Eventos de Webhook (Idempotencia)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS webhook_eventos (
+                clave TEXT PRIMARY KEY,
+                expira REAL NOT NULL
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_webhook_eventos_expira ON webhook_eventos (expira)")
+
+        # 7. Rollups de analítica (ver analitica.py)
+        if analitica.crear_tablas(cursor):
+            analitica.reconstruir(conn)
+
+        # 8. Lista de espera (ver lista_espera.py)
+        lista_espera.crear_tablas(cursor)
         
         conn.commit()
         conn.close()
@@ -116,12 +330,13 @@ class Database:
             if not data:
                 cursor.execute("INSERT INTO citas (cliente, fecha, hora, servicio) VALUES (?, ?, ?, ?)", 
                                (cliente, fecha, hora, "Corte (Importado)"))
+                analitica.sumar_cita(conn, fecha, "Corte (Importado)", 1)
                 count_inserts += 1
                 
         conn.commit()
         conn.close()
         if count_inserts > 0:
-            print(f"🔄 [DB] Se importaron {count_inserts} turnos del video.")
+            log.info(f"🔄 [DB] Se importaron {count_inserts} turnos del video.")
 
     # === FUNCIONES QUE PIDE TU API_SERVER.PY ===
 
@@ -142,11 +357,11 @@ class Database:
         return {row['clave']: row['valor'] for row in rows}
         
     def set_config(self, clave, valor):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("INSERT OR REPLACE INTO config (clave, valor) VALUES (?, ?)", (clave, valor))
-        conn.commit()
-        conn.close()
+        with self.escritura('set_config') as conn:
+            conn.execute("INSERT INTO config (clave, valor) VALUES (?, ?) "
+                         "ON CONFLICT(clave) DO UPDATE SET valor = excluded.valor", (clave, valor))
+        self.marcar_cambio('config')
+        bus.publicar('config', {'clave': clave, 'valor': valor})
 
     def obtener_citas_por_fecha(self, fecha):
         """Retorna lista de citas para verificar disponibilidad"""
@@ -165,6 +380,14 @@ class Database:
         conn.close()
         return [dict(row) for row in rows]
 
+    def contar_citas(self):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT count(*) FROM citas")
+        res = cursor.fetchone()[0]
+        conn.close()
+        return res
+
     def contar_citas_hoy(self):
         hoy = datetime.date.today().isoformat()
         conn = self.get_connection()
@@ -175,64 +398,273 @@ class Database:
         return res
 
     def contar_mensajes_hoy(self):
-        hoy = datetime.date.today().isoformat()
+        hoy = datetime.date.today()
         conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT count(*) FROM mensajes WHERE date(timestamp) = ?", (hoy,))
+        # Rango sobre el texto del timestamp: usa idx_mensajes_timestamp (y sirve en ambos motores)
+        cursor.execute("SELECT count(*) FROM mensajes WHERE timestamp >= ? AND timestamp < ?",
+                       (hoy.isoformat(), (hoy + datetime.timedelta(days=1)).isoformat()))
         res = cursor.fetchone()[0]
         conn.close()
         return res
 
-    def agregar_mensaje(self, cliente, contenido, es_bot=False):
+    def agregar_mensaje(self, cliente, contenido, es_bot=False, tipo_turno=None):
+        with self.escritura('agregar_mensaje') as conn:
+            mensaje_id = self._insertar(conn, "INSERT INTO mensajes (cliente_nombre, contenido, es_bot) VALUES (?, ?, ?)",
+                                        (cliente, contenido, 1 if es_bot else 0))
+            # Misma transacción: la bandeja nunca queda atrás del historial
+            conn.execute(f'''
+                INSERT INTO conversaciones (cliente_id, ultimo_id, ultimo_mensaje, ultimo_timestamp, ultimo_es_bot,
+                                            total_mensajes, mensajes_bot, no_leidos, estado_json)
+                VALUES (?, ?, ?, {self.AHORA}, ?, 1, ?, ?,
+                        (SELECT estado_json FROM sesiones_bot WHERE cliente_id = ?))
+                ON CONFLICT(cliente_id) DO UPDATE SET
+                    ultimo_id = excluded.ultimo_id, ultimo_mensaje = excluded.ultimo_mensaje,
+                    ultimo_timestamp = excluded.ultimo_timestamp, ultimo_es_bot = excluded.ultimo_es_bot,
+                    total_mensajes = conversaciones.total_mensajes + 1,
+                    mensajes_bot = conversaciones.mensajes_bot + excluded.mensajes_bot,
+                    no_leidos = conversaciones.no_leidos + excluded.no_leidos
+            ''', (cliente, mensaje_id, contenido, 1 if es_bot else 0, 1 if es_bot else 0, 0 if es_bot else 1, cliente))
+            analitica.sumar_mensaje(conn, es_bot, tipo_turno)
+        self.marcar_cambio('mensajes')
+        MENSAJES.inc(origen='bot' if es_bot else 'cliente')
+        if self._cache_sesiones is not None:
+            with self._cache_lock:
+                sesion = self._cache_sesiones.get(cliente)
+                if sesion is not None:
+                    sesion['history'] = (sesion['history'] + [
+                        {"role": "assistant" if es_bot else "user", "content": contenido}])[-HISTORIAL_SESION:]
+        bus.publicar('mensaje', {
+            'id': mensaje_id,
+            'cliente_nombre': cliente,
+            'contenido': contenido,
+            'es_bot': bool(es_bot),
+            'fecha': datetime.date.today().isoformat()
+        })
+
+    # === ANALÍTICA ===
+    def consultar_analitica(self, desde, hasta, agrupar='dia'):
         conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO mensajes (cliente_nombre, contenido, es_bot) VALUES (?, ?, ?)", 
-                       (cliente, contenido, 1 if es_bot else 0))
-        conn.commit()
+        try:
+            return analitica.consultar(conn, desde, hasta, agrupar)
+        finally:
+            conn.close()
+
+    def reconstruir_analitica(self):
+        with self.escritura('reconstruir_analitica') as conn:
+            return analitica.reconstruir(conn)
+
+    # === BANDEJA DE CONVERSACIONES ===
+    def listar_conversaciones(self, limite=30, antes=None):
+        """Más recientes primero; antes = cursor devuelto por la página anterior (ultimo_id)"""
+        conn = self.get_connection()
+        rows = conn.execute(
+            "SELECT * FROM conversaciones WHERE ultimo_id < ? ORDER BY ultimo_id DESC LIMIT ?",
+            (antes if antes is not None else 2 ** 62, limite + 1)).fetchall()
         conn.close()
+        conversaciones = []
+        for r in rows[:limite]:
+            conversacion = dict(r, ultimo_es_bot=bool(r['ultimo_es_bot']))
+            conversacion['estado'] = json.loads(conversacion.pop('estado_json') or '{}')
+            conversaciones.append(conversacion)
+        siguiente = conversaciones[-1]['ultimo_id'] if len(rows) > limite else None
+        return {'conversaciones': conversaciones, 'siguiente': siguiente}
+
+    def marcar_conversacion_leida(self, cliente_id):
+        with self.escritura('marcar_conversacion_leida') as conn:
+            cambio = conn.execute("UPDATE conversaciones SET no_leidos = 0 WHERE cliente_id = ? AND no_leidos > 0",
+                                  (cliente_id,)).rowcount
+        if cambio:
+            self.marcar_cambio('mensajes')
+            bus.publicar('conversacion_leida', {'cliente_id': cliente_id})
+        return bool(cambio)
+
+    def buscar_mensajes(self, texto, cliente=None, desde=None, hasta=None, limite=20, pagina=1):
+        """Búsqueda por relevancia (bm25) con fragmento resaltado; desde/hasta en YYYY-MM-DD"""
+        consulta = consulta_fts(texto)
+        if not consulta:
+            return {'resultados': [], 'pagina': pagina, 'hay_mas': False}
+
+        if cliente:
+            # Filtro dentro del índice (intersección de listas), no después de puntuar
+            consulta = f'contenido : ({consulta}) AND cliente_nombre : "{cliente.replace(chr(34), "")}"'
 
-    def agregar_cita(self, fecha, hora, cliente_nombre, telefono, servicio):
         conn = self.get_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute("BEGIN TRANSACTION")
+        # Fechas -> rango de ids (ids y timestamps crecen juntos): FTS5 salta directo al rango
+        desde_id, hasta_id = 0, 2 ** 62
+        if desde:
+            fila = conn.execute("SELECT id FROM mensajes WHERE timestamp >= ? ORDER BY timestamp, id LIMIT 1",
+                                (desde,)).fetchone()
+            desde_id = fila[0] if fila else None
+        if hasta:
+            fila = conn.execute("SELECT id FROM mensajes WHERE timestamp < date(?, '+1 day') "
+                                "ORDER BY timestamp DESC, id DESC LIMIT 1", (hasta,)).fetchone()
+            hasta_id = fila[0] if fila else None
+        if desde_id is None or hasta_id is None:
+            conn.close()
+            return {'resultados': [], 'pagina': pagina, 'hay_mas': False}
+
+        # Términos muy comunes: puntuar solo las coincidencias más recientes (bm25 recorrería todas)
+        corte = conn.execute('''
+            SELECT rowid FROM mensajes_fts WHERE mensajes_fts MATCH ? AND rowid BETWEEN ? AND ?
+            ORDER BY rowid DESC LIMIT 1 OFFSET ?
+        ''', (consulta, desde_id, hasta_id, MAX_CANDIDATOS_BUSQUEDA)).fetchone()
+        if corte:
+            desde_id = corte[0]
+
+        # Uno de más para saber si hay otra página sin contar todo
+        rows = conn.execute('''
+            SELECT m.id, m.cliente_nombre, m.contenido, m.es_bot, m.timestamp,
+                   snippet(mensajes_fts, 0, '<b>', '</b>', '…', 12) AS fragmento
+            FROM mensajes_fts JOIN mensajes m ON m.id = mensajes_fts.rowid
+            WHERE mensajes_fts MATCH ? AND mensajes_fts.rowid BETWEEN ? AND ?
+            ORDER BY bm25(mensajes_fts, 1.0, 0.0)
+            LIMIT ? OFFSET ?
+        ''', (consulta, desde_id, hasta_id, limite + 1, (pagina - 1) * limite)).fetchall()
+        conn.close()
+        resultados = [dict(r, es_bot=bool(r['es_bot'])) for r in rows[:limite]]
+        return {'resultados': resultados, 'pagina': pagina, 'hay_mas': len(rows) > limite}
+
+    def agregar_cita(self, fecha, hora, cliente_nombre, telefono, servicio):
+        """id de la cita nueva, o None si el turno ya está ocupado (los errores de la DB se propagan)"""
+        # BEGIN IMMEDIATE (o el bloqueo del turno): nadie más puede reservar entre el chequeo y el insert
+        with self.escritura('agregar_cita') as conn:
+            self._bloquear_turno(conn, fecha, hora)
+            cursor = conn.cursor()
             # Verificar disponibilidad
             cursor.execute("SELECT count(*) FROM citas WHERE fecha = ? AND hora = ?", (fecha, hora))
             if cursor.fetchone()[0] > 0:
-                conn.rollback()
                 return None
-            
-            cursor.execute("INSERT INTO citas (cliente, telefono, fecha, hora, servicio) VALUES (?, ?, ?, ?, ?)",
-                           (cliente_nombre, telefono, fecha, hora, servicio))
-            last_id = cursor.lastrowid
-            conn.commit()
-            return last_id
-        except Exception as e:
-            conn.rollback()
-            print(f"Error DB: {e}")
-            return None
-        finally:
-            conn.close()
+
+            last_id = self._insertar(conn, "INSERT INTO citas (cliente, telefono, fecha, hora, servicio) "
+                                           "VALUES (?, ?, ?, ?, ?)", (cliente_nombre, telefono, fecha, hora, servicio))
+            analitica.sumar_cita(conn, fecha, servicio, 1)
+        self.marcar_cambio('citas')
+        bus.publicar('cita_agregada', {
+            'id': last_id,
+            'cliente': cliente_nombre,
+            'telefono': telefono,
+            'fecha': fecha,
+            'hora': hora,
+            'servicio': servicio,
+            'estado': 'Confirmado'
+        })
+        return last_id
 
     def eliminar_cita(self, cita_id):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM citas WHERE id = ?", (cita_id,))
-        conn.commit()
-        conn.close()
+        with self.escritura('eliminar_cita') as conn:
+            row = conn.execute(f"SELECT fecha, hora, servicio, estado FROM citas WHERE id = ?{self.PARA_ACTUALIZAR}",
+                               (cita_id,)).fetchone()
+            conn.execute("DELETE FROM citas WHERE id = ?", (cita_id,))
+            if row and row['estado'] == 'Confirmado':
+                analitica.sumar_cita(conn, row['fecha'], row['servicio'], -1)
+        if row:
+            self.marcar_cambio('citas')
+            bus.publicar('cita_eliminada', {'id': cita_id, 'fecha': row['fecha'], 'hora': row['hora']})
 
     # === MANEJO DE SESIONES (MEMORIA) ===
+    # === CACHE DE SESIONES (FRAGMENTOS) ===
+    def activar_cache_sesiones(self, maximo=MAX_CACHE_SESIONES):
+        """Solo válido si este proceso es el único que atiende a sus remitentes"""
+        self._cache_sesiones = collections.OrderedDict()
+        self._cache_maximo = maximo
+
+    def podar_cache_sesiones(self, conservar):
+        """Suelta las sesiones cuyo cliente ya no es de este proceso; devuelve cuántas"""
+        if self._cache_sesiones is None:
+            return 0
+        with self._cache_lock:
+            sueltas = [c for c in self._cache_sesiones if not conservar(c)]
+            for cliente in sueltas:
+                del self._cache_sesiones[cliente]
+        return len(sueltas)
+
+    def soltar_sesion(self, cliente_id):
+        """Otro proceso escribió en el historial del cliente: la próxima lectura va a la DB"""
+        if self._cache_sesiones is not None:
+            with self._cache_lock:
+                self._cache_sesiones.pop(cliente_id, None)
+
+    def _sesion_cacheada(self, cliente_id):
+        vencimiento = time.time() - self.ttl_sesion()
+        with self._cache_lock:
+            sesion = self._cache_sesiones.get(cliente_id)
+            if sesion is None:
+                return None
+            if sesion['tocada'] < vencimiento:
+                # Vencida: que la lectura de la DB aplique el vencimiento
+                del self._cache_sesiones[cliente_id]
+                return None
+            self._cache_sesiones.move_to_end(cliente_id)
+            # Copias: los llamadores modifican el estado que reciben
+            return {"state": dict(sesion['state']), "history": list(sesion['history'])}
+
+    def _cachear_sesion(self, cliente_id, sesion, tocada):
+        with self._cache_lock:
+            self._cache_sesiones[cliente_id] = {"state": dict(sesion['state']), "history": list(sesion['history']),
+                                                "tocada": tocada}
+            while len(self._cache_sesiones) > self._cache_maximo:
+                self._cache_sesiones.popitem(last=False)
+
+    # === VENCIMIENTO DE SESIONES (TTL) ===
+    def ttl_sesion(self):
+        """Segundos sin actividad tras los que una sesión se olvida (config 'sesion_ttl_horas', cacheado 60s)"""
+        ahora = time.time()
+        if ahora - self._ttl_leido > TTL_SESION_RELEER_SEG:
+            try:
+                self._ttl_sesion = float(self.get_config('sesion_ttl_horas', SESION_TTL_HORAS)) * 3600
+            except (TypeError, ValueError):
+                self._ttl_sesion = SESION_TTL_HORAS * 3600
+            self._ttl_leido = ahora
+        return self._ttl_sesion
+
+    def barrer_sesiones(self, lote=BARRIDO_LOTE):
+        """Borra sesiones vencidas o vacías en lotes cortos (no retiene el lock de escritura); devuelve cuántas"""
+        limite = int(self.ttl_sesion())
+        total = 0
+        while True:
+            with self.escritura('barrer_sesiones') as conn:
+                ids = [r[0] for r in conn.execute(
+                    f"SELECT cliente_id FROM sesiones_bot WHERE updated_at < {self.HACE} "
+                    "OR estado_json IS NULL OR estado_json IN ('{}', 'null', '') LIMIT ?", (limite, lote))]
+                if ids:
+                    marcas = ",".join("?" * len(ids))
+                    conn.execute(f"DELETE FROM sesiones_bot WHERE cliente_id IN ({marcas})", ids)
+                    conn.execute(f"UPDATE conversaciones SET estado_json = NULL WHERE cliente_id IN ({marcas})", ids)
+            total += len(ids)
+            if len(ids) < lote:
+                break
+            # Dejar pasar a los turnos entre lote y lote
+            time.sleep(BARRIDO_PAUSA_SEG)
+        if total:
+            SESIONES_VENCIDAS.inc(total, origen='barrido')
+            log.info(f"🧹 {total} sesiones vencidas o vacías borradas")
+        return total
+
     def get_session(self, cliente_id):
+        if self._cache_sesiones is not None:
+            sesion = self._sesion_cacheada(cliente_id)
+            SESIONES_CACHE.inc(resultado='hit' if sesion else 'miss')
+            if sesion is not None:
+                return sesion
+
         conn = self.get_connection()
         cursor = conn.cursor()
+        limite = int(self.ttl_sesion())
         
-        # 1. Obtener estado
-        cursor.execute("SELECT estado_json FROM sesiones_bot WHERE cliente_id = ?", (cliente_id,))
+        # 1. Obtener estado (vencimiento perezoso: una sesión vieja se lee como vacía; el barrido la borra)
+        cursor.execute(f"SELECT estado_json, updated_at < {self.HACE} AS vencida FROM sesiones_bot "
+                       "WHERE cliente_id = ?", (limite, cliente_id))
         row = cursor.fetchone()
+        if row and row['vencida']:
+            SESIONES_VENCIDAS.inc(origen='carga')
+            log.info(f"⌛ Sesión de {cliente_id} vencida, arranca de cero")
+            row = None
         state = json.loads(row['estado_json']) if row and row['estado_json'] else {}
 
-        # 2. Obtener historial reciente
-        cursor.execute("SELECT es_bot, contenido FROM mensajes WHERE cliente_nombre = ? ORDER BY id DESC LIMIT 6", (cliente_id,))
+        # 2. Obtener historial reciente (solo dentro del TTL: la charla de la semana pasada no va al prompt)
+        cursor.execute(f"SELECT es_bot, contenido FROM mensajes WHERE cliente_nombre = ? AND timestamp >= {self.HACE} "
+                       "ORDER BY id DESC LIMIT ?", (cliente_id, limite, HISTORIAL_SESION))
         rows = cursor.fetchall()
         
         history = []
@@ -241,15 +673,88 @@ class Database:
             history.insert(0, {"role": role, "content": r['contenido']})
             
         conn.close()
+        if self._cache_sesiones is not None:
+            self._cachear_sesion(cliente_id, {"state": state, "history": history}, time.time())
         return {"state": state, "history": history}
 
     def save_session_state(self, cliente_id, state_dict):
-        conn = self.get_connection()
-        cursor = conn.cursor()
         json_str = json.dumps(state_dict)
-        cursor.execute("INSERT OR REPLACE INTO sesiones_bot (cliente_id, estado_json) VALUES (?, ?)", (cliente_id, json_str))
-        conn.commit()
+        with self.escritura('save_session_state') as conn:
+            conn.execute(f"INSERT INTO sesiones_bot (cliente_id, estado_json, updated_at) VALUES (?, ?, {self.AHORA}) "
+                         "ON CONFLICT(cliente_id) DO UPDATE SET estado_json = excluded.estado_json, "
+                         "updated_at = excluded.updated_at", (cliente_id, json_str))
+            conn.execute("UPDATE conversaciones SET estado_json = ? WHERE cliente_id = ?", (json_str, cliente_id))
+        if self._cache_sesiones is not None:
+            with self._cache_lock:
+                if cliente_id in self._cache_sesiones:
+                    self._cache_sesiones[cliente_id]['state'] = json.loads(json_str)
+                    self._cache_sesiones[cliente_id]['tocada'] = time.time()
+
+
+    # === IDEMPOTENCIA DE WEBHOOKS ===
+    def registrar_evento_webhook(self, clave, expira):
+        """True si el evento es nuevo; False si ya estaba registrado (duplicado)"""
+        with self.escritura('registrar_evento_webhook') as conn:
+            cursor = conn.execute("INSERT INTO webhook_eventos (clave, expira) VALUES (?, ?) ON CONFLICT DO NOTHING",
+                                  (clave, expira))
+            return cursor.rowcount == 1
+
+    def existe_evento_webhook(self, clave, ahora):
+        conn = self.get_connection()
+        fila = conn.execute("SELECT 1 FROM webhook_eventos WHERE clave = ? AND expira > ?", (clave, ahora)).fetchone()
+        conn.close()
+        return fila is not None
+
+    def cargar_eventos_webhook(self, ahora):
+        """Eventos vigentes, para precargar el set en memoria al arrancar"""
+        conn = self.get_connection()
+        rows = conn.execute("SELECT clave, expira FROM webhook_eventos WHERE expira > ?", (ahora,)).fetchall()
         conn.close()
+        return [(r['clave'], r['expira']) for r in rows]
+
+    def purgar_eventos_webhook(self, ahora):
+        with self.escritura('purgar_eventos_webhook') as conn:
+            return conn.execute("DELETE FROM webhook_eventos WHERE expira <= ?", (ahora,)).rowcount
+
+class BarridoSesiones:
+    """Hilo que cada tanto borra sesiones vencidas; una sola instancia por despliegue"""
+
+    def __init__(self, db, intervalo=BARRIDO_INTERVALO_SEG):
+        self.db = db
+        self.intervalo = intervalo
+        self._hilo = None
+        self._detener = threading.Event()
+
+    def iniciar(self):
+        if self._hilo is None or not self._hilo.is_alive():
+            self._detener.clear()
+            self._hilo = threading.Thread(target=self._barrer, name="barrido-sesiones", daemon=True)
+            self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+
+    def _barrer(self):
+        while not self._detener.wait(self.intervalo):
+            try:
+                self.db.barrer_sesiones()
+            except Exception as e:
+                log.warning(f"⚠️ Barrido de sesiones: {e}")
+
+# === SELECCIÓN DEL MOTOR ===
+def crear_db():
+    """SQLite salvo DB_BACKEND=postgres explícito: un DATABASE_URL suelto (Railway lo inyecta
+    al agregar un plugin) no cambia de motor ni deja atrás los datos de SQLite"""
+    url = os.environ.get('DATABASE_URL', '')
+    motor = os.environ.get('DB_BACKEND', 'sqlite').lower()
+    if motor in ('postgres', 'postgresql'):
+        from database_postgres import DatabasePostgres
+        return DatabasePostgres(url)
+    if motor != 'sqlite':
+        raise ValueError(f"DB_BACKEND={motor!r} no existe (sqlite o postgres)")
+    if url.startswith(('postgres://', 'postgresql://')):
+        log.warning("⚠️ DATABASE_URL apunta a PostgreSQL pero DB_BACKEND no es postgres: sigo con SQLite")
+    return Database()
 
 # INSTANCIA GLOBAL (Importante para api_server.py)
-db = Database()
\ No newline at end of file
+db = crear_db()
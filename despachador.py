@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+DESPACHADOR DE TURNOS POR REMITENTE
+===================================
+El webhook encola y responde 200 al toque; N hilos procesan los turnos.
+Cada remitente cae siempre en el mismo hilo (hash), así sus mensajes se
+procesan en orden y nunca dos turnos del mismo cliente en paralelo.
+"""
+
+import contextvars
+import os
+import queue
+import threading
+import zlib
+
+from bitacora import get_logger
+
+log = get_logger('despachador')
+
+WORKERS_TURNOS = int(os.environ.get('WORKERS_TURNOS', '8'))
+
+
+class Despachador:
+    def __init__(self, procesar, hilos=WORKERS_TURNOS):
+        self.procesar = procesar
+        self.colas = [queue.Queue() for _ in range(max(1, hilos))]
+        self._hilos = []
+        self._iniciado = False
+        self._lock = threading.Lock()
+
+    def iniciar(self):
+        with self._lock:
+            if self._iniciado:
+                return
+            for i, cola in enumerate(self.colas):
+                hilo = threading.Thread(target=self._trabajar, args=(cola,), name=f"turnos-{i}", daemon=True)
+                hilo.start()
+                self._hilos.append(hilo)
+            self._iniciado = True
+
+    def indice(self, remitente):
+        # crc32 es estable entre procesos (hash() de str no lo es)
+        return zlib.crc32(remitente.encode('utf-8')) % len(self.colas)
+
+    def encolar(self, remitente, *args):
+        """Encola un turno; hereda el contexto (trace_id) del webhook"""
+        self.iniciar()
+        contexto = contextvars.copy_context()
+        self.colas[self.indice(remitente)].put((contexto, remitente, args))
+
+    def pendientes(self):
+        return sum(c.qsize() for c in self.colas)
+
+    def _trabajar(self, cola):
+        while True:
+            contexto, remitente, args = cola.get()
+            try:
+                contexto.run(self.procesar, remitente, *args)
+            except Exception as e:
+                log.exception(f"❌ Error procesando turno de {remitente}: {e}")
+            finally:
+                cola.task_done()
+
+    def esperar(self):
+        """Bloquea hasta vaciar todas las colas (tests / apagado ordenado)"""
+        for cola in self.colas:
+            cola.join()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+ENRUTADOR DE MODELOS
+====================
+Cada turno elige modelo y presupuesto de max_tokens según lo que tiene que
+hacer, en vez de pagar lo mismo por un saludo que por una confirmación:
+
+    saludo        nada en memoria: respuesta corta y fija
+    datos         faltan nombre/servicio/fecha-hora: una pregunta
+    confirmacion  está todo: puede venir el objeto "cita" completo
+    contexto      prompt largo (historial extenso): más margen para copiar la memoria
+    escalado      modelo fuerte, solo si la respuesta no pasó la validación
+
+Escalado: si la salida no se pudo leer (sin estructura, JSON rechazado por
+Groq), vino cortada por max_tokens, sin texto, o con una cita incompleta o con
+fecha/hora inválidas, se repite la llamada una vez con el modelo fuerte en vez
+de contestarle al cliente con una extracción mala y volver a preguntarle.
+
+Por ruta se mide latencia, tokens (prompt/completion) y resultado.
+Modelos: LLM_MODELO (default llama-3.1-8b-instant) y LLM_MODELO_FUERTE.
+"""
+
+import collections
+import os
+import re
+
+from bitacora import get_logger
+from metricas import registro
+
+log = get_logger('enrutador_modelos')
+
+MODELO = os.environ.get('LLM_MODELO', 'llama-3.1-8b-instant')
+MODELO_FUERTE = os.environ.get('LLM_MODELO_FUERTE', 'llama-3.3-70b-versatile')
+# ~4 caracteres por token: el prompt se estima sin tokenizar
+CARACTERES_POR_TOKEN = 4
+UMBRAL_CONTEXTO_TOKENS = 2500
+FECHA = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+HORA = re.compile(r'^\d{2}:\d{2}$')
+
+Ruta = collections.namedtuple('Ruta', 'nombre modelo max_tokens')
+
+RUTAS = {
+    'saludo': Ruta('saludo', MODELO, 200),
+    'datos': Ruta('datos', MODELO, 300),
+    'confirmacion': Ruta('confirmacion', MODELO, 400),
+    'contexto': Ruta('contexto', MODELO, 450),
+    'escalado': Ruta('escalado', MODELO_FUERTE, 500),
+}
+
+RUTA_SEGUNDOS = registro.histograma(
+    'bot_llm_ruta_segundos', 'Latencia de las llamadas al LLM por ruta', ('ruta',))
+RUTA_LLAMADAS = registro.contador(
+    'bot_llm_ruta_total', 'Llamadas al LLM por ruta y resultado (ok, invalido, error)', ('ruta', 'resultado'))
+RUTA_TOKENS = registro.contador(
+    'bot_llm_tokens_total', 'Tokens usados por ruta (prompt, completion)', ('ruta', 'tipo'))
+
+
+def elegir(faltantes, mensajes):
+    """faltantes: lo que falta en memoria (NOMBRE, SERVICIO, FECHA Y HORA); mensajes: el prompt armado"""
+    tokens = sum(len(m.get('content') or '') for m in mensajes) // CARACTERES_POR_TOKEN
+    if tokens > UMBRAL_CONTEXTO_TOKENS:
+        return RUTAS['contexto']
+    if not faltantes:
+        return RUTAS['confirmacion']
+    if len(faltantes) == 3:
+        return RUTAS['saludo']
+    return RUTAS['datos']
+
+
+def parametros(ruta, base):
+    """Parámetros de chat.completions.create: los comunes (base) con el modelo y presupuesto de la ruta"""
+    return dict(base, model=ruta.modelo, max_tokens=ruta.max_tokens)
+
+
+def validar(salida, completion=None):
+    """Motivo por el que la respuesta no sirve, o None"""
+    if salida.resultado == 'sin_estructura':
+        return 'sin_estructura'
+    if not salida.respuesta:
+        return 'sin_respuesta'
+    if completion is not None and completion.choices[0].finish_reason == 'length':
+        return 'cortada'
+    if salida.incompleta:
+        return 'cita_incompleta'
+    if salida.cita and not (FECHA.match(salida.cita['fecha']) and HORA.match(salida.cita['hora'].zfill(5))):
+        return 'cita_invalida'
+    return None
+
+
+def registrar(ruta, segundos, resultado, completion=None):
+    RUTA_SEGUNDOS.observe(segundos, ruta=ruta.nombre)
+    RUTA_LLAMADAS.inc(ruta=ruta.nombre, resultado=resultado)
+    uso = getattr(completion, 'usage', None)
+    if uso is not None:
+        RUTA_TOKENS.inc(uso.prompt_tokens or 0, ruta=ruta.nombre, tipo='prompt')
+        RUTA_TOKENS.inc(uso.completion_tokens or 0, ruta=ruta.nombre, tipo='completion')
+
+
+def revisar(ruta, salida, segundos, completion=None):
+    """Registra la llamada; devuelve la ruta a la que escalar, o None si la respuesta se usa así"""
+    motivo = validar(salida, completion)
+    registrar(ruta, segundos, 'invalido' if motivo else 'ok', completion)
+    if motivo is None or ruta.nombre == 'escalado':
+        return None
+    log.info(f"🔼 Respuesta de '{ruta.nombre}' no válida ({motivo}): escalando a {MODELO_FUERTE}")
+    return RUTAS['escalado']
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+NORMALIZACIÓN DE PAYLOADS DEL WEBHOOK
+=====================================
+Convierte las tres formas de payload que recibimos en una lista plana de
+MensajeEntrante, procesando TODOS los mensajes de un lote (antes solo el [0]).
+
+  Caso 1: plano          {"from": ..., "message": ...}
+  Caso 2: WaSender       {"data": {"messages": [ {...}, {...} ]}}  (o un dict suelto)
+  Caso 3: genérico       {"data": {"from"/"phone": ..., "message"/"body": ...}}
+"""
+
+import collections
+
+# clave: evento de idempotencia, se confirma cuando el turno terminó (ver idempotencia.py)
+MensajeEntrante = collections.namedtuple(
+    'MensajeEntrante', ['remitente', 'mensaje', 'push_name', 'msg_id', 'timestamp', 'clave'], defaults=(None,))
+
+
+def _limpiar_remitente(remitente):
+    return str(remitente).replace('@c.us', '').replace('+', '')
+
+
+def _caso_plano(data):
+    yield data.get('from'), data.get('message'), None, data.get('id') or data.get('messageId'), data.get('timestamp')
+
+
+def _caso_wasender(data):
+    mensajes = data['data']['messages']
+    if not isinstance(mensajes, list):
+        mensajes = [mensajes]
+    for msg_data in mensajes:
+        if not isinstance(msg_data, dict):
+            continue
+        # Extracción del mensaje
+        mensaje = msg_data.get('messageBody')
+        if not mensaje:
+            contenido_msg = msg_data.get('message') or {}
+            mensaje = contenido_msg.get('conversation') or (contenido_msg.get('extendedTextMessage') or {}).get('text')
+
+        # Extracción del remitente
+        key = msg_data.get('key') or {}
+        remitente = msg_data.get('remoteJid') or key.get('remoteJid')
+
+        yield (remitente, mensaje, msg_data.get('pushName'),
+               key.get('id') or msg_data.get('id'), msg_data.get('messageTimestamp'))
+
+
+def _caso_generico(data):
+    interno = data['data']
+    yield (interno.get('from') or interno.get('phone'), interno.get('message') or interno.get('body'),
+           None, interno.get('id') or interno.get('messageId'), interno.get('timestamp'))
+
+
+def normalizar_payload(data):
+    """Genera un MensajeEntrante por cada mensaje utilizable del payload"""
+    if not isinstance(data, dict):
+        return
+    if 'message' in data and 'from' in data:
+        extractor = _caso_plano
+    elif isinstance(data.get('data'), dict) and 'messages' in data['data']:
+        extractor = _caso_wasender
+    elif isinstance(data.get('data'), dict):
+        extractor = _caso_generico
+    else:
+        return
+
+    for remitente, mensaje, push_name, msg_id, timestamp in extractor(data):
+        if not mensaje or not remitente:
+            continue
+        yield MensajeEntrante(_limpiar_remitente(remitente), mensaje, push_name, msg_id, timestamp)
+
+
+def agrupar_por_remitente(mensajes):
+    """remitente -> [MensajeEntrante] respetando el orden de llegada"""
+    grupos = collections.OrderedDict()
+    for m in mensajes:
+        grupos.setdefault(m.remitente, []).append(m)
+    return grupos
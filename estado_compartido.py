@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+ESTADO COMPARTIDO ENTRE WORKERS (GUNICORN)
+==========================================
+Con varios procesos, lo que vivía en variables globales deja de ser coherente.
+Con ESTADO_COMPARTIDO=1 (lo activa gunicorn.conf.py) pasa a tablas en la misma
+DB (SQLite o PostgreSQL), con transacciones cortas vía db.escritura:
+
+- contadores de versión por tabla (ETags del panel, /api/events)
+- rotación y salud de las API keys de Groq
+- token buckets por remitente (control de admisión)
+- cupo de llamadas al LLM en vuelo (control de admisión): un arriendo por llamada,
+  que vence solo si el proceso que lo tomó murió sin soltarlo
+
+Las claves de idempotencia ya eran compartidas: la tabla webhook_eventos es la
+fuente de verdad y el set en memoria solo ahorra consultas dentro de un proceso.
+
+Sin ESTADO_COMPARTIDO (app.run, tests) todo sigue en memoria como antes.
+"""
+
+import os
+import secrets
+import threading
+import time
+
+from bitacora import get_logger
+
+log = get_logger('estado')
+
+ESTADO_COMPARTIDO = os.environ.get('ESTADO_COMPARTIDO', '').lower() in ('1', 'true', 'si')
+
+# Una key que falló descansa este tiempo antes de volver a la rotación
+ENFRIAR_CLAVE_SEG = 30
+# Buckets sin uso por más de esto se borran (quedarían llenos igual)
+BUCKET_INACTIVO_SEG = 3600
+PURGAR_BUCKETS_CADA = 1000
+# Cada cuánto el puente mira si otro worker cambió algo
+PUENTE_INTERVALO_SEG = 1.0
+# Un cupo de LLM de un proceso caído se libera solo después de esto (más que cualquier turno)
+CUPO_LLM_VENCE_SEG = 120
+
+
+class EstadoCompartido:
+    def __init__(self, db):
+        self.db = db
+        self._tomas = 0
+        self._crear_tablas()
+
+    def _crear_tablas(self):
+        conn = self.db.get_connection()
+        # (Los tipos valen para ambos motores: REAL en PostgreSQL es de 4 bytes y no alcanza para un epoch)
+        # WAL: los lectores de un worker no se bloquean con el escritor de otro
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS estado_contadores (
+                nombre TEXT PRIMARY KEY,
+                valor BIGINT NOT NULL DEFAULT 0
+            )
+        ''')
+        # Época compartida para los ETags (la primera instancia la fija, el resto la lee)
+        conn.execute("INSERT INTO estado_contadores (nombre, valor) VALUES ('epoca', ?) ON CONFLICT DO NOTHING",
+                     (int(time.time() * 1000),))
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS estado_claves (
+                indice INTEGER PRIMARY KEY,
+                fallos INTEGER NOT NULL DEFAULT 0,
+                enfriar_hasta DOUBLE PRECISION NOT NULL DEFAULT 0,
+                ultimo_error TEXT
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS estado_cupos_llm (
+                id TEXT PRIMARY KEY,
+                vence DOUBLE PRECISION NOT NULL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS estado_buckets (
+                clave TEXT PRIMARY KEY,
+                tokens DOUBLE PRECISION NOT NULL,
+                actualizado DOUBLE PRECISION NOT NULL
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    # === CONTADORES ===
+    def incrementar(self, nombre):
+        with self.db.escritura('estado_contador') as conn:
+            conn.execute("INSERT INTO estado_contadores (nombre, valor) VALUES (?, 1) "
+                         "ON CONFLICT(nombre) DO UPDATE SET valor = estado_contadores.valor + 1", (nombre,))
+            return conn.execute("SELECT valor FROM estado_contadores WHERE nombre = ?", (nombre,)).fetchone()[0]
+
+    def leer(self, nombres):
+        conn = self.db.get_connection()
+        marcas = ",".join("?" * len(nombres))
+        rows = conn.execute(f"SELECT nombre, valor FROM estado_contadores WHERE nombre IN ({marcas})",
+                            list(nombres)).fetchall()
+        conn.close()
+        valores = {n: 0 for n in nombres}
+        valores.update({r['nombre']: r['valor'] for r in rows})
+        return valores
+
+    # === ROTACIÓN Y SALUD DE KEYS ===
+    def clave_activa(self, cantidad):
+        """Índice de la key a usar: la actual, salvo que esté enfriándose y haya otra sana"""
+        conn = self.db.get_connection()
+        fila = conn.execute("SELECT valor FROM estado_contadores WHERE nombre = 'clave_actual'").fetchone()
+        enfriando = {r['indice'] for r in conn.execute(
+            "SELECT indice FROM estado_claves WHERE enfriar_hasta > ?", (time.time(),))}
+        conn.close()
+        actual = (fila[0] if fila else 0) % cantidad
+        for paso in range(cantidad):
+            indice = (actual + paso) % cantidad
+            if indice not in enfriando:
+                return indice
+        return actual
+
+    def reportar_clave(self, indice, cantidad, ok, error=None):
+        if ok:
+            # Sin escritura en el camino feliz salvo que la key viniera de fallar
+            conn = self.db.get_connection()
+            fallos = conn.execute("SELECT fallos FROM estado_claves WHERE indice = ?", (indice,)).fetchone()
+            conn.close()
+            if not fallos or not fallos[0]:
+                return
+            with self.db.escritura('estado_clave') as conn:
+                conn.execute("UPDATE estado_claves SET fallos = 0, enfriar_hasta = 0 WHERE indice = ?", (indice,))
+            return
+
+        with self.db.escritura('estado_clave') as conn:
+            conn.execute('''
+                INSERT INTO estado_claves (indice, fallos, enfriar_hasta, ultimo_error) VALUES (?, 1, ?, ?)
+                ON CONFLICT(indice) DO UPDATE SET fallos = estado_claves.fallos + 1, enfriar_hasta = excluded.enfriar_hasta,
+                    ultimo_error = excluded.ultimo_error
+            ''', (indice, time.time() + ENFRIAR_CLAVE_SEG, (error or '')[:200]))
+            # Avanzar la rotación solo si nadie la avanzó ya (otro worker con el mismo error)
+            fila = conn.execute("SELECT valor FROM estado_contadores WHERE nombre = 'clave_actual'").fetchone()
+            if (fila[0] if fila else 0) % cantidad == indice:
+                conn.execute("INSERT INTO estado_contadores (nombre, valor) VALUES ('clave_actual', ?) "
+                             "ON CONFLICT(nombre) DO UPDATE SET valor = excluded.valor", ((indice + 1) % cantidad,))
+
+    def salud_claves(self):
+        conn = self.db.get_connection()
+        rows = conn.execute("SELECT indice, fallos, enfriar_hasta, ultimo_error FROM estado_claves").fetchall()
+        conn.close()
+        return [dict(r) for r in rows]
+
+    # === CUPO DE LLM ===
+    def tomar_cupo_llm(self, limite):
+        """Id del arriendo tomado, o None si ya hay `limite` llamadas en vuelo en todo el despliegue"""
+        ahora = time.time()
+        with self.db.escritura('estado_cupo') as conn:
+            # Fila de bloqueo: en PostgreSQL dos workers no cuentan a la vez (en SQLite ya lo hace BEGIN IMMEDIATE)
+            conn.execute("INSERT INTO estado_contadores (nombre, valor) VALUES ('cupo_llm', 0) "
+                         "ON CONFLICT(nombre) DO UPDATE SET valor = estado_contadores.valor")
+            conn.execute("DELETE FROM estado_cupos_llm WHERE vence <= ?", (ahora,))
+            if conn.execute("SELECT COUNT(*) FROM estado_cupos_llm").fetchone()[0] >= limite:
+                return None
+            cupo = secrets.token_hex(8)
+            conn.execute("INSERT INTO estado_cupos_llm (id, vence) VALUES (?, ?)", (cupo, ahora + CUPO_LLM_VENCE_SEG))
+        return cupo
+
+    def soltar_cupo_llm(self, cupo):
+        with self.db.escritura('estado_cupo') as conn:
+            conn.execute("DELETE FROM estado_cupos_llm WHERE id = ?", (cupo,))
+
+    # === TOKEN BUCKETS ===
+    def tomar_token(self, clave, capacidad, por_segundo):
+        ahora = time.time()
+        with self.db.escritura('estado_bucket') as conn:
+            fila = conn.execute("SELECT tokens, actualizado FROM estado_buckets WHERE clave = ?", (clave,)).fetchone()
+            tokens = capacidad if fila is None else min(capacidad, fila[0] + (ahora - fila[1]) * por_segundo)
+            permitido = tokens >= 1
+            if permitido:
+                tokens -= 1
+            conn.execute("INSERT INTO estado_buckets (clave, tokens, actualizado) VALUES (?, ?, ?) "
+                         "ON CONFLICT(clave) DO UPDATE SET tokens = excluded.tokens, actualizado = excluded.actualizado",
+                         (clave, tokens, ahora))
+        self._tomas += 1
+        if self._tomas % PURGAR_BUCKETS_CADA == 0:
+            with self.db.escritura('estado_bucket') as conn:
+                conn.execute("DELETE FROM estado_buckets WHERE actualizado < ?", (ahora - BUCKET_INACTIVO_SEG,))
+        return permitido
+
+
+class RotacionClaves:
+    """Key de Groq a usar y qué hacer cuando falla; en memoria o compartida entre workers"""
+
+    def __init__(self, cantidad, estado=None):
+        self.cantidad = cantidad
+        self.estado = estado
+        self._actual = 0
+        self._enfriar_hasta = {}
+        self._lock = threading.Lock()
+
+    def actual(self):
+        if self.estado is not None:
+            return self.estado.clave_activa(self.cantidad)
+        ahora = time.time()
+        with self._lock:
+            for paso in range(self.cantidad):
+                indice = (self._actual + paso) % self.cantidad
+                if self._enfriar_hasta.get(indice, 0) <= ahora:
+                    return indice
+            return self._actual
+
+    def exito(self, indice):
+        if self.estado is not None:
+            self.estado.reportar_clave(indice, self.cantidad, ok=True)
+            return
+        with self._lock:
+            self._enfriar_hasta.pop(indice, None)
+
+    def fallo(self, indice, error=None):
+        if self.estado is not None:
+            self.estado.reportar_clave(indice, self.cantidad, ok=False, error=error)
+            return
+        with self._lock:
+            self._enfriar_hasta[indice] = time.time() + ENFRIAR_CLAVE_SEG
+            if self._actual == indice:
+                self._actual = (indice + 1) % self.cantidad
+
+
+class PuenteEventos:
+    """El bus de eventos es por proceso: si otro worker cambió algo, avisamos 'resync' a los paneles locales"""
+
+    def __init__(self, db, bus, intervalo=PUENTE_INTERVALO_SEG):
+        self.db = db
+        self.bus = bus
+        self.intervalo = intervalo
+        self._hilo = None
+
+    def iniciar(self):
+        if self._hilo is None or not self._hilo.is_alive():
+            self._hilo = threading.Thread(target=self._vigilar, name="puente-eventos", daemon=True)
+            self._hilo.start()
+
+    def _vigilar(self):
+        while True:
+            time.sleep(self.intervalo)
+            if not self.bus.cantidad_suscriptores():
+                continue
+            try:
+                cambiadas = self.db.sincronizar_versiones()
+            except Exception as e:
+                log.warning(f"⚠️ Puente de eventos: {e}")
+                continue
+            if cambiadas:
+                self.bus.publicar('resync', {'tablas': cambiadas})
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+SERVIDOR DE ESTÁTICOS (FLUTTER WEB)
+===================================
+Carga la carpeta web/ en memoria UNA vez al arrancar:
+- Variantes precomprimidas gzip y brotli (si están en disco se usan, si no se generan)
+- ETag por archivo y por codificación
+- Cache inmutable de larga duración para assets con hash en el nombre
+- Soporte de Range (206) para wasm/fuentes grandes
+Así cada request de estáticos es un lookup en un dict, sin tocar el disco.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+
+from flask import Response
+
+from bitacora import get_logger
+
+log = get_logger('estaticos')
+
+try:
+    import brotli
+except ImportError:  # Opcional: sin brotli servimos gzip
+    brotli = None
+
+# Tipos que vale la pena comprimir (las imágenes ya vienen comprimidas)
+EXTENSIONES_COMPRIMIBLES = {
+    '.html', '.js', '.mjs', '.css', '.json', '.wasm', '.svg', '.txt',
+    '.map', '.ttf', '.otf', '.xml', '.frag',
+}
+TAMANO_MINIMO_COMPRESION = 1024
+
+# Nombres tipo main.3f2a9c1b.js o chunk-0a1b2c3d4e.wasm
+PATRON_HASH = re.compile(r'[.-][0-9a-f]{8,}\.', re.IGNORECASE)
+
+CACHE_INMUTABLE = 'public, max-age=31536000, immutable'
+# Sin hash en el nombre: el navegador revalida siempre (barato, responde 304)
+CACHE_REVALIDAR = 'no-cache'
+
+mimetypes.add_type('application/wasm', '.wasm')
+mimetypes.add_type('text/javascript', '.mjs')
+
+
+class Asset:
+    def __init__(self, ruta, contenido, variantes_disco=None):
+        self.ruta = ruta
+        self.mimetype = mimetypes.guess_type(ruta)[0] or 'application/octet-stream'
+        self.hash = hashlib.sha1(contenido).hexdigest()[:20]
+        self.inmutable = bool(PATRON_HASH.search(os.path.basename(ruta)))
+        self.variantes = {'identity': contenido}
+
+        variantes_disco = variantes_disco or {}
+        extension = os.path.splitext(ruta)[1].lower()
+        if extension in EXTENSIONES_COMPRIMIBLES and len(contenido) >= TAMANO_MINIMO_COMPRESION:
+            comprimido = variantes_disco.get('gzip') or gzip.compress(contenido, compresslevel=9, mtime=0)
+            if len(comprimido) < len(contenido):
+                self.variantes['gzip'] = comprimido
+
+            comprimido = variantes_disco.get('br')
+            if comprimido is None and brotli is not None:
+                comprimido = brotli.compress(contenido, quality=9)
+            if comprimido is not None and len(comprimido) < len(contenido):
+                self.variantes['br'] = comprimido
+
+    def elegir_codificacion(self, request):
+        # Rango sobre datos comprimidos no tiene sentido: pedimos identidad
+        if request.range is not None:
+            return 'identity'
+        for codificacion in ('br', 'gzip'):
+            if codificacion in self.variantes and request.accept_encodings[codificacion] > 0:
+                return codificacion
+        return 'identity'
+
+    def responder(self, request, cache_control=None):
+        codificacion = self.elegir_codificacion(request)
+        cuerpo = self.variantes[codificacion]
+
+        response = Response(cuerpo, mimetype=self.mimetype)
+        response.set_etag(f"{self.hash}-{codificacion}")
+        if codificacion != 'identity':
+            response.headers['Content-Encoding'] = codificacion
+        if len(self.variantes) > 1:
+            response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = cache_control or (CACHE_INMUTABLE if self.inmutable else CACHE_REVALIDAR)
+
+        # Maneja If-None-Match (304) y Range (206) en un solo paso
+        return response.make_conditional(request, accept_ranges=True, complete_length=len(cuerpo))
+
+
+class ManifiestoEstaticos:
+    def __init__(self, carpeta):
+        self.carpeta = carpeta
+        self.assets = {}
+        self.cargar()
+
+    def cargar(self):
+        """Recorre la carpeta y arma el manifiesto en memoria"""
+        assets = {}
+        if os.path.isdir(self.carpeta):
+            for raiz, _, archivos in os.walk(self.carpeta):
+                for nombre in archivos:
+                    # Los .gz/.br se toman como variantes del original
+                    if nombre.endswith(('.gz', '.br')) and nombre[:-3] in archivos:
+                        continue
+                    completo = os.path.join(raiz, nombre)
+                    ruta = os.path.relpath(completo, self.carpeta).replace(os.sep, '/')
+                    with open(completo, 'rb') as f:
+                        contenido = f.read()
+                    assets[ruta] = Asset(ruta, contenido, self._variantes_en_disco(completo))
+        self.assets = assets
+
+        total = sum(len(v) for a in assets.values() for v in a.variantes.values())
+        log.info(f"📦 Estáticos en memoria: {len(assets)} archivos ({total / 1024 / 1024:.1f} MB con variantes)")
+
+    @staticmethod
+    def _variantes_en_disco(completo):
+        variantes = {}
+        for extension, codificacion in (('.gz', 'gzip'), ('.br', 'br')):
+            if os.path.exists(completo + extension):
+                with open(completo + extension, 'rb') as f:
+                    variantes[codificacion] = f.read()
+        return variantes
+
+    def get(self, ruta):
+        return self.assets.get(ruta)
+
+    def servir(self, ruta, request):
+        """Sirve un asset; si no existe, index.html (fallback SPA). None si no hay build"""
+        asset = self.assets.get(ruta)
+        if asset is not None:
+            return asset.responder(request)
+        index = self.assets.get('index.html')
+        if index is not None:
+            # index.html nunca se cachea fuerte: apunta a los assets de la versión actual
+            return index.responder(request, cache_control=CACHE_REVALIDAR)
+        return None
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+BUS DE EVENTOS (PUB/SUB EN PROCESO)
+===================================
+Reparte los cambios de la base de datos (citas, config, mensajes) a todos
+los paneles conectados por /api/events (Server-Sent Events).
+Un evento por cambio real, en vez de N paneles consultando la DB.
+"""
+
+import itertools
+import json
+import queue
+import threading
+
+from bitacora import get_logger
+
+log = get_logger('eventos')
+
+# Cada cuánto mandar un comentario de vida para que proxies no corten la conexión
+HEARTBEAT_SEGUNDOS = 15
+# Eventos pendientes por panel antes de considerarlo "lento"
+MAX_PENDIENTES = 100
+
+
+class BusEventos:
+    def __init__(self, max_pendientes=MAX_PENDIENTES):
+        self.max_pendientes = max_pendientes
+        self._suscriptores = set()
+        # Oyentes en proceso (funciones): reciben cada evento sincrónicamente, sin cola
+        self._oyentes = []
+        self._lock = threading.Lock()
+        self._secuencia = itertools.count(1)
+
+    def suscribir(self):
+        """Registra un panel nuevo y devuelve su cola de eventos"""
+        cola = queue.Queue(maxsize=self.max_pendientes)
+        with self._lock:
+            self._suscriptores.add(cola)
+        return cola
+
+    def desuscribir(self, cola):
+        with self._lock:
+            self._suscriptores.discard(cola)
+
+    def agregar_oyente(self, funcion):
+        """funcion(tipo, datos) se llama en el hilo que publica: tiene que ser rápida"""
+        with self._lock:
+            self._oyentes = self._oyentes + [funcion]
+
+    def cantidad_suscriptores(self):
+        return len(self._suscriptores)
+
+    def publicar(self, tipo, datos=None):
+        """Reparte un evento a todos los suscriptores sin bloquear al que escribe"""
+        for oyente in self._oyentes:
+            try:
+                oyente(tipo, datos)
+            except Exception as e:
+                log.warning(f"⚠️ Oyente de '{tipo}' falló: {e}")
+
+        # Camino rápido: nadie escuchando, no armamos nada
+        if not self._suscriptores:
+            return
+
+        evento = {'id': next(self._secuencia), 'tipo': tipo, 'datos': datos}
+        with self._lock:
+            suscriptores = list(self._suscriptores)
+
+        for cola in suscriptores:
+            try:
+                cola.put_nowait(evento)
+            except queue.Full:
+                # Panel lento: vaciamos su cola y le pedimos que recargue todo
+                self._vaciar(cola)
+                try:
+                    cola.put_nowait({'id': evento['id'], 'tipo': 'resync', 'datos': None})
+                except queue.Full:
+                    pass
+
+    @staticmethod
+    def _vaciar(cola):
+        try:
+            while True:
+                cola.get_nowait()
+        except queue.Empty:
+            pass
+
+    def escuchar(self, heartbeat=HEARTBEAT_SEGUNDOS):
+        """Generador SSE para un panel. Se desuscribe solo al cerrar la conexión"""
+        cola = self.suscribir()
+        try:
+            # Sugerencia de reconexión para EventSource + saludo inicial
+            yield "retry: 3000\n\n"
+            yield formatear_sse({'id': 0, 'tipo': 'hola', 'datos': None})
+            while True:
+                try:
+                    evento = cola.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                yield formatear_sse(evento)
+        finally:
+            self.desuscribir(cola)
+
+
+def formatear_sse(evento):
+    """Serializa un evento al formato text/event-stream"""
+    data = json.dumps(evento['datos'], ensure_ascii=False, default=str)
+    return f"id: {evento['id']}\nevent: {evento['tipo']}\ndata: {data}\n\n"
+
+
+# INSTANCIA GLOBAL (La usan database.py y api_server.py)
+bus = BusEventos()
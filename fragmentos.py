@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+"""
+FRAGMENTOS: AFINIDAD POR REMITENTE ENTRE PROCESOS
+=================================================
+Bajo gunicorn los requests caen en cualquier worker. Para que la sesión de un
+cliente viva en un solo proceso (cache de sesiones sin ir a la DB, turnos en
+orden), el webhook no procesa: reenvía cada lote a un proceso "fragmento"
+elegido por hash consistente del remitente.
+
+- AnilloHash: anillo con nodos virtuales; sumar o sacar un fragmento solo mueve
+  los remitentes de ese fragmento
+- Cada fragmento escucha en un socket unix, se anuncia en la tabla fragmentos
+  con latidos, y tiene su propio despachador (colas por remitente) y cache de sesiones
+- Enrutador (workers HTTP): lee los fragmentos vivos, arma el anillo y envía;
+  si no hay fragmento disponible, procesa local (nunca se pierde un mensaje)
+- Supervisor: proceso propio (forkeado del master de gunicorn, sin hilos) que lanza,
+  reinicia y escala los fragmentos
+- Rebalanceo: cuando cambia la membresía cada fragmento suelta de su cache los
+  remitentes que ya no le tocan
+- Historial escrito por otro proceso (oferta de la lista de espera, recordatorio):
+  Enrutador.soltar le pide al fragmento dueño que suelte esa sesión y la relea
+"""
+
+import bisect
+import hashlib
+import multiprocessing
+import os
+import secrets
+import signal
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+import bitacora
+from bitacora import get_logger, iniciar_traza, cerrar_traza, trace_id_actual
+from metricas import registro
+import perfilador
+import plazos
+
+log = get_logger('fragmentos')
+
+FRAGMENTOS = int(os.environ.get('FRAGMENTOS', '0'))
+NODOS_VIRTUALES = 64
+LATIDO_SEG = 2.0
+# Un fragmento sin latir por más de esto se considera caído
+VIDA_SEG = 3 * LATIDO_SEG
+# Cada cuánto el enrutador relee la membresía
+REFRESCO_SEG = 1.0
+# Se fija en el master antes del fork: workers y fragmentos comparten la misma
+CLAVE = os.environ.setdefault('FRAGMENTOS_CLAVE', secrets.token_hex(16)).encode()
+CARPETA = os.environ.get('FRAGMENTOS_DIR') or os.path.join(tempfile.gettempdir(), f"bot-fragmentos-{os.getpid()}")
+
+ENVIOS = registro.contador(
+    'bot_fragmento_envios_total', 'Lotes enviados a un fragmento (o procesados local)', ('resultado',))
+
+
+def _punto(texto):
+    return int.from_bytes(hashlib.md5(texto.encode('utf-8')).digest()[:8], 'big')
+
+
+class AnilloHash:
+    def __init__(self, nodos=(), virtuales=NODOS_VIRTUALES):
+        self.virtuales = virtuales
+        self._puntos = []
+        self._nodos = []
+        for nodo in nodos:
+            self.agregar(nodo)
+
+    @property
+    def nodos(self):
+        return sorted(set(self._nodos))
+
+    def agregar(self, nodo):
+        for i in range(self.virtuales):
+            punto = _punto(f"{nodo}#{i}")
+            posicion = bisect.bisect(self._puntos, punto)
+            self._puntos.insert(posicion, punto)
+            self._nodos.insert(posicion, nodo)
+
+    def quitar(self, nodo):
+        conservar = [(p, n) for p, n in zip(self._puntos, self._nodos) if n != nodo]
+        self._puntos = [p for p, _ in conservar]
+        self._nodos = [n for _, n in conservar]
+
+    def nodo(self, clave):
+        if not self._puntos:
+            return None
+        posicion = bisect.bisect(self._puntos, _punto(clave)) % len(self._puntos)
+        return self._nodos[posicion]
+
+
+# === REGISTRO DE FRAGMENTOS VIVOS (TABLA COMPARTIDA) ===
+class RegistroFragmentos:
+    def __init__(self, db):
+        self.db = db
+        conn = db.get_connection()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS fragmentos (
+                nodo TEXT PRIMARY KEY,
+                direccion TEXT NOT NULL,
+                pid INTEGER,
+                latido DOUBLE PRECISION NOT NULL
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def anunciar(self, nodo, direccion):
+        with self.db.escritura('fragmento_latido') as conn:
+            conn.execute("INSERT INTO fragmentos (nodo, direccion, pid, latido) VALUES (?, ?, ?, ?) "
+                         "ON CONFLICT(nodo) DO UPDATE SET direccion = excluded.direccion, pid = excluded.pid, "
+                         "latido = excluded.latido", (nodo, direccion, os.getpid(), time.time()))
+
+    def retirar(self, nodo):
+        with self.db.escritura('fragmento_latido') as conn:
+            conn.execute("DELETE FROM fragmentos WHERE nodo = ? AND pid = ?", (nodo, os.getpid()))
+
+    def vivos(self):
+        conn = self.db.get_connection()
+        rows = conn.execute("SELECT nodo, direccion FROM fragmentos WHERE latido > ?",
+                            (time.time() - VIDA_SEG,)).fetchall()
+        conn.close()
+        return {r['nodo']: r['direccion'] for r in rows}
+
+
+# === LADO WORKER HTTP ===
+class Enrutador:
+    def __init__(self, db):
+        self.registro = RegistroFragmentos(db)
+        self._lock = threading.Lock()
+        self._direcciones = {}
+        self._anillo = AnilloHash()
+        self._leido = 0
+        # nodo -> (lock, conexión); Connection no es thread-safe
+        self._conexiones = {}
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._tras_fork)
+
+    def _tras_fork(self):
+        """Los sockets abiertos por el master (soltar_sesion) no se comparten con el hijo:
+        dos procesos escribiendo en la misma conexión mezclan los mensajes"""
+        self._lock = threading.Lock()
+        self._conexiones = {}
+        self._leido = 0
+
+    def _refrescar(self, forzar=False):
+        if not forzar and time.monotonic() - self._leido < REFRESCO_SEG:
+            return
+        vivos = self.registro.vivos()
+        with self._lock:
+            self._leido = time.monotonic()
+            if vivos == self._direcciones:
+                return
+            self._direcciones = vivos
+            self._anillo = AnilloHash(vivos)
+            for nodo in list(self._conexiones):
+                if nodo not in vivos:
+                    self._cerrar(nodo)
+        log.info(f"🧩 Fragmentos vivos: {sorted(vivos)}")
+
+    def _cerrar(self, nodo):
+        _, conexion = self._conexiones.pop(nodo, (None, None))
+        if conexion is not None:
+            try:
+                conexion.close()
+            except OSError:
+                pass
+
+    def _conexion(self, nodo):
+        with self._lock:
+            if nodo not in self._conexiones:
+                conexion = Client(self._direcciones[nodo], family='AF_UNIX', authkey=CLAVE)
+                self._conexiones[nodo] = (threading.Lock(), conexion)
+            return self._conexiones[nodo]
+
+    def enviar(self, remitente, mensajes):
+        """True si el lote quedó en su fragmento; False -> el llamador lo procesa local"""
+        plazo = plazos.plazo_actual.get()
+        paquete = ('turno', remitente, mensajes, trace_id_actual.get(),
+                   plazo.restante() if plazo is not None else plazos.TURNO_PLAZO_SEG, time.time(),
+                   perfilador.marcado.get())
+        enviado = self._mandar(remitente, paquete)
+        ENVIOS.inc(resultado='remoto' if enviado else 'local')
+        return enviado
+
+    def soltar(self, remitente):
+        """El fragmento dueño suelta la sesión cacheada (su historial cambió fuera de él)"""
+        # Sin fragmento disponible no hay cache que soltar: el que lo reemplace arranca vacío
+        return self._mandar(remitente, ('soltar', remitente))
+
+    def _mandar(self, remitente, paquete):
+        for intento in range(2):
+            nodo = None
+            try:
+                self._refrescar(forzar=intento > 0)
+                nodo = self._anillo.nodo(remitente)
+                if nodo is None:
+                    break
+                lock, conexion = self._conexion(nodo)
+                with lock:
+                    conexion.send(paquete)
+                return True
+            except (OSError, EOFError, KeyError) as e:
+                log.warning(f"⚠️ Fragmento de {remitente} no disponible: {e}")
+                with self._lock:
+                    if nodo in self._conexiones:
+                        self._cerrar(nodo)
+        return False
+
+
+# === PROCESOS HIJOS DEL MASTER ===
+def _salir(signum, frame):
+    raise SystemExit(0)
+
+
+def senales_de_hijo():
+    """Proceso forkeado del master de gunicorn: sus handlers no aplican; SIGTERM sale limpio"""
+    for senal in (signal.SIGHUP, signal.SIGQUIT, signal.SIGCHLD, signal.SIGUSR1, signal.SIGUSR2,
+                  signal.SIGTTIN, signal.SIGTTOU, signal.SIGWINCH):
+        signal.signal(senal, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, _salir)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class ProcesoHijo:
+    """Proceso forkeado del master de gunicorn con os.fork.
+
+    Con multiprocessing, los workers que gunicorn forkea después heredan el
+    registro de hijos del master y al salir intentan esperarlos o terminarlos.
+    """
+
+    def __init__(self, objetivo, *args, nombre='hijo'):
+        self.objetivo = objetivo
+        self.args = args
+        self.nombre = nombre
+        self.pid = None
+
+    def iniciar(self):
+        self.pid = os.fork()
+        if self.pid:
+            return
+        codigo = 1
+        try:
+            senales_de_hijo()
+            self.objetivo(*self.args)
+            codigo = 0
+        except SystemExit as e:
+            codigo = e.code if isinstance(e.code, int) else 0
+        except BaseException as e:
+            log.exception(f"❌ Proceso {self.nombre}: {e}")
+        finally:
+            # Sin atexit del master: vaciamos los logs a mano
+            bitacora.detener()
+            os._exit(codigo)
+
+    def vivo(self):
+        if self.pid is None:
+            return False
+        try:
+            return os.waitpid(self.pid, os.WNOHANG)[0] == 0
+        except ChildProcessError:
+            # Ya lo cosechó el master de gunicorn (waitpid(-1))
+            return False
+
+    def terminar(self, espera=30):
+        if not self.vivo():
+            return
+        os.kill(self.pid, signal.SIGTERM)
+        limite = time.monotonic() + espera
+        while self.vivo() and time.monotonic() < limite:
+            time.sleep(0.1)
+
+
+# === LADO FRAGMENTO ===
+def _atender(conexion, despachador, db):
+    try:
+        while True:
+            tipo, *paquete = conexion.recv()
+            if tipo == 'soltar':
+                db.soltar_sesion(paquete[0])
+                continue
+            remitente, mensajes, trace_id, plazo_seg, enviado, marcado = paquete
+            demora = max(0.0, time.time() - enviado)
+            # Trace, plazo y marca de perfil no cruzan procesos solos: se restauran antes de encolar
+            token_traza = iniciar_traza(trace_id)
+            token_plazo = plazos.iniciar_plazo(plazo_seg - demora)
+            token_marca = perfilador.marcado.set(marcado)
+            try:
+                despachador.encolar(remitente, mensajes, time.perf_counter() - demora)
+            finally:
+                perfilador.marcado.reset(token_marca)
+                plazos.soltar_plazo(token_plazo)
+                cerrar_traza(token_traza)
+    except EOFError:
+        pass
+    except Exception as e:
+        log.exception(f"❌ Conexión de fragmento: {e}")
+    finally:
+        conexion.close()
+
+
+def _latir(nodo, direccion, registro, db):
+    miembros = None
+    while True:
+        time.sleep(LATIDO_SEG)
+        try:
+            registro.anunciar(nodo, direccion)
+            vivos = set(registro.vivos())
+            if vivos != miembros:
+                # Rebalanceo: soltamos las sesiones de remitentes que ahora son de otro
+                anillo = AnilloHash(vivos)
+                sueltas = db.podar_cache_sesiones(lambda cliente: anillo.nodo(cliente) == nodo)
+                if miembros is not None:
+                    log.info(f"🧩 Rebalanceo en {nodo}: {sorted(vivos)}, {sueltas} sesiones soltadas")
+                miembros = vivos
+        except Exception as e:
+            log.warning(f"⚠️ Latido de {nodo}: {e}")
+
+
+def ejecutar_fragmento(nodo, db, despachador, carpeta=CARPETA):
+    """Proceso fragmento: escucha lotes en su socket y los procesa con su despachador"""
+    os.makedirs(carpeta, exist_ok=True)
+    direccion = os.path.join(carpeta, f"{nodo}.sock")
+    if os.path.exists(direccion):
+        os.unlink(direccion)
+
+    senales_de_hijo()
+
+    db.activar_cache_sesiones()
+    registro = RegistroFragmentos(db)
+    listener = Listener(direccion, family='AF_UNIX', authkey=CLAVE)
+    registro.anunciar(nodo, direccion)
+    threading.Thread(target=_latir, args=(nodo, direccion, registro, db), name="latido", daemon=True).start()
+    log.info(f"🧩 Fragmento {nodo} escuchando (pid {os.getpid()})")
+    try:
+        while True:
+            try:
+                conexion = listener.accept()
+            except (OSError, EOFError) as e:
+                log.warning(f"⚠️ accept en {nodo}: {e}")
+                continue
+            threading.Thread(target=_atender, args=(conexion, despachador, db), daemon=True).start()
+    finally:
+        registro.retirar(nodo)
+        listener.close()
+        # Los turnos ya aceptados se terminan antes de salir
+        despachador.esperar()
+        log.info(f"🧩 Fragmento {nodo} detenido")
+
+
+# === LADO MASTER DE GUNICORN ===
+class Supervisor:
+    """Proceso aparte que lanza N fragmentos, reinicia los que mueren y escala con los workers.
+
+    El master de gunicorn forkea workers en cualquier momento: si tuviera hilos propios
+    (un vigilante), un hijo podría nacer con un lock tomado. Por eso la vigilancia vive
+    en un proceso sin hilos, y el master solo le manda la cantidad deseada por un pipe.
+    """
+
+    def __init__(self, db, despachador, cantidad, carpeta=CARPETA):
+        self.db = db
+        self.despachador = despachador
+        self.cantidad = max(1, cantidad)
+        self.carpeta = carpeta
+        self._contexto = multiprocessing.get_context('fork')
+        self._proceso = None
+        self._ordenes = None
+
+    def iniciar(self):
+        recibir, self._ordenes = multiprocessing.Pipe(duplex=False)
+        self._proceso = ProcesoHijo(self._supervisar, recibir, nombre="supervisor-fragmentos")
+        self._proceso.iniciar()
+        recibir.close()
+        log.info(f"🧩 Supervisor (pid {self._proceso.pid}): {self.cantidad} fragmentos en {self.carpeta}")
+
+    def escalar(self, cantidad):
+        self.cantidad = max(1, cantidad)
+        if self._ordenes is not None:
+            try:
+                self._ordenes.send(self.cantidad)
+            except OSError as e:
+                log.warning(f"⚠️ Supervisor de fragmentos no disponible: {e}")
+
+    def detener(self):
+        if self._proceso is not None:
+            # Los fragmentos terminan sus turnos encolados antes de salir
+            self._proceso.terminar(espera=60)
+
+    # === DENTRO DEL PROCESO SUPERVISOR ===
+    def _lanzar(self, procesos, nodo):
+        proceso = self._contexto.Process(target=ejecutar_fragmento, name=f"fragmento-{nodo}",
+                                         args=(nodo, self.db, self.despachador, self.carpeta), daemon=True)
+        proceso.start()
+        procesos[nodo] = proceso
+
+    def _escalar(self, procesos, cantidad):
+        deseados = {f"f{i}" for i in range(cantidad)}
+        for nodo in list(procesos):
+            if nodo not in deseados:
+                procesos.pop(nodo).terminate()
+        for nodo in sorted(deseados - set(procesos)):
+            self._lanzar(procesos, nodo)
+
+    def _supervisar(self, ordenes):
+        procesos = {}
+        try:
+            self._escalar(procesos, self.cantidad)
+            while True:
+                # La espera del latido es la del pipe: un TTIN/TTOU se atiende al toque
+                if ordenes.poll(LATIDO_SEG):
+                    try:
+                        self._escalar(procesos, ordenes.recv())
+                    except EOFError:
+                        return
+                for nodo, proceso in list(procesos.items()):
+                    if not proceso.is_alive():
+                        log.warning(f"⚠️ Fragmento {nodo} murió (código {proceso.exitcode}), reiniciando")
+                        self._lanzar(procesos, nodo)
+        finally:
+            for proceso in procesos.values():
+                proceso.terminate()
+            for proceso in procesos.values():
+                proceso.join(timeout=30)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+GUNICORN (PRODUCCIÓN)
+=====================
+gunicorn -c gunicorn.conf.py api_server:app
+
+- gthread: cada worker atiende con hilos (el webhook encola y vuelve; /api/events ocupa un hilo por panel)
+- preload_app: la app (y el esquema de la DB) se carga una sola vez en el master antes del fork
+- ESTADO_COMPARTIDO=1: versiones, rotación de keys y buckets en SQLite (ver estado_compartido.py)
+- FRAGMENTOS: procesos que atienden los turnos con afinidad por remitente (ver fragmentos.py);
+  por defecto uno por worker, 0 los desactiva (cada worker procesa lo que recibe)
+- Tareas de fondo (recordatorios, barrido de sesiones, respaldos): una sola vez, en un proceso
+  propio. El master no arranca hilos: forkea workers en cualquier momento y un hijo nacido
+  con un lock tomado (métricas, logging, pool de la DB) se traba
+"""
+
+import multiprocessing
+import os
+
+# Antes del preload: database.py lo lee al importarse
+os.environ.setdefault('ESTADO_COMPARTIDO', '1')
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+preload_app = True
+os.environ.setdefault('FRAGMENTOS', str(workers))
+
+# Un turno con plazo de 25s + envío entra holgado; el heartbeat de gthread no corta streams SSE
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+# Los logs son JSON propios (bitacora.py); gunicorn solo reporta errores
+accesslog = None
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+
+
+def when_ready(server):
+    # Master: supervisor de fragmentos y tareas de fondo, cada uno en su proceso forkeado de la app precargada
+    import api_server
+    import fragmentos
+    if fragmentos.FRAGMENTOS > 0:
+        server.fragmentos = fragmentos.Supervisor(api_server.db, api_server.despachador, fragmentos.FRAGMENTOS)
+        server.fragmentos.iniciar()
+    server.tareas = fragmentos.ProcesoHijo(api_server.ejecutar_tareas_fondo, nombre="tareas-fondo")
+    server.tareas.iniciar()
+
+
+def nworkers_changed(server, new_value, old_value):
+    # TTIN/TTOU: los fragmentos acompañan a los workers; el anillo rebalancea solo
+    if getattr(server, 'fragmentos', None) is not None and old_value is not None:
+        server.fragmentos.escalar(new_value)
+
+
+def on_exit(server):
+    if getattr(server, 'tareas', None) is not None:
+        server.tareas.terminar(espera=graceful_timeout)
+    if getattr(server, 'fragmentos', None) is not None:
+        server.fragmentos.detener()
+
+
+def post_fork(server, worker):
+    # Los hilos (puente de eventos, despachador) no sobreviven al fork: se arrancan en cada worker
+    import api_server
+    api_server.iniciar_worker()
+
+
+def worker_exit(server, worker):
+    # Terminar los turnos ya encolados antes de salir (graceful_timeout es el tope)
+    import api_server
+    api_server.despachador.esperar()
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+IDEMPOTENCIA DEL WEBHOOK
+========================
+WaSender reintenta cuando tardamos en responder: sin esto cada reintento
+dispara otro agregar_mensaje, otra llamada a Groq y otro mensaje saliente.
+
+Clave del evento:
+- ID del mensaje del proveedor si viene
+- si no: hash de (remitente, timestamp, contenido)
+- sin ID ni timestamp no hay clave: no se puede distinguir un reintento de un
+  "ok" repetido a propósito, y perder un mensaje es peor que responder dos veces
+
+Set en memoria con vencimiento (O(1)) respaldado por la tabla webhook_eventos,
+así los duplicados siguen descartados después de un reinicio.
+
+Al llegar, el evento solo se reserva en memoria; la tabla se escribe recién
+cuando el turno terminó (confirmar). Si el proceso muere con el turno en la
+cola, el reintento de WaSender después del reinicio se procesa en vez de
+descartarse como repetido.
+"""
+
+import collections
+import hashlib
+import os
+import threading
+import time
+
+from bitacora import get_logger
+from metricas import registro
+
+log = get_logger('idempotencia')
+
+IDEMPOTENCIA_TTL_SEG = int(os.environ.get('IDEMPOTENCIA_TTL_SEG', str(24 * 3600)))
+MAX_EN_MEMORIA = 100000
+# Cada cuántos registros nuevos purgamos los vencidos de la tabla
+PURGAR_CADA = 1000
+
+DUPLICADOS = registro.contador(
+    'bot_webhook_duplicados_total', 'Eventos de webhook descartados por repetidos', ('origen',))
+
+
+def clave_evento(remitente, mensaje, msg_id=None, timestamp=None):
+    """Clave de idempotencia del evento; None si no hay con qué reconocer un reintento"""
+    if msg_id:
+        return f"id:{msg_id}"
+    if not timestamp:
+        return None
+    resumen = hashlib.sha1(f"{remitente}|{timestamp}|{mensaje}".encode('utf-8')).hexdigest()
+    return f"h:{resumen}"
+
+
+class Deduplicador:
+    def __init__(self, db, ttl=IDEMPOTENCIA_TTL_SEG, max_memoria=MAX_EN_MEMORIA):
+        self.db = db
+        self.ttl = ttl
+        self.max_memoria = max_memoria
+        # clave -> vencimiento, en orden de llegada (el más viejo primero)
+        self._vistos = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._nuevos = 0
+        self._precargar()
+
+    def _precargar(self):
+        try:
+            for clave, expira in sorted(self.db.cargar_eventos_webhook(time.time()), key=lambda e: e[1]):
+                self._vistos[clave] = expira
+            if self._vistos:
+                log.info(f"♻️ Idempotencia: {len(self._vistos)} eventos recientes precargados")
+        except Exception as e:
+            log.warning(f"⚠️ No se pudieron precargar eventos de webhook: {e}")
+
+    def _vencer(self, ahora):
+        while self._vistos:
+            clave, expira = next(iter(self._vistos.items()))
+            if expira > ahora and len(self._vistos) <= self.max_memoria:
+                break
+            self._vistos.popitem(last=False)
+
+    def es_duplicado(self, clave):
+        """Reserva el evento en memoria y dice si ya lo habíamos visto (no escribe la tabla)"""
+        ahora = time.time()
+        with self._lock:
+            self._vencer(ahora)
+            if clave in self._vistos:
+                DUPLICADOS.inc(origen='memoria')
+                return True
+            self._vistos[clave] = ahora + self.ttl
+
+        # La tabla tiene los ya procesados por otros procesos (u otro arranque)
+        try:
+            visto = self.db.existe_evento_webhook(clave, ahora)
+        except Exception as e:
+            # Ante duda procesamos: perder un mensaje es peor que responder dos veces
+            log.warning(f"⚠️ Idempotencia sin DB: {e}")
+            return False
+        if visto:
+            DUPLICADOS.inc(origen='db')
+        return visto
+
+    def confirmar(self, clave):
+        """El turno del evento terminó: desde ahora el descarte sobrevive a reinicios"""
+        if not clave:
+            return
+        ahora = time.time()
+        with self._lock:
+            self._vistos[clave] = ahora + self.ttl
+        try:
+            self.db.registrar_evento_webhook(clave, ahora + self.ttl)
+        except Exception as e:
+            log.warning(f"⚠️ No se pudo registrar el evento de webhook: {e}")
+            return
+
+        self._nuevos += 1
+        if self._nuevos % PURGAR_CADA == 0:
+            try:
+                self.db.purgar_eventos_webhook(ahora)
+            except Exception as e:
+                log.warning(f"⚠️ No se pudieron purgar eventos de webhook: {e}")
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+LISTA DE ESPERA
+===============
+Clientes que querían un turno ocupado (día [AGOTADO] o reserva que perdió la
+carrera) quedan anotados por (fecha, rango de horas, servicio). Cuando se
+libera un turno (cita_eliminada) se les ofrece por WhatsApp.
+
+- Índice (fecha, estado, hora_desde, hora_hasta, servicio): el matcher baja por
+  el B-tree hasta la fecha y las que empiezan antes de la hora, no recorre la
+  tabla (cientos de anotados en un día cargado siguen siendo una búsqueda)
+- Se ofrece a los primeros OFERTAS_POR_TURNO por orden de llegada; gana el
+  primero que confirma: la reserva pasa por db.agregar_cita como cualquier
+  otra y la constraint del turno decide. Los demás vuelven a esperar
+- La oferta vence a los OFERTA_VIGENCIA_SEG (perezoso: se revisa en la próxima
+  liberación y al leerla en el turno del cliente)
+- El servicio se guarda para la reserva, no filtra: hay un solo sillón
+
+El oyente del bus solo encola; las escrituras y los envíos van en un hilo
+propio que arranca con el primer evento (cada worker de gunicorn atiende
+los turnos que se liberan en su proceso). La oferta queda en el historial
+del cliente: con fragmentos, el dueño de su sesión la suelta para releerla.
+"""
+
+import collections
+import os
+import queue
+import threading
+import time
+
+from bitacora import get_logger, iniciar_traza, cerrar_traza
+from metricas import registro
+from recordatorios import momento_cita
+
+log = get_logger('lista_espera')
+
+OFERTAS_POR_TURNO = int(os.environ.get('LISTA_ESPERA_OFERTAS', '3'))
+OFERTA_VIGENCIA_SEG = 30 * 60
+MAX_LISTADO = 500
+ACTIVOS = "('esperando', 'ofrecido')"
+MENSAJE = ("🔔 ¡Hola {nombre}! Se liberó un turno el {fecha} a las {hora} hs. "
+           "¿Lo querés? Respondé SÍ y te lo reservo (se lo lleva el primero que confirma) 💈")
+# Tipos de columna que cambian entre motores
+DIALECTO = {
+    'sqlite': {'id': "INTEGER PRIMARY KEY AUTOINCREMENT", 'real': "REAL"},
+    'postgres': {'id': "BIGSERIAL PRIMARY KEY", 'real': "DOUBLE PRECISION"},
+}
+
+LISTA_ESPERA_TOTAL = registro.contador(
+    'bot_lista_espera_total', 'Movimientos de la lista de espera', ('evento',))
+
+Oferta = collections.namedtuple('Oferta', 'id fecha hora nombre servicio')
+
+
+def crear_tablas(cursor):
+    """Dentro de init_db (SQLite y PostgreSQL)"""
+    tipos = DIALECTO[getattr(cursor, 'dialecto', 'sqlite')]
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS lista_espera (
+            id {tipos['id']},
+            cliente_id TEXT NOT NULL,
+            nombre TEXT,
+            servicio TEXT,
+            fecha TEXT NOT NULL,
+            hora_desde TEXT NOT NULL,
+            hora_hasta TEXT NOT NULL,
+            estado TEXT NOT NULL DEFAULT 'esperando',
+            origen TEXT,
+            creado {tipos['real']} NOT NULL,
+            ofrecido_hora TEXT,
+            ofrecido_en {tipos['real']}
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_lista_espera_turno "
+                   "ON lista_espera (fecha, estado, hora_desde, hora_hasta, servicio)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_lista_espera_cliente ON lista_espera (cliente_id, estado)")
+    # Un mismo pedido activo por cliente: volver a pedirlo no duplica
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_lista_espera_unica "
+                   "ON lista_espera (cliente_id, fecha, hora_desde, hora_hasta) "
+                   f"WHERE estado IN {ACTIVOS}")
+
+
+class ListaEspera:
+    def __init__(self, db, bus, enviar, soltar_sesion=None):
+        self.db = db
+        # enviar(to, text) -> bool, el mismo envío del bot
+        self.enviar = enviar
+        # soltar_sesion(cliente): el proceso que cachea su sesión la relee de la DB (fragmentos)
+        self.soltar_sesion = soltar_sesion
+        self._cola = queue.Queue()
+        self._lock = threading.Lock()
+        self._hilo = None
+        bus.agregar_oyente(self._evento)
+
+    # === ANOTAR / CONSULTAR ===
+    def anotar(self, cliente_id, fecha, hora_desde, hora_hasta=None, nombre=None, servicio=None, origen='bot'):
+        """True si quedó anotado (False si ya estaba esperando lo mismo)"""
+        hora_hasta = hora_hasta or hora_desde
+        if hora_hasta < hora_desde:
+            hora_desde, hora_hasta = hora_hasta, hora_desde
+        with self.db.escritura('anotar_lista_espera') as conn:
+            cursor = conn.execute('''
+                INSERT INTO lista_espera (cliente_id, nombre, servicio, fecha, hora_desde, hora_hasta, origen, creado)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT DO NOTHING
+            ''', (cliente_id, nombre, servicio, fecha, hora_desde[:5], hora_hasta[:5], origen, time.time()))
+            nuevo = cursor.rowcount == 1
+        if nuevo:
+            LISTA_ESPERA_TOTAL.inc(evento='anotado')
+            log.info(f"📝 {cliente_id} en lista de espera: {fecha} {hora_desde}-{hora_hasta} ({origen})")
+        return nuevo
+
+    def listar(self, fecha=None):
+        conn = self.db.get_connection()
+        if fecha:
+            rows = conn.execute(f"SELECT * FROM lista_espera WHERE fecha = ? AND estado IN {ACTIVOS} "
+                                "ORDER BY hora_desde, id LIMIT ?", (fecha, MAX_LISTADO)).fetchall()
+        else:
+            rows = conn.execute(f"SELECT * FROM lista_espera WHERE estado IN {ACTIVOS} "
+                                "ORDER BY fecha, hora_desde, id LIMIT ?", (MAX_LISTADO,)).fetchall()
+        conn.close()
+        return [dict(r) for r in rows]
+
+    def oferta_pendiente(self, cliente_id):
+        """Turno ofrecido a este cliente y todavía vigente (o None); una lectura por índice"""
+        conn = self.db.get_connection()
+        row = conn.execute('''
+            SELECT id, fecha, ofrecido_hora, nombre, servicio FROM lista_espera
+            WHERE cliente_id = ? AND estado = 'ofrecido' AND ofrecido_en > ?
+            ORDER BY ofrecido_en DESC LIMIT 1
+        ''', (cliente_id, time.time() - OFERTA_VIGENCIA_SEG)).fetchone()
+        conn.close()
+        return Oferta(row['id'], row['fecha'], row['ofrecido_hora'], row['nombre'], row['servicio']) if row else None
+
+    # === EVENTOS ===
+    def _evento(self, tipo, datos):
+        if tipo in ('cita_eliminada', 'cita_agregada'):
+            self._iniciar()
+            self._cola.put((tipo, datos))
+
+    def _iniciar(self):
+        with self._lock:
+            if self._hilo is None or not self._hilo.is_alive():
+                self._hilo = threading.Thread(target=self._trabajar, name="lista-espera", daemon=True)
+                self._hilo.start()
+
+    def _trabajar(self):
+        while True:
+            tipo, datos = self._cola.get()
+            traza = iniciar_traza()
+            try:
+                if tipo == 'cita_eliminada':
+                    self.ofrecer(datos['fecha'], datos['hora'])
+                else:
+                    self._reservado(datos['telefono'], datos['fecha'], datos['hora'])
+            except Exception as e:
+                log.exception(f"❌ Error en lista de espera: {e}")
+            finally:
+                cerrar_traza(traza)
+
+    # === MATCHER ===
+    def ofrecer(self, fecha, hora):
+        """Turno liberado -> oferta a los primeros que lo esperan; devuelve a cuántos se les mandó"""
+        hora = hora[:5]
+        momento = momento_cita(fecha, hora)
+        if momento is None or momento <= time.time():
+            return 0
+        with self.db.escritura('ofrecer_lista_espera') as conn:
+            # Ofertas vencidas del día: vuelven a esperar
+            conn.execute("UPDATE lista_espera SET estado = 'esperando', ofrecido_hora = NULL, ofrecido_en = NULL "
+                         "WHERE fecha = ? AND estado = 'ofrecido' AND ofrecido_en <= ?",
+                         (fecha, time.time() - OFERTA_VIGENCIA_SEG))
+            # Si ya lo reservó alguien más, no hay nada que ofrecer
+            if conn.execute("SELECT count(*) FROM citas WHERE fecha = ? AND hora = ?", (fecha, hora)).fetchone()[0]:
+                return 0
+            candidatos = conn.execute('''
+                SELECT id, cliente_id, nombre FROM lista_espera
+                WHERE fecha = ? AND estado = 'esperando' AND hora_desde <= ? AND hora_hasta >= ?
+                ORDER BY id LIMIT ?
+            ''', (fecha, hora, hora, OFERTAS_POR_TURNO)).fetchall()
+            ofrecidos = []
+            for c in candidatos:
+                # Condicional: otro proceso pudo ofrecerle otro turno recién
+                cursor = conn.execute("UPDATE lista_espera SET estado = 'ofrecido', ofrecido_hora = ?, ofrecido_en = ? "
+                                      "WHERE id = ? AND estado = 'esperando'", (hora, time.time(), c['id']))
+                if cursor.rowcount == 1:
+                    ofrecidos.append((c['cliente_id'], c['nombre']))
+
+        for cliente_id, nombre in ofrecidos:
+            texto = MENSAJE.format(nombre=(nombre or '').title() or 'de nuevo', fecha=fecha, hora=hora)
+            # Al historial: el "SÍ" del cliente llega con la oferta en contexto
+            self.db.agregar_mensaje(cliente_id, texto, es_bot=True)
+            if self.soltar_sesion is not None:
+                self.soltar_sesion(cliente_id)
+            LISTA_ESPERA_TOTAL.inc(evento='ofrecido' if self.enviar(cliente_id, texto) else 'error_envio')
+        if ofrecidos:
+            log.info(f"🔔 Turno {fecha} {hora} liberado: ofrecido a {len(ofrecidos)} en espera")
+        return len(ofrecidos)
+
+    def _reservado(self, cliente_id, fecha, hora):
+        hora = hora[:5]
+        with self.db.escritura('reservado_lista_espera') as conn:
+            # El que reservó sale de la lista (lo que pidió para ese turno)
+            ganador = conn.execute(f'''
+                UPDATE lista_espera SET estado = 'reservado'
+                WHERE cliente_id = ? AND fecha = ? AND estado IN {ACTIVOS} AND hora_desde <= ? AND hora_hasta >= ?
+            ''', (cliente_id, fecha, hora, hora)).rowcount
+            # Los demás a los que se les ofreció este turno lo perdieron: vuelven a esperar
+            conn.execute("UPDATE lista_espera SET estado = 'esperando', ofrecido_hora = NULL, ofrecido_en = NULL "
+                         "WHERE fecha = ? AND estado = 'ofrecido' AND ofrecido_hora = ?", (fecha, hora))
+        if ganador:
+            LISTA_ESPERA_TOTAL.inc(evento='reservado')
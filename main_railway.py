@@ -4,6 +4,9 @@ SERVIDOR PARA RAILWAY
 ======================
 Solo ejecuta el API Server
 El bot se ejecuta en una tarea separada
+
+FLASK_ENV=production -> gunicorn multi-worker (gunicorn.conf.py)
+si no             -> servidor de desarrollo de Flask
 """
 
 import os
@@ -12,12 +15,17 @@ from dotenv import load_dotenv
 # Cargar variables de entorno
 load_dotenv()
 
-# Importar la app de api_server
-from api_server import app
-
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     debug = os.environ.get('FLASK_ENV') != 'production'
+
+    if not debug:
+        # Reemplaza este proceso: gunicorn importa la app en su master (preload)
+        print(f"🚀 Producción: gunicorn en puerto {port}")
+        os.execvp('gunicorn', ['gunicorn', '-c', 'gunicorn.conf.py', 'api_server:app'])
+
+    # Importar la app de api_server
+    from api_server import app, iniciar_tareas_fondo
     
     print("\n" + "="*60)
     print("  🌐 SERVIDOR API - Railway")
@@ -27,4 +35,8 @@ if __name__ == '__main__':
     print(f"  URL: https://tuapp.railway.app")
     print("="*60 + "\n")
     
+    # Con debug, el reloader de Werkzeug importa la app en dos procesos: las tareas de fondo
+    # (recordatorios, barrido, respaldos) van solo en el hijo que sirve, no en el vigilante
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        iniciar_tareas_fondo()
     app.run(host='0.0.0.0', port=port, debug=debug)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+MÉTRICAS (FORMATO PROMETHEUS)
+=============================
+Contadores, histogramas de latencia y medidores en memoria, expuestos en /metrics.
+Cada observación es un bisect + suma bajo un lock: se puede dejar siempre prendido.
+"""
+
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# Buckets de latencia en segundos (desde SQLite rápido hasta Groq lento)
+BUCKETS_LATENCIA = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _formatear_etiquetas(nombres, valores, extra=None):
+    pares = list(zip(nombres, valores))
+    if extra:
+        pares.append(extra)
+    if not pares:
+        return ""
+    # Escapes del formato de exposición: una etiqueta con comillas no rompe todo /metrics
+    cuerpo = ",".join(f'{k}="{_escapar(v)}"' for k, v in pares)
+    return "{" + cuerpo + "}"
+
+
+class _Metrica:
+    tipo = ""
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._lock = threading.Lock()
+
+    def _clave(self, labels):
+        return tuple(labels.get(e, "") for e in self.etiquetas)
+
+    def exponer(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} {self.tipo}"]
+        lineas.extend(self._muestras())
+        return "\n".join(lineas)
+
+
+class Contador(_Metrica):
+    tipo = "counter"
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        super().__init__(nombre, ayuda, etiquetas)
+        self._valores = {}
+
+    def inc(self, valor=1, **labels):
+        clave = self._clave(labels)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + valor
+
+    def valor(self, **labels):
+        return self._valores.get(self._clave(labels), 0)
+
+    def _muestras(self):
+        with self._lock:
+            items = list(self._valores.items())
+        return [f"{self.nombre}{_formatear_etiquetas(self.etiquetas, k)} {v}" for k, v in items]
+
+
+class Medidor(_Metrica):
+    """Gauge: valor actual (o calculado al exponer con una función)"""
+    tipo = "gauge"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), funcion=None):
+        super().__init__(nombre, ayuda, etiquetas)
+        self._valores = {}
+        self._funcion = funcion
+
+    def set(self, valor, **labels):
+        with self._lock:
+            self._valores[self._clave(labels)] = valor
+
+    def inc(self, valor=1, **labels):
+        clave = self._clave(labels)
+        with self._lock:
+            self._valores[clave] = self._valores.get(clave, 0) + valor
+
+    def dec(self, valor=1, **labels):
+        self.inc(-valor, **labels)
+
+    def valor(self, **labels):
+        if self._funcion is not None:
+            return self._funcion()
+        return self._valores.get(self._clave(labels), 0)
+
+    def _muestras(self):
+        if self._funcion is not None:
+            return [f"{self.nombre} {self._funcion()}"]
+        with self._lock:
+            items = list(self._valores.items())
+        return [f"{self.nombre}{_formatear_etiquetas(self.etiquetas, k)} {v}" for k, v in items]
+
+
+class Histograma(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_LATENCIA):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.buckets = tuple(buckets)
+        # clave -> [conteos por bucket (+Inf al final), suma, cantidad]
+        self._series = {}
+
+    def observe(self, valor, **labels):
+        clave = self._clave(labels)
+        indice = bisect.bisect_left(self.buckets, valor)
+        with self._lock:
+            serie = self._series.get(clave)
+            if serie is None:
+                serie = self._series[clave] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            serie[0][indice] += 1
+            serie[1] += valor
+            serie[2] += 1
+
+    def _muestras(self):
+        with self._lock:
+            items = [(k, (list(s[0]), s[1], s[2])) for k, s in self._series.items()]
+        lineas = []
+        for clave, (conteos, suma, cantidad) in items:
+            acumulado = 0
+            for limite, conteo in zip(self.buckets + ('+Inf',), conteos):
+                acumulado += conteo
+                etiquetas = _formatear_etiquetas(self.etiquetas, clave, ('le', limite))
+                lineas.append(f"{self.nombre}_bucket{etiquetas} {acumulado}")
+            etiquetas = _formatear_etiquetas(self.etiquetas, clave)
+            lineas.append(f"{self.nombre}_sum{etiquetas} {suma}")
+            lineas.append(f"{self.nombre}_count{etiquetas} {cantidad}")
+        return lineas
+
+
+class Registro:
+    def __init__(self):
+        self._metricas = {}
+
+    def _registrar(self, metrica):
+        # Idempotente: si ya existe (ej. recarga de módulo) devolvemos la misma
+        return self._metricas.setdefault(metrica.nombre, metrica)
+
+    def contador(self, nombre, ayuda, etiquetas=()):
+        return self._registrar(Contador(nombre, ayuda, etiquetas))
+
+    def medidor(self, nombre, ayuda, etiquetas=(), funcion=None):
+        return self._registrar(Medidor(nombre, ayuda, etiquetas, funcion))
+
+    def histograma(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_LATENCIA):
+        return self._registrar(Histograma(nombre, ayuda, etiquetas, buckets))
+
+    def exponer(self):
+        """Texto en formato de exposición de Prometheus (text/plain; version=0.0.4)"""
+        return "\n".join(m.exponer() for m in self._metricas.values()) + "\n"
+
+
+# INSTANCIA GLOBAL
+registro = Registro()
+
+# === MÉTRICAS DEL BOT ===
+ETAPAS = registro.histograma(
+    'bot_etapa_segundos', 'Latencia por etapa del turno (webhook -> respuesta)', ('etapa',))
+LLM_LATENCIA = registro.histograma(
+    'bot_llm_segundos', 'Latencia de cada llamada a Groq por API key', ('clave',))
+DB_ESCRITURA = registro.histograma(
+    'bot_db_escritura_segundos', 'Duración total de escrituras en la DB', ('operacion',))
+DB_ESPERA_LOCK = registro.histograma(
+    'bot_db_espera_lock_segundos', 'Espera por el lock de escritura (SQLite) o por una conexión del pool (PostgreSQL)', ('operacion',))
+
+MENSAJES = registro.contador(
+    'bot_mensajes_total', 'Mensajes registrados en el historial', ('origen',))
+LLM_LLAMADAS = registro.contador(
+    'bot_llm_llamadas_total', 'Llamadas a Groq por API key y resultado', ('clave', 'resultado'))
+RESPUESTAS_RAPIDAS = registro.contador(
+    'bot_respuestas_rapidas_total', 'Turnos resueltos sin llamar al LLM', ('motivo',))
+CONFLICTOS_RESERVA = registro.contador(
+    'bot_conflictos_reserva_total', 'Reservas rechazadas porque el horario ya estaba ocupado')
+
+TURNOS_EN_CURSO = registro.medidor(
+    'bot_turnos_en_curso', 'Webhooks siendo procesados ahora mismo')
+
+
+@contextmanager
+def cronometrar(histograma, **labels):
+    """Observa en el histograma la duración del bloque"""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        histograma.observe(time.perf_counter() - inicio, **labels)
+
+
+# Desglose por etapa del request actual (solo lo activa el perfilador)
+etapas_request = contextvars.ContextVar('etapas_request', default=None)
+
+
+def observar_etapa(etapa, segundos):
+    ETAPAS.observe(segundos, etapa=etapa)
+    desglose = etapas_request.get()
+    if desglose is not None:
+        desglose[etapa] = desglose.get(etapa, 0.0) + segundos
+
+
+@contextmanager
+def medir(etapa):
+    """Mide una etapa del turno: with medir('carga_sesion'): ..."""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        observar_etapa(etapa, time.perf_counter() - inicio)
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+PERFILADOR OPCIONAL DE REQUESTS
+===============================
+Apagado por defecto: si PROFILING no está activo no se registra ningún hook
+ni ruta, así que no cuesta nada.
+
+Con PROFILING=1 se perfila con cProfile:
+- una fracción de requests (PROFILE_SAMPLE_RATE, default 0.01)
+- todo request con el header X-Profile: 1
+- todo webhook cuyo cuerpo mencione un remitente de PROFILE_REMITENTES (coma separados)
+
+El webhook solo encola: lo caro (DB, Groq, WaSender) corre después en el turno
+del despachador. Un webhook elegido no se perfila a sí mismo, marca sus turnos
+(contextvar, y por el socket con fragmentos) y turno() perfila esos.
+
+Los .prof van a un anillo acotado en disco (PROFILE_DIR, PROFILE_MAX archivos).
+Rutas de admin (header X-Admin-Token; sin ADMIN_TOKEN definido responden 404):
+  GET /admin/perfiles                  lista perfiles + los N requests más lentos con desglose por etapa
+  GET /admin/perfiles/<archivo>        descarga el .prof (?formato=texto para ver el top de pstats)
+"""
+
+import collections
+import contextlib
+import hmac
+import contextvars
+import cProfile
+import io
+import os
+import pstats
+import random
+import re
+import threading
+import time
+from functools import wraps
+
+from flask import g, jsonify, request, send_from_directory, Response
+
+from bitacora import get_logger
+from metricas import etapas_request
+
+log = get_logger('perfilador')
+
+PROFILING = os.environ.get('PROFILING', '').lower() in ('1', 'true', 'si')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0.01'))
+PROFILE_HEADER = os.environ.get('PROFILE_HEADER', 'X-Profile')
+PROFILE_REMITENTES = [r.strip() for r in os.environ.get('PROFILE_REMITENTES', '').split(',') if r.strip()]
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(os.getcwd(), 'perfiles'))
+PROFILE_MAX = int(os.environ.get('PROFILE_MAX', '50'))
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+# Cuántos requests recientes recordamos para el ranking de lentos
+MAX_RECIENTES = 500
+NOMBRE_VALIDO = re.compile(r'^[\w.-]+\.prof$')
+RUTA_WEBHOOK = '/wasender/webhook'
+
+# El request que encoló el turno fue elegido para perfilar (viaja con el contexto al despachador)
+marcado = contextvars.ContextVar('perfil_marcado', default=False)
+# Perfilador instalado en este proceso (None = PROFILING apagado)
+_activo = None
+
+
+def requiere_admin(vista):
+    @wraps(vista)
+    def envoltura(*args, **kwargs):
+        # Sin token configurado no hay admin: los perfiles muestran código y datos de requests
+        if not ADMIN_TOKEN:
+            return jsonify({'error': 'no encontrado'}), 404
+        if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+            return jsonify({'error': 'no autorizado'}), 401
+        return vista(*args, **kwargs)
+    return envoltura
+
+
+class Perfilador:
+    def __init__(self, carpeta=PROFILE_DIR, maximo=PROFILE_MAX, tasa=PROFILE_SAMPLE_RATE,
+                 remitentes=PROFILE_REMITENTES):
+        self.carpeta = carpeta
+        self.maximo = maximo
+        self.tasa = tasa
+        self.remitentes = [r.encode() for r in remitentes]
+        self.recientes = collections.deque(maxlen=MAX_RECIENTES)
+        # cProfile no soporta dos perfiles activos a la vez: uno por vez, el resto se saltea
+        self._ocupado = threading.Lock()
+        os.makedirs(self.carpeta, exist_ok=True)
+
+    def debe_perfilar(self):
+        if request.headers.get(PROFILE_HEADER) == '1':
+            return True
+        if self.remitentes and request.path == RUTA_WEBHOOK:
+            cuerpo = request.get_data(cache=True)
+            if any(r in cuerpo for r in self.remitentes):
+                return True
+        return random.random() < self.tasa
+
+    # === HOOKS DE FLASK ===
+    def antes(self):
+        g.perfil_inicio = time.perf_counter()
+        g.perfil_token_etapas = etapas_request.set({})
+        g.perfil = None
+        g.perfil_token_marca = None
+        if not self.debe_perfilar():
+            return
+        if request.path == RUTA_WEBHOOK:
+            g.perfil_token_marca = marcado.set(True)
+        elif self._ocupado.acquire(blocking=False):
+            g.perfil = cProfile.Profile()
+            g.perfil.enable()
+
+    def despues(self, response):
+        inicio = g.pop('perfil_inicio', None)
+        if inicio is None:
+            return response
+        duracion = time.perf_counter() - inicio
+        perfil = g.pop('perfil', None)
+        archivo = None
+        if perfil is not None:
+            perfil.disable()
+            self._ocupado.release()
+            archivo = self._guardar(perfil, duracion, request.endpoint)
+
+        token = g.pop('perfil_token_etapas', None)
+        etapas = etapas_request.get() or {}
+        if token is not None:
+            etapas_request.reset(token)
+        self._soltar_marca()
+
+        self._anotar({'ruta': request.path, 'metodo': request.method, 'status': response.status_code},
+                     duracion, etapas, archivo)
+        return response
+
+    def limpiar(self, error=None):
+        """teardown: si el request explotó antes de after_request, soltamos el perfil igual"""
+        perfil = g.pop('perfil', None)
+        if perfil is not None:
+            perfil.disable()
+            self._ocupado.release()
+        token = g.pop('perfil_token_etapas', None)
+        if token is not None:
+            etapas_request.reset(token)
+        self._soltar_marca()
+
+    def _soltar_marca(self):
+        token = g.pop('perfil_token_marca', None)
+        if token is not None:
+            marcado.reset(token)
+
+    # === TURNOS DEL DESPACHADOR ===
+    @contextlib.contextmanager
+    def turno(self, remitente, inicio, con_cprofile=True):
+        """Desglose por etapa del turno (desde que se encoló) y cProfile si el webhook fue elegido.
+        El pipeline async no usa cProfile: en el event loop mezclaría todos los turnos en vuelo"""
+        token = etapas_request.set({})
+        perfil = None
+        if con_cprofile and marcado.get() and self._ocupado.acquire(blocking=False):
+            perfil = cProfile.Profile()
+            perfil.enable()
+        try:
+            yield
+        finally:
+            duracion = time.perf_counter() - inicio
+            archivo = None
+            if perfil is not None:
+                perfil.disable()
+                self._ocupado.release()
+                archivo = self._guardar(perfil, duracion, 'turno')
+            etapas = etapas_request.get() or {}
+            etapas_request.reset(token)
+            self._anotar({'ruta': 'turno', 'remitente': remitente}, duracion, etapas, archivo)
+
+    def _anotar(self, origen, duracion, etapas, archivo):
+        self.recientes.append({
+            **origen,
+            'ms': round(duracion * 1000, 2),
+            'etapas_ms': {k: round(v * 1000, 2) for k, v in etapas.items()},
+            'perfil': archivo,
+            'ts': time.time(),
+        })
+
+    def _guardar(self, perfil, duracion, origen):
+        nombre = f"{time.strftime('%Y%m%d-%H%M%S')}-{int(duracion * 1000)}ms-{origen or 'x'}.prof"
+        try:
+            perfil.dump_stats(os.path.join(self.carpeta, nombre))
+            self._recortar()
+            log.info(f"🔬 Perfil guardado: {nombre}")
+            return nombre
+        except OSError as e:
+            log.warning(f"⚠️ No se pudo guardar el perfil: {e}")
+            return None
+
+    def _recortar(self):
+        """Anillo: deja solo los últimos PROFILE_MAX perfiles"""
+        archivos = sorted(f for f in os.listdir(self.carpeta) if f.endswith('.prof'))
+        for viejo in archivos[:-self.maximo] if len(archivos) > self.maximo else []:
+            try:
+                os.remove(os.path.join(self.carpeta, viejo))
+            except OSError:
+                pass
+
+    def listar(self):
+        archivos = []
+        for nombre in sorted(os.listdir(self.carpeta), reverse=True):
+            if nombre.endswith('.prof'):
+                info = os.stat(os.path.join(self.carpeta, nombre))
+                archivos.append({'archivo': nombre, 'bytes': info.st_size, 'creado': info.st_mtime})
+        return archivos
+
+    def mas_lentos(self, n=10):
+        return sorted(self.recientes, key=lambda r: r['ms'], reverse=True)[:n]
+
+
+def turno(remitente, inicio, con_cprofile=True):
+    """Envuelve un turno del despachador; sin PROFILING no hace nada"""
+    if _activo is None:
+        return contextlib.nullcontext()
+    return _activo.turno(remitente, inicio, con_cprofile)
+
+
+def instalar(app):
+    """Registra hooks y rutas de admin SOLO si PROFILING está activo"""
+    global _activo
+    if not PROFILING:
+        return None
+
+    perfilador = _activo = Perfilador()
+    app.before_request(perfilador.antes)
+    app.after_request(perfilador.despues)
+    app.teardown_request(perfilador.limpiar)
+
+    @app.route('/admin/perfiles', methods=['GET'])
+    @requiere_admin
+    def admin_perfiles():
+        n = request.args.get('n', 10, type=int)
+        return jsonify({'perfiles': perfilador.listar(), 'lentos': perfilador.mas_lentos(n)})
+
+    @app.route('/admin/perfiles/<nombre>', methods=['GET'])
+    @requiere_admin
+    def admin_perfil(nombre):
+        if not NOMBRE_VALIDO.match(nombre) or not os.path.exists(os.path.join(perfilador.carpeta, nombre)):
+            return jsonify({'error': 'perfil no encontrado'}), 404
+        if request.args.get('formato') == 'texto':
+            salida = io.StringIO()
+            stats = pstats.Stats(os.path.join(perfilador.carpeta, nombre), stream=salida)
+            stats.sort_stats('cumulative').print_stats(request.args.get('top', 40, type=int))
+            return Response(salida.getvalue(), mimetype='text/plain')
+        return send_from_directory(perfilador.carpeta, nombre, as_attachment=True)
+
+    log.info(f"🔬 Perfilador activo (tasa={perfilador.tasa}, carpeta={perfilador.carpeta})")
+    if not ADMIN_TOKEN:
+        log.warning("⚠️ Sin ADMIN_TOKEN: /admin/perfiles queda cerrado (los .prof siguen en disco)")
+    return perfilador
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+PIPELINE ASYNC DE CONVERSACIONES
+================================
+Alternativa al Despachador de hilos (PIPELINE=async): un solo event loop en un
+hilo aparte lleva todos los turnos en vuelo. Esperar a Groq o a WaSender no
+ocupa un hilo del SO, así un proceso sostiene cientos de conversaciones
+esperando al LLM con muy poca memoria.
+
+- Groq: un AsyncGroq por API key (pool de conexiones compartido, sin reintentos del SDK)
+- WaSender: un httpx.AsyncClient compartido; pausa anti-ban con asyncio.sleep
+- SQLite sigue siendo bloqueante: va a un ThreadPoolExecutor dedicado y chico
+- Orden por remitente: un asyncio.Lock por remitente (FIFO)
+
+Los pasos del turno son los mismos que en api_server (preparar_turno, la rotación y
+escalado de conversar_con_groq, preparar_envio_wasender, respuesta_degradada, admisión):
+este módulo solo cambia cómo se espera.
+"""
+
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import os
+import threading
+import time
+from contextlib import asynccontextmanager
+
+import httpx
+from groq import AsyncGroq
+
+from bitacora import get_logger, iniciar_traza, trace_id_actual
+from metricas import medir, cronometrar, observar_etapa, LLM_LATENCIA, TURNOS_EN_CURSO
+from admision import SONDEO_CUPO_SEG
+import perfilador
+import plazos
+
+log = get_logger('pipeline')
+
+PIPELINE_ASYNC = os.environ.get('PIPELINE', 'hilos').lower() == 'async'
+# Hilos para SQLite (la DB serializa escrituras igual; más hilos no ayudan)
+DB_HILOS = int(os.environ.get('PIPELINE_DB_HILOS', '4'))
+HTTP_MAX_CONEXIONES = 100
+
+
+class PipelineAsync:
+    def __init__(self, bot, hilos_db=DB_HILOS):
+        # bot: el módulo api_server (funciones del turno, db, admisión, config)
+        self.bot = bot
+        self.loop = None
+        self._hilo = None
+        self._lock = threading.Lock()
+        self._ejecutor_db = concurrent.futures.ThreadPoolExecutor(hilos_db, thread_name_prefix='db-async')
+        self._groq = {}
+        self._http = None
+        # remitente -> [asyncio.Lock, turnos que lo usan]
+        self._bloqueos = {}
+        self._semaforo = None
+        self._limite_cupo = None
+        self._en_espera = 0
+        self._futuros = set()
+
+    # === CICLO DE VIDA ===
+    def iniciar(self):
+        with self._lock:
+            if self.loop is not None:
+                return
+            self.loop = asyncio.new_event_loop()
+            self._hilo = threading.Thread(target=self.loop.run_forever, name="pipeline-async", daemon=True)
+            self._hilo.start()
+            asyncio.run_coroutine_threadsafe(self._crear_clientes(), self.loop).result()
+            log.info(f"⚡ Pipeline async activo (DB en {self._ejecutor_db._max_workers} hilos)")
+
+    async def _crear_clientes(self):
+        self._http = httpx.AsyncClient(limits=httpx.Limits(max_connections=HTTP_MAX_CONEXIONES,
+                                                           max_keepalive_connections=20))
+        self._groq = {i: AsyncGroq(api_key=clave, base_url=self.bot.GROQ_BASE_URL, max_retries=0)
+                      for i, clave in enumerate(self.bot.GROQ_API_KEYS)}
+
+    def encolar(self, remitente, mensajes, inicio_turno):
+        """Mismo contrato que Despachador.encolar; trace y plazo viajan explícitos al loop"""
+        self.iniciar()
+        plazo = plazos.plazo_actual.get()
+        plazo_seg = plazo.restante() if plazo is not None else plazos.TURNO_PLAZO_SEG
+        with self._lock:
+            self._en_espera += 1
+        futuro = asyncio.run_coroutine_threadsafe(
+            self._turno(remitente, mensajes, inicio_turno, trace_id_actual.get(), plazo_seg), self.loop)
+        with self._lock:
+            self._futuros.add(futuro)
+        futuro.add_done_callback(self._terminado)
+
+    def _terminado(self, futuro):
+        with self._lock:
+            self._futuros.discard(futuro)
+
+    def pendientes(self):
+        return self._en_espera
+
+    def esperar(self):
+        while True:
+            with self._lock:
+                futuros = list(self._futuros)
+            if not futuros:
+                return
+            concurrent.futures.wait(futuros)
+
+    # === HELPERS ===
+    def _en_db(self, funcion, *args):
+        # run_in_executor no copia el contexto: sin esto se pierden trace_id y plazo
+        contexto = contextvars.copy_context()
+        return self.loop.run_in_executor(self._ejecutor_db, functools.partial(contexto.run, funcion, *args))
+
+    @asynccontextmanager
+    async def _bloqueo(self, remitente):
+        entrada = self._bloqueos.setdefault(remitente, [asyncio.Lock(), 0])
+        entrada[1] += 1
+        try:
+            async with entrada[0]:
+                yield
+        finally:
+            entrada[1] -= 1
+            if entrada[1] == 0:
+                del self._bloqueos[remitente]
+
+    @asynccontextmanager
+    async def _cupo_llm(self):
+        """Equivalente async de admision.cupo_llm (sin bloquear un hilo mientras espera)"""
+        admision = self.bot.admision
+        # ajustes() puede releer la config de la DB: fuera del loop
+        ajustes = await self._en_db(admision.ajustes)
+        limite = ajustes['admision_llm_concurrentes']
+        espera = plazos.restante(ajustes['admision_espera_llm_seg'])
+        if admision.estado is not None:
+            # Cupo de todo el despliegue: se vuelve a pedir hasta que otro proceso suelte uno
+            fin = time.monotonic() + espera
+            cupo = await self._en_db(admision.estado.tomar_cupo_llm, limite)
+            while cupo is None and time.monotonic() < fin:
+                await asyncio.sleep(min(SONDEO_CUPO_SEG, fin - time.monotonic()))
+                cupo = await self._en_db(admision.estado.tomar_cupo_llm, limite)
+            try:
+                yield cupo is not None
+            finally:
+                if cupo is not None:
+                    await self._en_db(admision.estado.soltar_cupo_llm, cupo)
+            return
+
+        if limite != self._limite_cupo:
+            self._semaforo = asyncio.Semaphore(limite)
+            self._limite_cupo = limite
+        semaforo = self._semaforo
+        try:
+            await asyncio.wait_for(semaforo.acquire(), timeout=espera)
+            tomado = True
+        except asyncio.TimeoutError:
+            tomado = False
+        try:
+            yield tomado
+        finally:
+            if tomado:
+                semaforo.release()
+
+    # === TURNO ===
+    async def _turno(self, remitente, mensajes, inicio_turno, trace_id, plazo_seg):
+        # Cada tarea tiene su copia del contexto: setear acá no pisa a otras
+        iniciar_traza(trace_id)
+        plazos.iniciar_plazo(plazo_seg)
+        async with self._bloqueo(remitente):
+            with self._lock:
+                self._en_espera -= 1
+            with perfilador.turno(remitente, inicio_turno, con_cprofile=False):
+                observar_etapa('espera_cola', time.perf_counter() - inicio_turno)
+                TURNOS_EN_CURSO.inc()
+                try:
+                    await self._procesar(remitente, mensajes)
+                except Exception as e:
+                    log.exception(f"❌ Error procesando turno de {remitente}: {e}")
+                finally:
+                    await self._en_db(self.bot.confirmar_eventos, mensajes)
+                    TURNOS_EN_CURSO.dec()
+                    observar_etapa('turno_completo', time.perf_counter() - inicio_turno)
+
+    async def _procesar(self, remitente, mensajes):
+        bot = self.bot
+        for m in mensajes:
+            await self._en_db(bot.db.agregar_mensaje, remitente, m.mensaje, False)
+        if not mensajes and not bot.admision.hay_retenidos(remitente):
+            return
+
+        decision = await self._en_db(bot.admision.decidir, remitente)
+        if decision == 'ignorar':
+            log.info(f"🚦 Turno de {remitente} sin respuesta ({decision})")
+            return
+        if decision == 'limitar':
+            # Mismo criterio que limitar_turno: un aviso por ráfaga y reintento al recargarse el bucket
+            primero = bot.admision.retener(remitente, [m.mensaje for m in mensajes])
+            if primero:
+                respuesta = await self._en_db(bot.respuesta_degradada, remitente, 'limitar')
+                if respuesta:
+                    await self._enviar(remitente, respuesta)
+            if primero or not mensajes:
+                espera = await self._en_db(bot.admision.espera_recarga)
+                asyncio.get_running_loop().call_later(espera, self._reintentar, remitente)
+            log.info(f"🚦 Turno de {remitente} retenido (limitar)")
+            return
+
+        texto = "\n".join(bot.admision.retomar(remitente) + [m.mensaje for m in mensajes])
+        push_name = next((m.push_name for m in reversed(mensajes) if m.push_name), None)
+        if decision == 'llm':
+            respuesta = await self._generar(texto, remitente, push_name)
+        else:
+            respuesta = await self._en_db(bot.respuesta_degradada, remitente, decision)
+
+        if respuesta:
+            await self._enviar(remitente, respuesta)
+
+    def _reintentar(self, remitente):
+        # Traza y plazo nuevos: el del turno limitado ya venció
+        iniciar_traza()
+        plazos.iniciar_plazo()
+        self.encolar(remitente, [], time.perf_counter())
+
+    async def _generar(self, mensaje, cliente, push_name):
+        """generar_respuesta_ia con Groq async: misma rotación y escalado (conversar_con_groq),
+        cuyos pasos (DB, rotación de claves) corren en el ejecutor; el loop solo espera a Groq"""
+        bot = self.bot
+        turno = await self._en_db(bot.preparar_turno, mensaje, cliente, push_name)
+        if turno.mensajes is None:
+            return turno.respuesta
+
+        async with self._cupo_llm() as hay_cupo:
+            if not hay_cupo:
+                return await self._en_db(bot.respuesta_degradada, cliente, 'fija')
+
+            conversacion = bot.conversar_con_groq(turno, cliente)
+            llamada, respuesta = await self._en_db(bot.avanzar_conversacion, conversacion)
+            while llamada is not None:
+                indice_clave, parametros = llamada
+                try:
+                    with cronometrar(LLM_LATENCIA, clave=str(indice_clave)):
+                        resultado = await self._groq[indice_clave].chat.completions.create(
+                            messages=turno.mensajes, timeout=plazos.restante(bot.GROQ_TIMEOUT_SEG),
+                            **parametros), None
+                except Exception as e:
+                    resultado = None, e
+                llamada, respuesta = await self._en_db(bot.avanzar_conversacion, conversacion, resultado)
+            return respuesta
+
+    async def _enviar(self, to, text):
+        bot = self.bot
+        # Pausa anti-ban sin ocupar un hilo; entera aunque el plazo se haya agotado
+        await asyncio.sleep(bot.WASENDER_THROTTLE_SEG)
+        envio = bot.preparar_envio_wasender(to, text)
+        try:
+            with medir('envio_wasender'):
+                response = await self._http.post(bot.WASENDER_URL, **envio)
+            return bot.resultado_envio_wasender(response.status_code, response.text)
+        except Exception as e:
+            log.error(f"❌ WaSender Exception: {str(e)}")
+            return False
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+PLAZO POR TURNO (DEADLINE DE PUNTA A PUNTA)
+===========================================
+El webhook crea un Plazo al recibir el mensaje; viaja por contextvars
+(igual que el trace_id) hasta el despachador, la admisión, Groq y WaSender.
+Cada etapa usa como timeout lo que queda del presupuesto en vez de su
+propio número fijo; sin plazo activo se usa el máximo de siempre.
+
+La DB no: guardar el mensaje o la reserva no es opcional, y un lock que
+vence por el plazo se confundiría con un turno ocupado.
+
+La pausa anti-ban antes de cada envío a WaSender tampoco: acortarla con el
+plazo justo bajo carga es lo que hace que bloqueen el número.
+"""
+
+import contextvars
+import os
+import time
+
+TURNO_PLAZO_SEG = float(os.environ.get('TURNO_PLAZO_SEG', '25'))
+
+plazo_actual = contextvars.ContextVar('plazo_actual', default=None)
+
+
+class Plazo:
+    def __init__(self, segundos=TURNO_PLAZO_SEG):
+        self.segundos = segundos
+        self.vence = time.monotonic() + segundos
+
+    def restante(self):
+        return max(0.0, self.vence - time.monotonic())
+
+    def vencido(self, margen=0.0):
+        return self.restante() <= margen
+
+    def __repr__(self):
+        return f"Plazo({self.restante():.2f}s de {self.segundos}s)"
+
+
+def iniciar_plazo(segundos=TURNO_PLAZO_SEG):
+    """Activa un plazo nuevo y devuelve el token para soltarlo"""
+    return plazo_actual.set(Plazo(segundos))
+
+
+def soltar_plazo(token):
+    plazo_actual.reset(token)
+
+
+def restante(maximo, minimo=0.0):
+    """Timeout para una etapa: lo que quede del plazo, sin pasar `maximo` ni bajar de `minimo`"""
+    plazo = plazo_actual.get()
+    if plazo is None:
+        return maximo
+    return max(minimo, min(maximo, plazo.restante()))
+
+
+def vencido(margen=0.0):
+    plazo = plazo_actual.get()
+    return plazo is not None and plazo.vencido(margen)
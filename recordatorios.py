@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+RECORDATORIOS DE TURNOS
+=======================
+Un mensaje de WhatsApp antes de cada cita para bajar el ausentismo.
+
+- Heap por momento de envío: al arrancar se cargan las citas futuras una vez;
+  después solo cambia con eventos del bus (cita_agregada / cita_eliminada)
+- El hilo duerme con un Condition hasta el próximo vencimiento: sin citas
+  cerca no gasta CPU (con miles de turnos a futuro tampoco)
+- Cancelaciones: borrado perezoso (la entrada del heap se descarta al salir)
+  y la cita se relee de la DB justo antes de enviar
+- Envío en lotes por una sesión HTTP reusada, con tope de envíos por minuto
+- Marca de agua en config ('recordatorios_marca'): tras un reinicio se mandan
+  los que vencieron mientras el proceso estaba caído (si el turno no pasó)
+- Si WaSender falla, el recordatorio se reintenta y la marca no lo pasa hasta que
+  salga o deje de hacer falta (mejor repetir uno tras un reinicio que perderlo)
+- Una cita reservada ya dentro de la anticipación se avisa al reservarla: su
+  envío cuenta desde el alta, así la marca no la descarta
+- El recordatorio queda en el historial: si el cliente contesta, el bot lo
+  tiene en contexto (con fragmentos, el dueño de la sesión la suelta para releerla)
+
+Con varios workers (gunicorn) corre una sola instancia en el master: las citas
+que agrega otro proceso se detectan por el contador de versión compartido y se
+cargan por id incremental, nunca releyendo la tabla entera.
+
+Se activa con RECORDATORIOS=1.
+"""
+
+import datetime
+import heapq
+import os
+import threading
+import time
+
+import requests
+
+from bitacora import get_logger, iniciar_traza, cerrar_traza
+from metricas import registro
+from resolutor_fechas import ZONA_LOCAL
+
+log = get_logger('recordatorios')
+
+RECORDATORIOS = os.environ.get('RECORDATORIOS', '').lower() in ('1', 'true', 'si')
+# Anticipación del aviso (se puede cambiar en config: 'recordatorio_minutos')
+ANTICIPACION_MIN = 120
+ENVIOS_POR_MINUTO = int(os.environ.get('RECORDATORIOS_POR_MINUTO', '20'))
+LOTE_MAXIMO = 50
+# Modo compartido: cada cuánto mirar si otro proceso agregó citas (una lectura de contador)
+SINCRONIZAR_SEG = 30
+ENVIO_TIMEOUT_SEG = 10
+# Un envío que falló se reintenta a este intervalo mientras el turno no pase
+REINTENTO_SEG = 60
+MENSAJE = "⏰ ¡Hola {cliente}! Te recordamos tu turno {cuando} a las {hora} ({servicio}). ¡Te esperamos! 💈"
+
+RECORDATORIOS_TOTAL = registro.contador(
+    'bot_recordatorios_total', 'Recordatorios procesados', ('resultado',))
+
+
+class CamposPlantilla(dict):
+    """Un placeholder que no conocemos queda tal cual en vez de romper el envío"""
+
+    def __missing__(self, clave):
+        return '{' + clave + '}'
+
+
+def momento_cita(fecha, hora):
+    """Epoch de la cita en hora local (UTC-4); None si el formato no sirve"""
+    try:
+        return datetime.datetime.strptime(f"{fecha} {hora[:5]}", '%Y-%m-%d %H:%M').replace(
+            tzinfo=ZONA_LOCAL).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def anticipacion_seg(minutos):
+    """'recordatorio_minutos' de config (lo edita el panel): un valor inválido no frena los recordatorios"""
+    try:
+        return max(0, int(float(minutos))) * 60
+    except (TypeError, ValueError):
+        log.warning(f"⚠️ recordatorio_minutos inválido ({minutos!r}), uso {ANTICIPACION_MIN}")
+        return ANTICIPACION_MIN * 60
+
+
+def momento_alta(timestamp):
+    """Epoch del alta de la cita (columna timestamp, texto UTC); 0 si no está o no se puede leer"""
+    try:
+        return datetime.datetime.strptime(str(timestamp)[:19], '%Y-%m-%d %H:%M:%S').replace(
+            tzinfo=datetime.timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class Recordatorios:
+    def __init__(self, db, bus, armar_envio, url, por_minuto=ENVIOS_POR_MINUTO, soltar_sesion=None):
+        self.db = db
+        self.bus = bus
+        # armar_envio(to, text) -> (to, headers, payload), el mismo del bot
+        self.armar_envio = armar_envio
+        # soltar_sesion(cliente): corre en el master, la sesión la cachea su fragmento
+        self.soltar_sesion = soltar_sesion
+        self.url = url
+        self.intervalo = 60.0 / max(1, por_minuto)
+        self._heap = []
+        # cita_id -> momento de envío vigente (lo que no está acá, se descarta al salir del heap)
+        self._vigentes = {}
+        self._cond = threading.Condition()
+        self._hilo = None
+        self._oyente = False
+        self._detener = False
+        self._ultimo_id = 0
+        self._version = None
+        self._marca = None
+        # Último envío resuelto, y cita_id -> envío original de los que fallaron (frenan la marca)
+        self._hecho = 0.0
+        self._fallidos = {}
+        self._anticipacion = ANTICIPACION_MIN * 60
+        self._http = None
+        self._ultimo_envio = 0.0
+
+    # === CICLO DE VIDA ===
+    def iniciar(self):
+        if self._hilo is not None and self._hilo.is_alive():
+            return
+        self._detener = False
+        self._anticipacion = anticipacion_seg(self.db.get_config('recordatorio_minutos', ANTICIPACION_MIN))
+        self._marca = float(self.db.get_config('recordatorios_marca', 0) or 0) or time.time()
+        self._http = requests.Session()
+        # Reiniciar (detener/iniciar) no suma otro oyente: cada evento se programaría dos veces
+        if not self._oyente:
+            self.bus.agregar_oyente(self._evento)
+            self._oyente = True
+        self._cargar()
+        self._hilo = threading.Thread(target=self._ciclo, name="recordatorios", daemon=True)
+        self._hilo.start()
+        log.info(f"⏰ Recordatorios activos: {len(self._vigentes)} programados, "
+                 f"{self._anticipacion // 60} min antes")
+
+    def detener(self):
+        with self._cond:
+            self._detener = True
+            self._cond.notify()
+
+    def programados(self):
+        return len(self._vigentes)
+
+    # === HEAP ===
+    def _programar(self, cita_id, fecha, hora, alta=None):
+        """alta: epoch en que se reservó (None: ahora, recién llegada por el bus)"""
+        cita = momento_cita(fecha, hora)
+        if cita is None:
+            return
+        # Reservada dentro de la anticipación: se avisa apenas se reservó
+        envio = max(cita - self._anticipacion, time.time() if alta is None else alta)
+        # Ya avisado según la marca, o el turno ya pasó
+        if envio <= self._marca or cita <= time.time():
+            return
+        with self._cond:
+            self._vigentes[cita_id] = envio
+            heapq.heappush(self._heap, (envio, cita_id))
+            self._ultimo_id = max(self._ultimo_id, cita_id)
+            # Solo despertar si cambió el próximo vencimiento
+            if self._heap[0][1] == cita_id:
+                self._cond.notify()
+
+    def _cancelar(self, cita_id):
+        with self._cond:
+            self._vigentes.pop(cita_id, None)
+            self._fallidos.pop(cita_id, None)
+            # Muchas cancelaciones dejan basura: compactar de vez en cuando
+            if len(self._heap) > 2 * len(self._vigentes) + 64:
+                self._heap = [(m, i) for m, i in self._heap if self._vigentes.get(i) == m]
+                heapq.heapify(self._heap)
+
+    def _evento(self, tipo, datos):
+        if tipo == 'cita_agregada':
+            self._programar(datos['id'], datos['fecha'], datos['hora'])
+        elif tipo == 'cita_eliminada':
+            self._cancelar(datos['id'])
+        elif tipo == 'config' and datos.get('clave') == 'recordatorio_minutos':
+            log.info("⏰ Cambió la anticipación: se recargan los recordatorios")
+            with self._cond:
+                self._heap, self._vigentes = [], {}
+            self._anticipacion = anticipacion_seg(datos['valor'])
+            self._cargar()
+
+    def _cargar(self, desde_id=0):
+        """Citas futuras (o con id mayor a desde_id) al heap"""
+        ayer = (datetime.datetime.now(ZONA_LOCAL) - datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+        conn = self.db.get_connection()
+        rows = conn.execute("SELECT id, fecha, hora, timestamp FROM citas "
+                            "WHERE estado = 'Confirmado' AND fecha >= ? AND id > ?", (ayer, desde_id)).fetchall()
+        conn.close()
+        self._version = self.db.version('citas')
+        for r in rows:
+            self._programar(r['id'], r['fecha'], r['hora'], momento_alta(r['timestamp']))
+        self._ultimo_id = max([self._ultimo_id] + [r['id'] for r in rows])
+        return len(rows)
+
+    def _sincronizar(self):
+        # Solo hace falta con varios procesos: en uno solo el bus ya avisó
+        if self.db.estado is None or self.db.version('citas') == self._version:
+            return
+        nuevas = self._cargar(desde_id=self._ultimo_id)
+        if nuevas:
+            log.info(f"⏰ {nuevas} citas nuevas de otros procesos")
+
+    def _tomar_vencidos(self):
+        lote = []
+        ahora = time.time()
+        while self._heap and self._heap[0][0] <= ahora and len(lote) < LOTE_MAXIMO:
+            envio, cita_id = heapq.heappop(self._heap)
+            if self._vigentes.get(cita_id) == envio:
+                del self._vigentes[cita_id]
+                lote.append((envio, cita_id))
+        return lote
+
+    def _ciclo(self):
+        while True:
+            with self._cond:
+                if self._detener:
+                    return
+                lote = self._tomar_vencidos()
+                if not lote:
+                    espera = self._heap[0][0] - time.time() if self._heap else None
+                    if self.db.estado is not None:
+                        espera = SINCRONIZAR_SEG if espera is None else min(espera, SINCRONIZAR_SEG)
+                    self._cond.wait(timeout=espera)
+            try:
+                self._sincronizar()
+                if lote:
+                    self._enviar_lote(lote)
+            except Exception as e:
+                log.exception(f"❌ Error en recordatorios: {e}")
+
+    # === ENVÍO ===
+    def _enviar_lote(self, lote):
+        traza = iniciar_traza()
+        try:
+            log.info(f"⏰ Enviando {len(lote)} recordatorios")
+            for envio, cita_id in lote:
+                resultado = self._enviar(cita_id)
+                RECORDATORIOS_TOTAL.inc(resultado=resultado)
+                with self._cond:
+                    original = self._fallidos.pop(cita_id, envio)
+                    if resultado == 'error':
+                        self._fallidos[cita_id] = original
+                        self._reintentar(cita_id)
+                if resultado != 'error':
+                    self._guardar_marca(original)
+        finally:
+            cerrar_traza(traza)
+
+    def _reintentar(self, cita_id):
+        # Con self._cond tomado
+        envio = time.time() + REINTENTO_SEG
+        self._vigentes[cita_id] = envio
+        heapq.heappush(self._heap, (envio, cita_id))
+
+    def _enviar(self, cita_id):
+        # Releer: pudo cancelarse en otro proceso
+        conn = self.db.get_connection()
+        cita = conn.execute("SELECT * FROM citas WHERE id = ? AND estado = 'Confirmado'", (cita_id,)).fetchone()
+        conn.close()
+        if cita is None:
+            return 'cancelado'
+        momento = momento_cita(cita['fecha'], cita['hora'])
+        if momento is None or momento <= time.time():
+            return 'vencido'
+        if not cita['telefono']:
+            return 'sin_telefono'
+
+        # Tope de envíos por minuto (anti-ban)
+        pausa = self._ultimo_envio + self.intervalo - time.monotonic()
+        if pausa > 0:
+            time.sleep(pausa)
+        self._ultimo_envio = time.monotonic()
+
+        texto = self._texto(cita)
+        to, headers, payload = self.armar_envio(cita['telefono'], texto)
+        try:
+            response = self._http.post(self.url, json=payload, headers=headers, timeout=ENVIO_TIMEOUT_SEG)
+            if response.status_code in (200, 201):
+                self.db.agregar_mensaje(cita['telefono'], texto, es_bot=True)
+                if self.soltar_sesion is not None:
+                    self.soltar_sesion(cita['telefono'])
+                return 'enviado'
+            log.error(f"❌ Recordatorio {cita_id}: WaSender {response.status_code}")
+        except Exception as e:
+            log.error(f"❌ Recordatorio {cita_id}: {e}")
+        return 'error'
+
+    def _texto(self, cita):
+        hoy = datetime.datetime.now(ZONA_LOCAL).date()
+        fecha = datetime.date.fromisoformat(cita['fecha'])
+        if fecha == hoy:
+            cuando = "de hoy"
+        elif fecha == hoy + datetime.timedelta(days=1):
+            cuando = "de mañana"
+        else:
+            cuando = f"del {fecha.day}/{fecha.month}"
+        plantilla = self.db.get_config('recordatorio_mensaje') or MENSAJE
+        campos = CamposPlantilla(cliente=cita['cliente'], cuando=cuando, hora=cita['hora'][:5],
+                                 servicio=cita['servicio'] or 'corte')
+        try:
+            return plantilla.format_map(campos)
+        except (ValueError, IndexError, AttributeError) as e:
+            # Llaves sueltas, "{0}", "{cliente.x}": la plantilla editada en el panel no frena el aviso
+            log.warning(f"⚠️ Plantilla de recordatorio inválida ({e}), uso la de siempre")
+            return MENSAJE.format_map(campos)
+
+    def _guardar_marca(self, envio):
+        # Sin marcar_cambio ni evento: no es config que el panel tenga que releer
+        with self._cond:
+            self._hecho = max(self._hecho, envio)
+            marca = self._hecho
+            if self._fallidos:
+                # Un fallido pendiente frena la marca: tras un reinicio se vuelve a programar
+                marca = min(marca, min(self._fallidos.values()) - 0.001)
+            self._marca = marca
+        with self.db.escritura('recordatorios_marca') as conn:
+            conn.execute("INSERT INTO config (clave, valor) VALUES ('recordatorios_marca', ?) "
+                         "ON CONFLICT(clave) DO UPDATE SET valor = excluded.valor", (repr(self._marca),))
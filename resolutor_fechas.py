@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""
+RESOLUTOR DE FECHAS Y HORAS EN ESPAÑOL
+======================================
+Convierte expresiones como "el viernes", "pasado mañana", "el 23",
+"23 de diciembre", "a la tarde", "5 y media", "después del almuerzo" o
+"en 2 horas" en
+candidatos concretos (fecha YYYY-MM-DD, hora HH:MM) relativos al reloj del
+local (UTC-4), cada uno con una confianza entre 0 y 1.
+
+Determinista y sin LLM: lo usan el chequeo de conflictos, la memoria de la
+sesión y la disponibilidad que va al prompt, para cerrar el turno en menos
+idas y vueltas.
+
+Reglas de la casa para horas sueltas: 1 a 7 es PM, 8 a 11 es AM.
+"""
+
+import collections
+import datetime
+import re
+import unicodedata
+
+ZONA_LOCAL = datetime.timezone(datetime.timedelta(hours=-4))
+APERTURA = 9
+CIERRE = 20
+
+# Con confianza >= esto el dato va directo a la memoria de la sesión
+UMBRAL_MEMORIA = 0.75
+# Dos candidatos a menos de esto se consideran empatados (ambiguo)
+MARGEN_AMBIGUEDAD = 0.15
+
+DIAS = {'lunes': 0, 'martes': 1, 'miercoles': 2, 'jueves': 3, 'viernes': 4, 'sabado': 5, 'domingo': 6}
+MESES = {'enero': 1, 'febrero': 2, 'marzo': 3, 'abril': 4, 'mayo': 5, 'junio': 6, 'julio': 7, 'agosto': 8,
+         'septiembre': 9, 'setiembre': 9, 'octubre': 10, 'noviembre': 11, 'diciembre': 12}
+# Primera hora que ofrecemos en cada franja
+FRANJAS = {'manana': 9, 'tarde': 13, 'noche': 19}
+
+Candidato = collections.namedtuple('Candidato', ['valor', 'confianza', 'origen'])
+
+_RE_FRANJA = re.compile(r'\b(?:a|por|de|en|durante|esta) la (manana|tarde|noche)\b|\besta (tarde|noche)\b')
+_RE_ISO = re.compile(r'\b(\d{4})-(\d{1,2})-(\d{1,2})\b')
+_RE_BARRA = re.compile(r'\b(\d{1,2})[/-](\d{1,2})(?:[/-](\d{2,4}))?\b')
+_RE_DIA_MES = re.compile(r'\b(\d{1,2}) de (' + '|'.join(MESES) + r')\b')
+_RE_DIA_SEMANA = re.compile(r'\b(?:(proximo|siguiente|este) )?(' + '|'.join(DIAS) + r')(?: (que viene|proximo))?\b')
+_RE_DIA_SUELTO = re.compile(r'\b(?:el|dia|para el) (\d{1,2})\b(?! ?(?::|\.\d|hs?\b|horas|y media|y cuarto|menos|de la|am\b|pm\b))')
+
+# Duración desde ahora ("en 2 horas", "dentro de media hora"): no es la hora 2
+_RE_RELATIVA = re.compile(r'\b(?:en|dentro de) (\d{1,3}|una?|media) (horas?|minutos?|min)\b( y media)?')
+_RE_HORA_MINUTOS = re.compile(r'\b(\d{1,2})[:.](\d{2})\s*(am|pm|hs|h)?\b')
+_RE_HORA_SUFIJO = re.compile(r'\b(\d{1,2})\s*(am|pm|hs|h|horas)\b')
+_RE_HORA_FRACCION = re.compile(r'\b(?:(?:a )?las )?(\d{1,2}) (y media|y cuarto|menos cuarto)\b')
+_RE_HORA_LAS = re.compile(r'\b(?:a las|las|tipo|a eso de las|para las|desde las|a partir de las) (\d{1,2})\b')
+_RE_HORA_FRANJA = re.compile(r'\b(\d{1,2}) de la (manana|tarde|noche)\b')
+_RE_SOLO_NUMERO = re.compile(r'^\s*(?:a las |las )?(\d{1,2})\s*$')
+
+
+def ahora_local():
+    return datetime.datetime.now(ZONA_LOCAL)
+
+
+def normalizar_texto(texto):
+    """Minúsculas y sin tildes ('mañana' -> 'manana'), para comparar sin variantes"""
+    texto = unicodedata.normalize('NFKD', texto.lower())
+    return ''.join(c for c in texto if not unicodedata.combining(c))
+
+
+class Resolucion:
+    def __init__(self, fechas, horas, franja=None):
+        self.fechas = sorted(fechas, key=lambda c: -c.confianza)
+        self.horas = sorted(horas, key=lambda c: -c.confianza)
+        self.franja = franja
+
+    @staticmethod
+    def _mejor(candidatos, umbral):
+        if candidatos and candidatos[0].confianza >= umbral:
+            return candidatos[0].valor
+        return None
+
+    def fecha(self, umbral=0.0):
+        return self._mejor(self.fechas, umbral)
+
+    def hora(self, umbral=0.0):
+        return self._mejor(self.horas, umbral)
+
+    @property
+    def ambigua(self):
+        for candidatos in (self.fechas, self.horas):
+            if len(candidatos) > 1 and candidatos[0].confianza - candidatos[1].confianza < MARGEN_AMBIGUEDAD:
+                return True
+        return False
+
+    def __bool__(self):
+        return bool(self.fechas or self.horas)
+
+    def __repr__(self):
+        return f"Resolucion(fechas={self.fechas}, horas={self.horas}, franja={self.franja})"
+
+
+def _agregar(candidatos, valor, confianza, origen):
+    # Mismo valor por dos caminos: gana la confianza más alta
+    previo = candidatos.get(valor)
+    if previo is None or previo.confianza < confianza:
+        candidatos[valor] = Candidato(valor, round(confianza, 2), origen)
+
+
+def _tapar(texto, match):
+    """Borra lo ya interpretado para que sus números no se relean como hora"""
+    inicio, fin = match.span()
+    return texto[:inicio] + ' ' * (fin - inicio) + texto[fin:]
+
+
+def _fecha_valida(anio, mes, dia):
+    try:
+        return datetime.date(anio, mes, dia)
+    except ValueError:
+        return None
+
+
+# === FECHAS ===
+def _resolver_fechas(texto, hoy, relativas=()):
+    fechas = {c.valor: c for c in relativas}
+
+    for m in list(_RE_ISO.finditer(texto)):
+        fecha = _fecha_valida(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+        if fecha:
+            _agregar(fechas, fecha.isoformat(), 1.0, 'iso')
+            texto = _tapar(texto, m)
+
+    for m in list(_RE_BARRA.finditer(texto)):
+        dia, mes = int(m.group(1)), int(m.group(2))
+        anio = int(m.group(3)) if m.group(3) else hoy.year
+        if anio < 100:
+            anio += 2000
+        fecha = _fecha_valida(anio, mes, dia)
+        if fecha and not m.group(3) and fecha < hoy:
+            fecha = _fecha_valida(anio + 1, mes, dia)
+        if fecha:
+            _agregar(fechas, fecha.isoformat(), 0.95, 'dd/mm')
+            texto = _tapar(texto, m)
+
+    for m in list(_RE_DIA_MES.finditer(texto)):
+        fecha = _fecha_valida(hoy.year, MESES[m.group(2)], int(m.group(1)))
+        if fecha and fecha < hoy:
+            fecha = _fecha_valida(hoy.year + 1, MESES[m.group(2)], int(m.group(1)))
+        if fecha:
+            _agregar(fechas, fecha.isoformat(), 0.95, 'dia de mes')
+            texto = _tapar(texto, m)
+
+    m = re.search(r'\bpasado manana\b', texto)
+    if m:
+        _agregar(fechas, (hoy + datetime.timedelta(days=2)).isoformat(), 1.0, 'pasado manana')
+        texto = _tapar(texto, m)
+
+    m = re.search(r'\bhoy\b', texto)
+    if m:
+        _agregar(fechas, hoy.isoformat(), 1.0, 'hoy')
+        texto = _tapar(texto, m)
+
+    # "manana" que queda (las franjas "a la manana" ya se taparon) = día siguiente
+    m = re.search(r'(?<!la )\bmanana\b', texto)
+    if m:
+        _agregar(fechas, (hoy + datetime.timedelta(days=1)).isoformat(), 0.95, 'manana')
+        texto = _tapar(texto, m)
+
+    for m in list(_RE_DIA_SEMANA.finditer(texto)):
+        proximo = m.group(1) in ('proximo', 'siguiente') or bool(m.group(3))
+        delta = (DIAS[m.group(2)] - hoy.weekday()) % 7
+        if delta == 0:
+            # "el viernes" dicho un viernes: hoy o el de la semana que viene
+            if proximo:
+                _agregar(fechas, (hoy + datetime.timedelta(days=7)).isoformat(), 0.85, 'dia de semana')
+            else:
+                _agregar(fechas, hoy.isoformat(), 0.55, 'dia de semana')
+                _agregar(fechas, (hoy + datetime.timedelta(days=7)).isoformat(), 0.45, 'dia de semana')
+        else:
+            _agregar(fechas, (hoy + datetime.timedelta(days=delta)).isoformat(), 0.9, 'dia de semana')
+        texto = _tapar(texto, m)
+
+    for m in list(_RE_DIA_SUELTO.finditer(texto)):
+        dia = int(m.group(1))
+        if not 1 <= dia <= 31:
+            continue
+        # "el 23": este mes si no pasó, si no el mes que viene
+        anio, mes = hoy.year, hoy.month
+        if dia < hoy.day:
+            anio, mes = (anio + 1, 1) if mes == 12 else (anio, mes + 1)
+        fecha = _fecha_valida(anio, mes, dia)
+        if fecha:
+            _agregar(fechas, fecha.isoformat(), 0.75, 'dia suelto')
+            texto = _tapar(texto, m)
+
+    return list(fechas.values()), texto
+
+
+# === DURACIONES RELATIVAS ===
+def _resolver_relativas(texto, ahora):
+    fechas, horas = {}, {}
+    for m in list(_RE_RELATIVA.finditer(texto)):
+        cantidad = {'un': 1, 'una': 1, 'media': 0.5}.get(m.group(1)) or int(m.group(1))
+        minutos = cantidad * 60 if m.group(2).startswith('hora') else cantidad
+        if m.group(3):
+            minutos += 30
+        # Con solo una fecha no hay reloj contra el cual sumar: se tapa igual para no leerla como hora
+        if isinstance(ahora, datetime.datetime):
+            momento = ahora + datetime.timedelta(minutes=minutos)
+            _agregar(fechas, momento.date().isoformat(), 0.8, 'relativa')
+            valor = momento.strftime('%H:%M')
+            _agregar(horas, valor, _confianza_hora(valor, 0.8), 'relativa')
+        texto = _tapar(texto, m)
+    return list(fechas.values()), list(horas.values()), texto
+
+
+# === HORAS ===
+def _hora24(hora, minutos=0, sufijo=None, franja=None):
+    if not 0 <= hora <= 23 or not 0 <= minutos <= 59:
+        return None
+    if sufijo == 'pm' and hora < 12:
+        hora += 12
+    elif sufijo == 'am':
+        if hora == 12:
+            hora = 0
+    elif franja in ('tarde', 'noche') and hora < 12:
+        hora += 12
+    elif franja == 'manana':
+        pass
+    elif 1 <= hora <= 7:
+        # Regla de la casa: nadie pide turno a las 5 AM
+        hora += 12
+    return f"{hora:02d}:{minutos:02d}"
+
+
+def _confianza_hora(valor, base):
+    # Fuera del horario del local probablemente no era una hora
+    hora = int(valor[:2])
+    return base if APERTURA - 1 <= hora < CIERRE else base * 0.3
+
+
+def _resolver_horas(texto, franja, relativas=()):
+    horas = {c.valor: c for c in relativas}
+
+    def agregar(valor, base, origen):
+        if valor:
+            _agregar(horas, valor, _confianza_hora(valor, base), origen)
+
+    for m in list(_RE_HORA_FRANJA.finditer(texto)):
+        agregar(_hora24(int(m.group(1)), franja=m.group(2)), 0.95, 'hora de franja')
+        texto = _tapar(texto, m)
+
+    for m in list(_RE_HORA_MINUTOS.finditer(texto)):
+        sufijo = m.group(3) if m.group(3) in ('am', 'pm') else None
+        agregar(_hora24(int(m.group(1)), int(m.group(2)), sufijo, franja), 0.95, 'hh:mm')
+        texto = _tapar(texto, m)
+
+    for m in list(_RE_HORA_SUFIJO.finditer(texto)):
+        sufijo = m.group(2) if m.group(2) in ('am', 'pm') else None
+        # "17 hs" suele ser hora, pero "2 horas" suelto también puede ser una duración
+        base = 0.95 if sufijo else 0.8 if m.group(2) in ('hs', 'h') else 0.6
+        agregar(_hora24(int(m.group(1)), 0, sufijo, franja), base, 'hora con sufijo')
+        texto = _tapar(texto, m)
+
+    for m in list(_RE_HORA_FRACCION.finditer(texto)):
+        hora = int(m.group(1))
+        if m.group(2) == 'y media':
+            valor = _hora24(hora, 30, franja=franja)
+        elif m.group(2) == 'y cuarto':
+            valor = _hora24(hora, 15, franja=franja)
+        else:
+            valor = _hora24(hora, 0, franja=franja)
+            if valor:
+                # "5 menos cuarto" = 16:45
+                total = int(valor[:2]) * 60 - 15
+                valor = f"{total // 60:02d}:{total % 60:02d}"
+        agregar(valor, 0.85, 'fraccion')
+        texto = _tapar(texto, m)
+
+    for m in list(_RE_HORA_LAS.finditer(texto)):
+        agregar(_hora24(int(m.group(1)), franja=franja), 0.9, 'a las')
+        texto = _tapar(texto, m)
+
+    m = _RE_SOLO_NUMERO.match(texto)
+    if m:
+        agregar(_hora24(int(m.group(1)), franja=franja), 0.7, 'numero suelto')
+
+    # Sin hora concreta: la franja o el almuerzo orientan
+    if not horas:
+        if re.search(r'\bdespues (?:del almuerzo|de almorzar|de comer|del mediodia)\b', texto):
+            agregar("13:00", 0.7, 'despues del almuerzo')
+        elif re.search(r'\b(?:al )?mediodia\b', texto):
+            agregar("12:00", 0.6, 'mediodia')
+        elif re.search(r'\btemprano\b', texto):
+            agregar(f"{APERTURA:02d}:00", 0.5, 'temprano')
+        elif franja:
+            agregar(f"{FRANJAS[franja]:02d}:00", 0.4, 'franja')
+
+    return list(horas.values())
+
+
+def resolver(texto, ahora=None):
+    """Candidatos de fecha y hora para un mensaje, relativos a `ahora` (UTC-4 por defecto)"""
+    ahora = ahora or ahora_local()
+    hoy = ahora.date() if isinstance(ahora, datetime.datetime) else ahora
+    texto = normalizar_texto(texto or '')
+
+    franja = None
+    for m in list(_RE_FRANJA.finditer(texto)):
+        franja = m.group(1) or m.group(2)
+        if m.group(0).startswith('esta'):
+            # "esta tarde" también dice el día
+            texto = texto[:m.start()] + ' hoy ' + texto[m.end():]
+        elif not re.search(r'\d\s+' + re.escape(m.group(0)), texto):
+            texto = _tapar(texto, m)
+
+    fechas_relativas, horas_relativas, texto = _resolver_relativas(texto, ahora)
+    fechas, resto = _resolver_fechas(texto, hoy, fechas_relativas)
+    horas = _resolver_horas(resto, franja, horas_relativas)
+    return Resolucion(fechas, horas, franja)
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+RESPALDOS DE LA AGENDA (SQLITE)
+===============================
+Snapshots en caliente de la DB con la API de backup de SQLite, sin cortar al bot:
+
+- La copia se hace de a PAGINAS_POR_PASO páginas. La conexión origen mantiene
+  abierta una transacción de lectura, así que la copia sale de un solo instante
+  y no se reinicia aunque el webhook siga escribiendo. Esto solo se hace en
+  modo WAL (database.init_db lo activa): ahí los lectores no bloquean a los
+  escritores
+- En horario de atención se pausa entre pasos (PAUSA_PASO_SEG) para no
+  competir por disco con los turnos; fuera de horario copia de corrido
+- Sin WAL (una DB vieja que todavía no pasó por init_db) una lectura abierta
+  frena a todos los escritores: se copia en un solo paso, sin pausas
+- Cada snapshot se verifica con PRAGMA integrity_check antes de darlo por bueno
+  (se escribe como .parcial y se renombra al final: nunca queda uno a medias)
+- Opcionalmente se comprime con gzip (RESPALDOS_GZIP=1, default)
+- Retención: se conservan los últimos RESPALDOS_CONSERVAR
+
+Programado: RESPALDOS=1 (cada RESPALDOS_HORAS, default 6), una sola instancia
+por despliegue (tareas de fondo del master de gunicorn).
+
+    python respaldos.py                      # snapshot ahora
+    python respaldos.py --listar
+    python respaldos.py --restaurar <archivo>  # con el bot detenido
+
+Con PostgreSQL no aplica: ahí van pg_dump o los backups del proveedor.
+"""
+
+import argparse
+import collections
+import datetime
+import gzip
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+from bitacora import get_logger
+from metricas import registro
+from resolutor_fechas import ZONA_LOCAL
+
+log = get_logger('respaldos')
+
+RESPALDOS = os.environ.get('RESPALDOS', '').lower() in ('1', 'true', 'si')
+DIRECTORIO = os.environ.get('RESPALDOS_DIR', '')
+INTERVALO_HORAS = float(os.environ.get('RESPALDOS_HORAS', '6'))
+CONSERVAR = int(os.environ.get('RESPALDOS_CONSERVAR', '14'))
+COMPRIMIR = os.environ.get('RESPALDOS_GZIP', '1').lower() not in ('0', 'false', 'no')
+PAGINAS_POR_PASO = 256
+PAUSA_PASO_SEG = 0.02
+# Horario de atención (local, lunes a sábado): con margen alrededor de 09:00-20:00
+HORARIO_ATENCION = (8, 21)
+PREFIJO = 'agenda-'
+BLOQUE_GZIP = 1024 * 1024
+
+RESPALDOS_TOTAL = registro.contador(
+    'bot_respaldos_total', 'Snapshots de la DB por resultado', ('resultado',))
+RESPALDO_SEGUNDOS = registro.histograma(
+    'bot_respaldo_segundos', 'Duración de cada snapshot (copia, verificación y compresión)',
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800))
+
+Respaldo = collections.namedtuple('Respaldo', 'ruta bytes segundos')
+
+
+def en_horario(ahora=None):
+    ahora = ahora or datetime.datetime.now(ZONA_LOCAL)
+    return ahora.weekday() != 6 and HORARIO_ATENCION[0] <= ahora.hour < HORARIO_ATENCION[1]
+
+
+def directorio_por_defecto(db_path):
+    return DIRECTORIO or os.path.join(os.path.dirname(os.path.abspath(db_path)), 'respaldos')
+
+
+def verificar(ruta):
+    """PRAGMA integrity_check sobre un archivo SQLite; lanza ValueError si no da 'ok'"""
+    conn = sqlite3.connect(f"file:{ruta}?mode=ro", uri=True)
+    try:
+        resultado = [r[0] for r in conn.execute("PRAGMA integrity_check").fetchall()]
+    finally:
+        conn.close()
+    if resultado != ['ok']:
+        raise ValueError(f"integrity_check de {ruta}: {'; '.join(resultado[:5])}")
+
+
+def _copiar(origen, destino, suave):
+    """API de backup por pasos desde una transacción de lectura (una sola foto de la DB)"""
+    src = sqlite3.connect(origen, timeout=30)
+    dst = sqlite3.connect(destino)
+    try:
+        if src.execute("PRAGMA journal_mode").fetchone()[0].lower() != 'wal':
+            # En modo rollback el lock compartido frena a los escritores: que dure lo menos posible
+            log.warning("⚠️ La DB no está en WAL: snapshot en un solo paso")
+            src.backup(dst)
+            return
+        src.execute("BEGIN")
+        src.execute("SELECT count(*) FROM sqlite_master").fetchone()
+
+        def progreso(estado, restantes, total):
+            if suave and restantes:
+                time.sleep(PAUSA_PASO_SEG)
+
+        src.backup(dst, pages=PAGINAS_POR_PASO, progress=progreso)
+    finally:
+        if src.in_transaction:
+            src.rollback()
+        src.close()
+        dst.close()
+
+
+def _comprimir(ruta, destino):
+    with open(ruta, 'rb') as entrada, gzip.open(destino, 'wb', compresslevel=6) as salida:
+        shutil.copyfileobj(entrada, salida, BLOQUE_GZIP)
+    os.remove(ruta)
+
+
+def respaldar(db_path, directorio=None, comprimir=COMPRIMIR, suave=None):
+    """Snapshot verificado de db_path; devuelve Respaldo. suave=None: según el horario de atención"""
+    inicio = time.perf_counter()
+    directorio = directorio or directorio_por_defecto(db_path)
+    os.makedirs(directorio, exist_ok=True)
+    suave = en_horario() if suave is None else suave
+    sello = datetime.datetime.now(ZONA_LOCAL).strftime('%Y%m%d-%H%M%S')
+    nombre, n = PREFIJO + sello + '.db', 1
+    # Dos snapshots en el mismo segundo (restaurar guarda uno antes): no pisar el anterior
+    while os.path.exists(os.path.join(directorio, nombre)) or os.path.exists(os.path.join(directorio, nombre + '.gz')):
+        nombre, n = f"{PREFIJO}{sello}-{n}.db", n + 1
+    final = os.path.join(directorio, nombre + ('.gz' if comprimir else ''))
+    parcial = os.path.join(directorio, nombre + '.parcial')
+    try:
+        _copiar(db_path, parcial, suave)
+        verificar(parcial)
+        if comprimir:
+            _comprimir(parcial, final + '.parcial')
+            parcial = final + '.parcial'
+        os.replace(parcial, final)
+    except Exception:
+        if os.path.exists(parcial):
+            os.remove(parcial)
+        RESPALDOS_TOTAL.inc(resultado='error')
+        raise
+    segundos = time.perf_counter() - inicio
+    RESPALDOS_TOTAL.inc(resultado='ok')
+    RESPALDO_SEGUNDOS.observe(segundos)
+    respaldo = Respaldo(final, os.path.getsize(final), segundos)
+    log.info(f"💾 Snapshot {os.path.basename(final)}: {respaldo.bytes // 1024} KB en {segundos:.1f}s"
+             f"{' (modo suave)' if suave else ''}")
+    return respaldo
+
+
+def listar(directorio):
+    """Snapshots terminados, del más viejo al más nuevo"""
+    if not os.path.isdir(directorio):
+        return []
+    rutas = [os.path.join(directorio, f) for f in os.listdir(directorio)
+             if f.startswith(PREFIJO) and f.endswith(('.db', '.db.gz'))]
+    return sorted(rutas, key=lambda r: (os.path.getmtime(r), r))
+
+
+def podar(directorio, conservar=CONSERVAR):
+    viejos = listar(directorio)[:-conservar] if conservar > 0 else []
+    for ruta in viejos:
+        os.remove(ruta)
+    if viejos:
+        log.info(f"🧹 {len(viejos)} snapshots viejos borrados (se conservan {conservar})")
+    return len(viejos)
+
+
+def restaurar(snapshot, db_path):
+    """Reemplaza el contenido de db_path por el snapshot (con el bot detenido).
+    Antes guarda un snapshot de lo que había, por si hay que volver atrás."""
+    directorio = os.path.dirname(os.path.abspath(snapshot))
+    origen = snapshot
+    if snapshot.endswith('.gz'):
+        origen = os.path.join(directorio, os.path.basename(snapshot)[:-3] + '.restaurando')
+        with gzip.open(snapshot, 'rb') as entrada, open(origen, 'wb') as salida:
+            shutil.copyfileobj(entrada, salida, BLOQUE_GZIP)
+    try:
+        verificar(origen)
+        if os.path.exists(db_path):
+            previo = respaldar(db_path, directorio, suave=False)
+            log.info(f"💾 Estado anterior guardado en {os.path.basename(previo.ruta)}")
+        # Por la API de backup (no copiando el archivo): respeta el WAL y los locks de la DB destino
+        src = sqlite3.connect(f"file:{origen}?mode=ro", uri=True)
+        dst = sqlite3.connect(db_path, timeout=30)
+        try:
+            src.backup(dst)
+        finally:
+            src.close()
+            dst.close()
+        verificar(db_path)
+    finally:
+        if origen != snapshot and os.path.exists(origen):
+            os.remove(origen)
+    log.info(f"♻️ DB restaurada desde {os.path.basename(snapshot)}")
+
+
+# === PROGRAMADOS (TAREA DE FONDO) ===
+class Respaldos:
+    """Hilo que saca un snapshot cada intervalo y poda los viejos; una sola instancia por despliegue"""
+
+    def __init__(self, db, directorio=None, intervalo_horas=INTERVALO_HORAS, conservar=CONSERVAR):
+        self.db_path = getattr(db, 'db_path', None)
+        self.directorio = directorio or (directorio_por_defecto(self.db_path) if self.db_path else None)
+        self.intervalo = intervalo_horas * 3600
+        self.conservar = conservar
+        self._hilo = None
+        self._detener = threading.Event()
+
+    def iniciar(self):
+        if self.db_path is None:
+            log.warning("⚠️ Respaldos solo para SQLite: con PostgreSQL usar pg_dump o los del proveedor")
+            return
+        if self._hilo is None or not self._hilo.is_alive():
+            self._detener.clear()
+            self._hilo = threading.Thread(target=self._ciclo, name="respaldos", daemon=True)
+            self._hilo.start()
+            log.info(f"💾 Respaldos cada {self.intervalo / 3600:g} h en {self.directorio}")
+
+    def detener(self):
+        self._detener.set()
+
+    def ultimo(self):
+        """Epoch del último snapshot en disco (0 si no hay)"""
+        snapshots = listar(self.directorio) if self.directorio else []
+        return os.path.getmtime(snapshots[-1]) if snapshots else 0
+
+    def _ciclo(self):
+        # Tras un reinicio no se repite el snapshot si el último es reciente
+        espera = max(0.0, self.ultimo() + self.intervalo - time.time())
+        while not self._detener.wait(espera):
+            try:
+                respaldar(self.db_path, self.directorio)
+                podar(self.directorio, self.conservar)
+            except Exception as e:
+                log.error(f"❌ Respaldo fallido: {e}")
+            espera = self.intervalo
+
+
+def main():
+    from database import db
+    parser = argparse.ArgumentParser(description="Snapshots de la agenda (SQLite)")
+    parser.add_argument('--dir', default=None, help="Carpeta de snapshots (default RESPALDOS_DIR o ./respaldos)")
+    parser.add_argument('--listar', action='store_true')
+    parser.add_argument('--restaurar', metavar='ARCHIVO', help="Snapshot a restaurar (detener el bot antes)")
+    parser.add_argument('--sin-gzip', action='store_true')
+    args = parser.parse_args()
+    if db.db_path is None:
+        parser.error("Solo para SQLite: con PostgreSQL usar pg_dump")
+    directorio = args.dir or directorio_por_defecto(db.db_path)
+    if args.listar:
+        for ruta in listar(directorio):
+            print(f"{os.path.basename(ruta)}  {os.path.getsize(ruta) // 1024} KB")
+    elif args.restaurar:
+        restaurar(args.restaurar, db.db_path)
+    else:
+        respaldo = respaldar(db.db_path, directorio, comprimir=COMPRIMIR and not args.sin_gzip, suave=False)
+        podar(directorio)
+        print(respaldo.ruta)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+SALIDA ESTRUCTURADA DEL LLM
+===========================
+El modelo responde un objeto JSON (modo JSON de Groq) con el texto para el
+cliente, la memoria de la charla y, si el cliente confirmó, la reserva:
+
+    {"respuesta": "...",
+     "memoria": {"nombre": "...", "fecha": "YYYY-MM-DD", "hora": "HH:MM", "servicio": "..."},
+     "cita": null | {"nombre": "...", "servicio": "...", "fecha": "YYYY-MM-DD", "hora": "HH:MM"},
+     "espera": null | {"fecha": "YYYY-MM-DD", "desde": "HH:MM", "hasta": "HH:MM"}}
+
+"espera" es opcional: el cliente acepta quedar en la lista de espera (lista_espera.py).
+
+interpretar() lo lee una sola vez por respuesta y tolera salida sucia:
+- texto antes o después del objeto, bloques ```json
+- comillas simples, comas colgando, None/True/False, claves sin comillas
+- salida cortada por max_tokens (cierra el string y las llaves abiertas)
+- el formato viejo de etiquetas [MEMORIA]{...}[/MEMORIA] y [CITA]a|b|c|d[/CITA]
+
+Cada respuesta suma en bot_salida_llm_total por resultado: lo que no se pudo
+leer se cuenta (y se loguea), no se pierde en silencio.
+"""
+
+import collections
+import json
+import re
+
+from bitacora import get_logger, truncar
+from metricas import registro
+
+log = get_logger('salida_llm')
+
+CAMPOS_MEMORIA = ('nombre', 'fecha', 'hora', 'servicio')
+CAMPOS_CITA = ('nombre', 'servicio', 'fecha', 'hora')
+HORA = re.compile(r'^\d{1,2}:\d{2}$')
+LITERALES = {'None': 'null', 'True': 'true', 'False': 'false', 'null': 'null', 'true': 'true', 'false': 'false'}
+CIERRE = {'{': '}', '[': ']'}
+ETIQUETAS = re.compile(r'\[(MEMORIA|CITA)\](.*?)(?:\[/\1\]|$)', re.DOTALL)
+
+SALIDA_LLM = registro.contador(
+    'bot_salida_llm_total', 'Respuestas del LLM por resultado del parseo', ('resultado',))
+
+# resultado: json | reparado | etiquetas | sin_estructura (+ cita_incompleta si la reserva vino a medias)
+# incompleta: el LLM quiso reservar pero la cita no trae los cuatro campos
+SalidaLLM = collections.namedtuple('SalidaLLM', 'respuesta memoria cita resultado espera incompleta',
+                                   defaults=(None, False))
+
+
+# === REPARACIÓN EN UNA PASADA ===
+def reparar_json(texto):
+    """Primer objeto JSON del texto, reparado en un solo recorrido; None si no hay objeto"""
+    inicio = texto.find('{')
+    if inicio < 0:
+        return None
+    salida, pila = [], []
+    comilla = None
+    escape = False
+    palabra = []
+    i, n = inicio, len(texto)
+
+    def cerrar_palabra(final=False):
+        if palabra:
+            token = "".join(palabra)
+            palabra.clear()
+            if final and 'null'.startswith(token):
+                # Cortado a mitad de un null ("cita": nu)
+                salida.append('null')
+            elif token in LITERALES:
+                salida.append(LITERALES[token])
+            elif re.fullmatch(r'-?\d+(\.\d+)?', token):
+                salida.append(token)
+            else:
+                # Clave o valor sin comillas
+                salida.append(json.dumps(token))
+
+    def quitar_coma():
+        while salida and salida[-1].isspace():
+            salida.pop()
+        if salida and salida[-1] == ',':
+            salida.pop()
+
+    while i < n:
+        c = texto[i]
+        i += 1
+        if comilla:
+            if escape:
+                salida.append(c)
+                escape = False
+            elif c == '\\':
+                salida.append(c)
+                escape = True
+            elif c == comilla:
+                salida.append('"')
+                comilla = None
+            elif c == '"':
+                salida.append('\\"')
+            elif c == '\n':
+                salida.append('\\n')
+            else:
+                salida.append(c)
+            continue
+
+        if c.isalnum() or c in '_.-':
+            palabra.append(c)
+            continue
+        cerrar_palabra()
+        if c in '"\'':
+            comilla = c
+            salida.append('"')
+        elif c in '{[':
+            pila.append(c)
+            salida.append(c)
+        elif c in '}]':
+            quitar_coma()
+            if pila and CIERRE[pila[-1]] == c:
+                pila.pop()
+                salida.append(c)
+            if not pila:
+                break
+        else:
+            salida.append(c)
+
+    # Salida cortada: cerrar lo que quedó abierto
+    cerrar_palabra(final=True)
+    if comilla:
+        if escape:
+            salida.pop()
+        salida.append('"')
+    if pila:
+        quitar_coma()
+        while salida and salida[-1].isspace():
+            salida.pop()
+        if salida and salida[-1] == ':':
+            salida.append('null')
+        while pila:
+            salida.append(CIERRE[pila.pop()])
+    try:
+        datos = json.loads("".join(salida))
+    except ValueError:
+        return None
+    return datos if isinstance(datos, dict) else None
+
+
+# === NORMALIZACIÓN ===
+def _memoria(datos):
+    if not isinstance(datos, dict):
+        return {}
+    return {c: datos[c] for c in CAMPOS_MEMORIA if datos.get(c) not in (None, '')}
+
+
+def _cita(datos):
+    """dict completo o None; acepta también el formato viejo 'Nombre|Servicio|Fecha|Hora'"""
+    if isinstance(datos, str):
+        partes = [p.strip() for p in datos.split('|')]
+        datos = dict(zip(CAMPOS_CITA, partes)) if len(partes) >= 4 else {}
+    if not isinstance(datos, dict):
+        return None
+    cita = {c: str(datos.get(c) or '').strip() for c in CAMPOS_CITA}
+    return cita if all(cita.values()) else None
+
+
+def _espera(datos):
+    """{'fecha', 'desde', 'hasta'} o None; sin 'hasta' es una sola hora"""
+    if not isinstance(datos, dict):
+        return None
+    fecha = str(datos.get('fecha') or '').strip()
+    desde = str(datos.get('desde') or datos.get('hora') or '').strip()
+    hasta = str(datos.get('hasta') or desde).strip()
+    if not (fecha and HORA.match(desde) and HORA.match(hasta)):
+        return None
+    return {'fecha': fecha, 'desde': desde.zfill(5), 'hasta': hasta.zfill(5)}
+
+
+def _de_etiquetas(texto):
+    memoria, cita = {}, None
+    for etiqueta, contenido in ETIQUETAS.findall(texto):
+        if etiqueta == 'MEMORIA':
+            memoria = _memoria(reparar_json(contenido))
+        else:
+            cita = _cita(contenido)
+    respuesta = texto[:texto.find('[MEMORIA]')] if '[MEMORIA]' in texto else texto
+    respuesta = ETIQUETAS.sub('', respuesta).strip()
+    return memoria, cita, respuesta
+
+
+def interpretar(texto):
+    """Respuesta cruda del LLM -> SalidaLLM (una sola lectura por turno)"""
+    texto = (texto or '').strip()
+    datos, espera = None, None
+    if texto.startswith('{'):
+        try:
+            datos = json.loads(texto)
+            resultado = 'json'
+        except ValueError:
+            datos = None
+    if datos is None and '[MEMORIA]' not in texto and '[CITA]' not in texto:
+        datos = reparar_json(texto)
+        resultado = 'reparado'
+
+    if isinstance(datos, dict):
+        respuesta = str(datos.get('respuesta') or '').strip()
+        memoria = _memoria(datos.get('memoria'))
+        cita = _cita(datos.get('cita'))
+        cruda = datos.get('cita')
+        espera = _espera(datos.get('espera'))
+    elif '[MEMORIA]' in texto or '[CITA]' in texto:
+        memoria, cita, respuesta = _de_etiquetas(texto)
+        cruda = cita or ('[CITA]' in texto)
+        resultado = 'etiquetas'
+    else:
+        # Texto suelto: se contesta igual, pero la memoria de este turno se pierde
+        log.warning(f"⚠️ Salida del LLM sin estructura: {truncar(texto, 120)}")
+        respuesta, memoria, cita, cruda = ('' if texto.startswith('{') else texto), {}, None, None
+        resultado = 'sin_estructura'
+
+    incompleta = bool(cruda) and cita is None
+    if incompleta:
+        log.warning(f"⚠️ Reserva incompleta en la salida del LLM: {truncar(str(cruda), 120)}")
+        SALIDA_LLM.inc(resultado='cita_incompleta')
+    elif resultado == 'reparado':
+        log.info(f"🩹 Salida del LLM reparada: {truncar(texto, 120)}")
+    SALIDA_LLM.inc(resultado=resultado)
+    return SalidaLLM(respuesta, memoria, cita, resultado, espera, incompleta)
+
+
+def generacion_fallida(error):
+    """Groq rechaza con 400 (json_validate_failed) lo que no valida en modo JSON; el texto viene en el error"""
+    cuerpo = getattr(error, 'body', None)
+    if not isinstance(cuerpo, dict):
+        return None
+    cuerpo = cuerpo.get('error', cuerpo)
+    return cuerpo.get('failed_generation') if isinstance(cuerpo, dict) else None
@@ -3,13 +3,57 @@ from unittest.mock import patch, MagicMock
 import json
 import os
 import datetime
-from api_server import app, procesar_cita, db
+import tempfile
+import threading
+import sqlite3
+import time
+import types
+import api_server
+from api_server import app, procesar_cita
+from despachador import Despachador
+from pipeline_async import PipelineAsync
+from estado_compartido import RotacionClaves
+from entrada_webhook import MensajeEntrante
+import database
+from database import Database
+from eventos import BusEventos
+from lista_espera import ListaEspera
+from idempotencia import Deduplicador, clave_evento
+from admision import ControlAdmision
+from metricas import Registro, observar_etapa
+import perfilador
+import plazos
+import salida_llm
+from recordatorios import Recordatorios
+from resolutor_fechas import ZONA_LOCAL
+import analitica
+import fragmentos
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+from multiprocessing import Pipe
+import requests
+import respaldos
+from flask import Flask, jsonify, request as flask_request
+from estaticos import ManifiestoEstaticos, brotli
+import gzip
+import logging
+import queue
+import bitacora
 
 class TestBotIntegration(unittest.TestCase):
     def setUp(self):
+        # DB temporal: nunca tocar agenda_final_2025.db (la de producción)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.db = Database(os.path.join(self.tmp.name, "agenda.db"), compartido=False)
+        for nombre, valor in (('db', self.db), ('enrutador', None)):
+            parche = patch.object(api_server, nombre, valor)
+            parche.start()
+            self.addCleanup(parche.stop)
         self.app = app.test_client()
-        # Use an in-memory DB or a test DB file would be better, but for now we test the logic functions
-        # We will check if the DB entry is created.
 
     def test_procesar_cita(self):
         # Simulate AI response
@@ -17,13 +61,13 @@ class TestBotIntegration(unittest.TestCase):
         cliente_telefono = "12345678"
 
         # Clear previous test data if any
-        citas_previas = db.obtener_citas_por_fecha("2024-12-25")
+        citas_previas = self.db.obtener_citas_por_fecha("2024-12-25")
 
         # Execute logic
         procesar_cita(ai_response, cliente_telefono)
 
         # Verify DB
-        citas_nuevas = db.obtener_citas_por_fecha("2024-12-25")
+        citas_nuevas = self.db.obtener_citas_por_fecha("2024-12-25")
 
         # Check if we have one more appointment
         found = False
@@ -35,5 +79,870 @@ class TestBotIntegration(unittest.TestCase):
         self.assertTrue(found, "La cita no se guardó en la base de datos")
         print("✅ Test de Integración Bot -> DB exitoso: Cita guardada correctamente.")
 
+    def test_etag_config(self):
+        # Primera lectura trae ETag; la segunda con If-None-Match debe ser 304
+        r1 = self.app.get('/api/config')
+        etag = r1.headers.get('ETag')
+        self.assertIsNotNone(etag)
+
+        r2 = self.app.get('/api/config', headers={'If-None-Match': etag})
+        self.assertEqual(r2.status_code, 304)
+
+        # Un cambio en config invalida el ETag
+        self.db.set_config('test_etag', str(datetime.datetime.now()))
+        r3 = self.app.get('/api/config', headers={'If-None-Match': etag})
+        self.assertEqual(r3.status_code, 200)
+
+    def test_buscar_mensajes(self):
+        # El índice FTS se actualiza con cada mensaje (triggers); tildes y mayúsculas no importan
+        cliente = f"test-fts-{datetime.datetime.now().timestamp()}"
+        self.db.agregar_mensaje(cliente, "¿Hacen arreglo de BARBA con navaja?")
+        r = self.app.get('/api/mensajes/search', query_string={'q': 'barba navája', 'cliente': cliente})
+        self.assertEqual(r.status_code, 200)
+        resultados = r.get_json()['resultados']
+        self.assertEqual(len(resultados), 1)
+        self.assertIn('<b>BARBA</b>', resultados[0]['fragmento'])
+        self.assertEqual(self.app.get('/api/mensajes/search').status_code, 400)
+
+    def test_bandeja_conversaciones(self):
+        # La bandeja se actualiza con cada mensaje: último mensaje arriba y no leídos del cliente
+        cliente = f"test-bandeja-{datetime.datetime.now().timestamp()}"
+        self.db.agregar_mensaje(cliente, "hola")
+        self.db.agregar_mensaje(cliente, "¿tenés turno hoy?")
+        self.db.agregar_mensaje(cliente, "Sí, a las 17:00", es_bot=True)
+        primera = self.app.get('/api/conversaciones', query_string={'limite': 1}).get_json()
+        conversacion = primera['conversaciones'][0]
+        self.assertEqual(conversacion['cliente_id'], cliente)
+        self.assertEqual((conversacion['total_mensajes'], conversacion['no_leidos']), (3, 2))
+        self.assertTrue(conversacion['ultimo_es_bot'])
+        self.app.post(f'/api/conversaciones/{cliente}/leido')
+        segunda = self.db.listar_conversaciones(1)['conversaciones'][0]
+        self.assertEqual(segunda['no_leidos'], 0)
+
+class PruebasAlmacenamiento:
+    """Las mismas pruebas para cada motor (self.db)"""
+
+    def test_reserva_concurrente(self):
+        # Varios hilos por el mismo turno: una sola reserva; al cancelarla el turno se libera
+        fecha, hora = "2099-01-04", "10:00"
+        for cita in self.db.obtener_citas_por_fecha(fecha):
+            self.db.eliminar_cita(cita['id'])
+        ids = []
+        hilos = [threading.Thread(target=lambda: ids.append(self.db.agregar_cita(fecha, hora, "Ana", "1", "Corte")))
+                 for _ in range(6)]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+        reservas = [i for i in ids if i]
+        self.assertEqual(len(reservas), 1)
+        self.db.eliminar_cita(reservas[0])
+        self.assertEqual(self.db.obtener_citas_por_fecha(fecha), [])
+
+    def test_lock_no_es_turno_ocupado(self):
+        # Un lock vencido se propaga como error; solo un turno tomado devuelve None
+        if self.db.db_path is None:
+            self.skipTest("lock de SQLite")
+        ocupante = self.db.get_connection()
+        ocupante.execute("BEGIN IMMEDIATE")
+        try:
+            with patch('database.SQLITE_TIMEOUT_SEG', 0.1):
+                with self.assertRaises(sqlite3.OperationalError):
+                    self.db.agregar_cita("2099-01-06", "10:00", "Ana", "1", "Corte")
+        finally:
+            ocupante.rollback()
+            ocupante.close()
+        self.assertTrue(self.db.agregar_cita("2099-01-06", "10:00", "Ana", "1", "Corte"))
+        self.assertIsNone(self.db.agregar_cita("2099-01-06", "10:00", "Beto", "2", "Corte"))
+
+    def test_mensajes_sesion_y_busqueda(self):
+        cliente = f"test-motor-{datetime.datetime.now().timestamp()}"
+        self.db.agregar_mensaje(cliente, "¿Hacen arreglo de BARBA con navaja?")
+        self.db.agregar_mensaje(cliente, "Sí, claro", es_bot=True)
+        self.db.save_session_state(cliente, {"servicio": "barba"})
+        sesion = self.db.get_session(cliente)
+        self.assertEqual(sesion['state'], {"servicio": "barba"})
+        self.assertEqual([m['role'] for m in sesion['history']], ["user", "assistant"])
+        resultados = self.db.buscar_mensajes("barba navája", cliente=cliente)['resultados']
+        self.assertEqual(len(resultados), 1)
+        self.assertIn('<b>BARBA</b>', resultados[0]['fragmento'])
+        self.assertEqual(self.db.listar_conversaciones(1)['conversaciones'][0]['cliente_id'], cliente)
+
+    def test_lista_espera(self):
+        # Turno liberado: se ofrece a los que lo esperan (por orden), no a los de otro rango; el que reserva sale
+        fecha = "2099-01-05"
+        enviados = []
+        espera = ListaEspera(self.db, BusEventos(), lambda to, text: enviados.append(to) or True)
+        with self.db.escritura('test') as conn:
+            conn.execute("DELETE FROM lista_espera WHERE fecha = ?", (fecha,))
+        self.assertTrue(espera.anotar("c1", fecha, "09:00", "12:00", nombre="ana"))
+        self.assertFalse(espera.anotar("c1", fecha, "09:00", "12:00"))
+        espera.anotar("c2", fecha, "15:00", "18:00")
+        espera.anotar("c3", fecha, "10:00")
+        self.assertEqual(espera.ofrecer(fecha, "10:00"), 2)
+        self.assertEqual(enviados, ["c1", "c3"])
+        self.assertEqual(espera.oferta_pendiente("c3").hora, "10:00")
+        self.assertIsNone(espera.oferta_pendiente("c2"))
+        espera._reservado("c3", fecha, "10:00")
+        self.assertEqual(sorted(e['cliente_id'] for e in espera.listar(fecha) if e['estado'] == 'esperando'), ["c1", "c2"])
+
+class TestAlmacenamientoSqlite(PruebasAlmacenamiento, unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database(os.path.join(self.tmp.name, "test.db"), compartido=False)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+class TestIdempotencia(unittest.TestCase):
+    def test_duplicado_tras_reinicio(self):
+        # Un reintento de WaSender que llega después de reiniciar se descarta igual (tabla webhook_eventos)
+        with tempfile.TemporaryDirectory() as tmp:
+            ruta = os.path.join(tmp, "agenda.db")
+            clave = clave_evento("595981000111", "hola", msg_id="ABC123")
+            antes = Deduplicador(Database(ruta, compartido=False))
+            self.assertFalse(antes.es_duplicado(clave))
+            self.assertTrue(antes.es_duplicado(clave))
+            # Turno perdido en la cola (reinicio antes de procesarlo): el reintento se procesa
+            self.assertFalse(Deduplicador(Database(ruta, compartido=False)).es_duplicado(clave))
+            antes.confirmar(clave)
+            # Proceso nuevo: precarga los eventos vigentes de la DB
+            despues = Deduplicador(Database(ruta, compartido=False))
+            self.assertTrue(despues.es_duplicado(clave))
+            # Sin precarga en memoria también: la tabla es la fuente de verdad
+            despues._vistos.clear()
+            self.assertTrue(despues.es_duplicado(clave))
+            self.assertFalse(despues.es_duplicado(clave_evento("595981000111", "hola", msg_id="XYZ789")))
+
+    def test_mensaje_repetido_sin_id_ni_timestamp(self):
+        # Un "ok" mandado dos veces a propósito no es un reintento: se procesan los dos
+        self.assertIsNone(clave_evento("595981000111", "ok"))
+        self.assertEqual(clave_evento("595981000111", "ok", timestamp=1700000000),
+                         clave_evento("595981000111", "ok", timestamp=1700000000))
+        self.assertNotEqual(clave_evento("595981000111", "ok", timestamp=1700000000),
+                            clave_evento("595981000111", "ok", timestamp=1700000005))
+        encolados = []
+        with tempfile.TemporaryDirectory() as tmp:
+            db = Database(os.path.join(tmp, "agenda.db"), compartido=False)
+            with patch.object(api_server, 'db', db), patch.object(api_server, 'enrutador', None), \
+                    patch.object(api_server, 'deduplicador', Deduplicador(db)), \
+                    patch.object(api_server, 'admision', ControlAdmision(db, pendientes=lambda: 0)), \
+                    patch.object(api_server, 'despachador', MagicMock(encolar=lambda *turno: encolados.append(turno))):
+                cliente = api_server.app.test_client()
+                for _ in range(2):
+                    cliente.post('/wasender/webhook', json={"from": "595981000111", "message": "ok"})
+        self.assertEqual(len(encolados), 2)
+
+    def test_clave_confirmada_al_terminar_el_turno(self):
+        # El 200 no registra el evento: si el turno se pierde en la cola, el reintento se procesa
+        with tempfile.TemporaryDirectory() as tmp:
+            db = Database(os.path.join(tmp, "agenda.db"), compartido=False)
+            encolados = []
+            payload = {"data": {"messages": {"key": {"remoteJid": "595981000111@c.us", "id": "ABC123"},
+                                             "message": {"conversation": "hola"}}}}
+            with patch.object(api_server, 'db', db), patch.object(api_server, 'enrutador', None), \
+                    patch.object(api_server, 'deduplicador', Deduplicador(db)), \
+                    patch.object(api_server, 'admision', ControlAdmision(db, pendientes=lambda: 0)), \
+                    patch.object(api_server, 'despachador', MagicMock(encolar=lambda *turno: encolados.append(turno))), \
+                    patch.object(api_server, 'enviar_mensaje_wasender', lambda to, texto: True), \
+                    patch.object(api_server, 'generar_respuesta_ia', lambda texto, cliente, push_name=None: "IA"):
+                cliente = api_server.app.test_client()
+                self.assertEqual(cliente.post('/wasender/webhook', json=payload).status_code, 200)
+                self.assertEqual(len(encolados), 1)
+                self.assertFalse(db.existe_evento_webhook("id:ABC123", time.time()))
+                api_server.procesar_turno(*encolados[0])
+                self.assertTrue(db.existe_evento_webhook("id:ABC123", time.time()))
+                cliente.post('/wasender/webhook', json=payload)
+            self.assertEqual(len(encolados), 1)
+
+class TestEventos(unittest.TestCase):
+    def test_reparto_a_todos_los_paneles_y_desuscripcion(self):
+        bus = BusEventos()
+        paneles = [bus.escuchar(heartbeat=0.05) for _ in range(2)]
+        for panel in paneles:
+            self.assertEqual(next(panel), "retry: 3000\n\n")
+            self.assertIn("event: hola", next(panel))
+        self.assertEqual(bus.cantidad_suscriptores(), 2)
+        bus.publicar('cita_agregada', {'id': 7, 'cliente': "Ñandú"})
+        for panel in paneles:
+            self.assertEqual(next(panel), 'id: 1\nevent: cita_agregada\ndata: {"id": 7, "cliente": "Ñandú"}\n\n')
+        # Sin eventos: comentario de vida para que el proxy no corte
+        self.assertEqual(next(paneles[0]), ": ping\n\n")
+        # Cerrar la conexión desuscribe; el que queda sigue recibiendo
+        paneles[0].close()
+        self.assertEqual(bus.cantidad_suscriptores(), 1)
+        bus.publicar('config', {'clave': 'x'})
+        self.assertIn("event: config", next(paneles[1]))
+        paneles[1].close()
+        self.assertEqual(bus.cantidad_suscriptores(), 0)
+
+    def test_panel_lento_recibe_resync(self):
+        bus = BusEventos(max_pendientes=2)
+        cola = bus.suscribir()
+        for i in range(3):
+            bus.publicar('mensaje', {'n': i})
+        self.assertEqual([cola.get_nowait()['tipo'] for _ in range(cola.qsize())], ['resync'])
+
+    def test_endpoint_sse(self):
+        bus = BusEventos()
+        with patch.object(api_server, 'bus', bus):
+            respuesta = api_server.app.test_client().get('/api/events')
+            self.assertEqual(respuesta.mimetype, 'text/event-stream')
+            self.assertEqual(respuesta.headers['X-Accel-Buffering'], 'no')
+            stream = respuesta.response
+            self.assertEqual(next(stream), b"retry: 3000\n\n")
+            next(stream)
+            bus.publicar('cita_eliminada', {'id': 3})
+            self.assertIn(b"event: cita_eliminada", next(stream))
+            respuesta.close()
+        self.assertEqual(bus.cantidad_suscriptores(), 0)
+
+@unittest.skipIf(brotli is None, "brotli no instalado")
+class TestEstaticos(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.js = ("console.log('barberia');\n" * 200).encode()
+        for nombre, contenido in (("main.3f2a9c1b.js", self.js), ("index.html", b"<html>" + b"x" * 2000 + b"</html>")):
+            with open(os.path.join(self.tmp.name, nombre), 'wb') as f:
+                f.write(contenido)
+        # Variante precomprimida en disco: se usa tal cual en vez de recomprimir
+        with open(os.path.join(self.tmp.name, "index.html.gz"), 'wb') as f:
+            f.write(b"gz-de-disco")
+        self.manifiesto = ManifiestoEstaticos(self.tmp.name)
+        self.app = Flask(__name__)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _pedir(self, ruta, **headers):
+        with self.app.test_request_context('/' + ruta, headers=headers):
+            return self.manifiesto.servir(ruta, flask_request)
+
+    def test_variante_segun_accept_encoding(self):
+        self.assertEqual(sorted(self.manifiesto.assets), ["index.html", "main.3f2a9c1b.js"])
+        br = self._pedir("main.3f2a9c1b.js", **{'Accept-Encoding': "gzip, br"})
+        self.assertEqual(br.headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(br.get_data()), self.js)
+        gz = self._pedir("main.3f2a9c1b.js", **{'Accept-Encoding': "gzip"})
+        self.assertEqual(gzip.decompress(gz.get_data()), self.js)
+        plano = self._pedir("main.3f2a9c1b.js")
+        self.assertNotIn('Content-Encoding', plano.headers)
+        self.assertEqual(plano.get_data(), self.js)
+        self.assertIn('Accept-Encoding', br.vary)
+        # Un ETag por codificación; el nombre con hash se cachea inmutable
+        self.assertEqual(len({r.get_etag()[0] for r in (br, gz, plano)}), 3)
+        self.assertIn('immutable', br.headers['Cache-Control'])
+        self.assertEqual(self._pedir("index.html", **{'Accept-Encoding': "gzip"}).get_data(), b"gz-de-disco")
+
+    def test_304_y_fallback_spa(self):
+        primera = self._pedir("main.3f2a9c1b.js", **{'Accept-Encoding': "br"})
+        etag = primera.headers['ETag']
+        self.assertEqual(self._pedir("main.3f2a9c1b.js", **{'Accept-Encoding': "br", 'If-None-Match': etag}).status_code, 304)
+        # El ETag de otra codificación no vale para esta
+        self.assertEqual(self._pedir("main.3f2a9c1b.js", **{'If-None-Match': etag}).status_code, 200)
+        # Ruta del SPA: index.html sin cache fuerte
+        spa = self._pedir("agenda/hoy")
+        self.assertEqual(spa.headers['Cache-Control'], 'no-cache')
+        self.assertTrue(spa.get_data().startswith(b"<html>"))
+
+class TestMetricas(unittest.TestCase):
+    def test_formato_de_exposicion(self):
+        registro = Registro()
+        contador = registro.contador('x_envios_total', 'Envíos por resultado', ('resultado',))
+        contador.inc(resultado='ok')
+        contador.inc(2, resultado='ok')
+        contador.inc(resultado='error "503"')
+        latencia = registro.histograma('x_llm_segundos', 'Latencia', ('clave',), buckets=(0.1, 1))
+        for segundos in (0.1, 0.5, 3):
+            latencia.observe(segundos, clave='0')
+        registro.medidor('x_en_cola', 'Turnos encolados', funcion=lambda: 4)
+        self.assertEqual(registro.exponer(), "\n".join([
+            '# HELP x_envios_total Envíos por resultado',
+            '# TYPE x_envios_total counter',
+            'x_envios_total{resultado="ok"} 3',
+            'x_envios_total{resultado="error \\"503\\""} 1',
+            '# HELP x_llm_segundos Latencia',
+            '# TYPE x_llm_segundos histogram',
+            # Buckets acumulados; el límite es inclusivo (0.1 cae en le="0.1")
+            'x_llm_segundos_bucket{clave="0",le="0.1"} 1',
+            'x_llm_segundos_bucket{clave="0",le="1"} 2',
+            'x_llm_segundos_bucket{clave="0",le="+Inf"} 3',
+            'x_llm_segundos_sum{clave="0"} 3.6',
+            'x_llm_segundos_count{clave="0"} 3',
+            '# HELP x_en_cola Turnos encolados',
+            '# TYPE x_en_cola gauge',
+            'x_en_cola 4',
+        ]) + "\n")
+
+    def test_endpoint_metrics(self):
+        respuesta = api_server.app.test_client().get('/metrics')
+        self.assertEqual(respuesta.headers['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        texto = respuesta.get_data(as_text=True)
+        self.assertIn("# TYPE bot_etapa_segundos histogram", texto)
+        self.assertIn("# TYPE bot_paneles_conectados gauge", texto)
+
+class TestBitacora(unittest.TestCase):
+    def setUp(self):
+        self.cola = queue.Queue()
+        self.log = logging.getLogger('prueba.bitacora')
+        self.log.handlers = [bitacora.ManejadorCola(self.cola)]
+        self.log.propagate = False
+        self.log.setLevel(logging.INFO)
+
+    def tearDown(self):
+        self.log.handlers = []
+
+    def _lineas(self):
+        formato = bitacora.FormatoJSON()
+        lineas = []
+        while not self.cola.empty():
+            lineas.append(json.loads(formato.format(self.cola.get_nowait())))
+        return lineas
+
+    def test_linea_json(self):
+        token = bitacora.iniciar_traza("abc123")
+        try:
+            self.log.info("📩 Turno de %s", "595981000111", extra={'datos': {'mensajes': 2}})
+            try:
+                raise ValueError("sin turno")
+            except ValueError:
+                self.log.exception("❌ Falló")
+        finally:
+            bitacora.cerrar_traza(token)
+        self.log.warning("fuera de turno")
+        info, error, afuera = self._lineas()
+        self.assertEqual({k: info[k] for k in ('nivel', 'logger', 'trace_id', 'msg', 'datos')},
+                         {'nivel': 'INFO', 'logger': 'prueba.bitacora', 'trace_id': "abc123",
+                          'msg': "📩 Turno de 595981000111", 'datos': {'mensajes': 2}})
+        self.assertTrue(info['ts'].endswith('+00:00'))
+        self.assertEqual(error['trace_id'], "abc123")
+        self.assertIn("ValueError: sin turno", error['error'])
+        self.assertEqual(afuera['trace_id'], '-')
+        self.assertEqual(bitacora.truncar("x" * 10, limite=4), "xxxx…(+6)")
+
+    def test_trace_id_viaja_al_despachador(self):
+        # El turno corre en otro hilo pero loguea con el trace del webhook que lo encoló
+        despachador = Despachador(lambda remitente: self.log.info(f"turno de {remitente}"), hilos=2)
+        for trace_id in ("t-uno", "t-dos"):
+            token = bitacora.iniciar_traza(trace_id)
+            try:
+                despachador.encolar(trace_id)
+            finally:
+                bitacora.cerrar_traza(token)
+        despachador.esperar()
+        self.assertEqual(sorted((l['trace_id'], l['msg']) for l in self._lineas()),
+                         [("t-dos", "turno de t-dos"), ("t-uno", "turno de t-uno")])
+
+class TestPerfilador(unittest.TestCase):
+    def test_turno_del_webhook_marcado(self):
+        # El perfil y el desglose son del turno en el despachador, no del encolado
+        with tempfile.TemporaryDirectory() as tmp:
+            perfil = perfilador.Perfilador(carpeta=tmp, tasa=0)
+            token = perfilador.marcado.set(True)
+            try:
+                with perfil.turno("595981000111", time.perf_counter()):
+                    observar_etapa('llm', 0.25)
+            finally:
+                perfilador.marcado.reset(token)
+            with perfil.turno("595981000222", time.perf_counter()):
+                pass
+            marcado, comun = perfil.recientes
+            self.assertEqual(marcado['remitente'], "595981000111")
+            self.assertEqual(marcado['etapas_ms'], {'llm': 250.0})
+            self.assertTrue(os.path.exists(os.path.join(tmp, marcado['perfil'])))
+            self.assertIsNone(comun['perfil'])
+            self.assertEqual([p['archivo'] for p in perfil.listar()], [marcado['perfil']])
+
+    def test_admin_cerrado_sin_token(self):
+        app_admin = Flask(__name__)
+        app_admin.route('/admin/perfiles')(perfilador.requiere_admin(lambda: jsonify({'perfiles': []})))
+        cliente = app_admin.test_client()
+        with patch.object(perfilador, 'ADMIN_TOKEN', ''):
+            self.assertEqual(cliente.get('/admin/perfiles', headers={'X-Admin-Token': ''}).status_code, 404)
+        with patch.object(perfilador, 'ADMIN_TOKEN', 'secreto'):
+            self.assertEqual(cliente.get('/admin/perfiles').status_code, 401)
+            self.assertEqual(cliente.get('/admin/perfiles', headers={'X-Admin-Token': 'secreto'}).status_code, 200)
+
+class TestAdmision(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database(os.path.join(self.tmp.name, "agenda.db"), compartido=False)
+        self.encolados = 0
+        self.admision = ControlAdmision(self.db, pendientes=lambda: self.encolados)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_decisiones(self):
+        self.db.set_config('admision_rafaga', '2')
+        self.db.set_config('admision_tokens_minuto', '0.001')
+        self.db.set_config('admision_cola_fija', '5')
+        self.db.set_config('admision_cola_diferir', '10')
+        self.db.set_config('contactos_ignorados', json.dumps(["+595981000999"]))
+        self.assertEqual(self.admision.decidir("595981000999@c.us"), 'ignorar')
+        # Ráfaga de 2: el tercero sin recarga queda limitado; otro remitente tiene su propio bucket
+        self.assertEqual([self.admision.decidir("a") for _ in range(3)], ['llm', 'llm', 'limitar'])
+        self.assertEqual(self.admision.decidir("b"), 'llm')
+        self.encolados = 5
+        self.assertEqual(self.admision.decidir("c"), 'fija')
+        self.encolados = 10
+        self.assertEqual(self.admision.decidir("d"), 'diferir')
+
+    def test_config_en_caliente(self):
+        self.db.set_config('admision_rafaga', '1')
+        self.db.set_config('admision_tokens_minuto', '0.001')
+        self.assertEqual([self.admision.decidir("a") for _ in range(2)], ['llm', 'limitar'])
+        # Config inválida: se usa el default en vez de romper el turno
+        self.db.set_config('admision_rafaga', 'muchos')
+        self.assertEqual(self.admision.ajustes()['admision_rafaga'], 4.0)
+
+    def test_cupo_llm_compartido_entre_workers(self):
+        # Dos workers con estado compartido: el tope es de los dos juntos, no de cada uno
+        db = Database(os.path.join(self.tmp.name, "agenda.db"), compartido=True)
+        db.set_config('admision_llm_concurrentes', '1')
+        db.set_config('admision_espera_llm_seg', '0.2')
+        worker_a, worker_b = ControlAdmision(db, estado=db.estado), ControlAdmision(db, estado=db.estado)
+        with worker_a.cupo_llm() as tomado:
+            self.assertTrue(tomado)
+            with worker_b.cupo_llm() as tomado_b:
+                self.assertFalse(tomado_b)
+        with worker_b.cupo_llm() as tomado_b:
+            self.assertTrue(tomado_b)
+        # Un arriendo de un proceso que murió sin soltarlo vence solo
+        cupo = db.estado.tomar_cupo_llm(1)
+        with db.escritura('test') as conn:
+            conn.execute("UPDATE estado_cupos_llm SET vence = 0 WHERE id = ?", (cupo,))
+        self.assertIsNotNone(db.estado.tomar_cupo_llm(1))
+
+    def test_turnos_limitados_retenidos(self):
+        # Un solo aviso por ráfaga; los textos se responden juntos en el turno siguiente
+        self.assertTrue(self.admision.retener("a", ["uno"]))
+        self.assertFalse(self.admision.retener("a", ["dos", "tres"]))
+        self.assertTrue(self.admision.hay_retenidos("a"))
+        self.assertEqual(self.admision.retomar("a"), ["uno", "dos", "tres"])
+        self.assertFalse(self.admision.hay_retenidos("a"))
+        self.assertEqual(self.admision.retomar("a"), [])
+        self.db.set_config('admision_tokens_minuto', '6')
+        self.assertAlmostEqual(self.admision.espera_recarga(), 10.0)
+
+    def test_turno_limitado_se_responde_al_recargar(self):
+        self.db.set_config('admision_rafaga', '1')
+        self.db.set_config('admision_tokens_minuto', '600')
+        enviados = []
+        despachador = Despachador(api_server.procesar_turno, hilos=1)
+        with patch.object(api_server, 'db', self.db), patch.object(api_server, 'admision', self.admision), \
+                patch.object(api_server, 'despachador', despachador), \
+                patch.object(api_server, 'enviar_mensaje_wasender', lambda to, texto: enviados.append(texto)), \
+                patch.object(api_server, 'generar_respuesta_ia', lambda texto, cliente, push_name=None: "IA: " + texto):
+            for texto in ("uno", "dos", "tres"):
+                despachador.encolar("595981000111", [MensajeEntrante("595981000111", texto, None, None, None)], time.perf_counter())
+            despachador.esperar()
+            self.assertEqual(enviados, ["IA: uno", api_server.MENSAJE_DIFERIDO])
+            # El reintento (a los 0.1s) responde lo retenido de una vez
+            time.sleep(0.5)
+            despachador.esperar()
+        self.assertEqual(enviados, ["IA: uno", api_server.MENSAJE_DIFERIDO, "IA: dos\ntres"])
+
+class TestPlazos(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database(os.path.join(self.tmp.name, "agenda.db"), compartido=False)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_etapas_acotadas_por_el_plazo(self):
+        self.assertEqual(plazos.restante(8), 8)
+        token = plazos.iniciar_plazo(2)
+        try:
+            self.assertLessEqual(plazos.restante(8), 2)
+            self.assertFalse(plazos.vencido())
+            self.assertTrue(plazos.vencido(margen=5))
+        finally:
+            plazos.soltar_plazo(token)
+        token = plazos.iniciar_plazo(0)
+        try:
+            self.assertEqual(plazos.restante(8, minimo=0.1), 0.1)
+            self.assertTrue(plazos.vencido())
+        finally:
+            plazos.soltar_plazo(token)
+
+    def test_plazo_vencido_responde_fija_sin_groq(self):
+        token = plazos.iniciar_plazo(0)
+        try:
+            with patch.object(api_server, 'db', self.db), patch.object(api_server, 'GROQ_API_KEYS', ['clave']), \
+                    patch.object(api_server, 'Groq') as groq:
+                respuesta = api_server.generar_respuesta_ia("quiero un corte", "595981000222")
+        finally:
+            plazos.soltar_plazo(token)
+        groq.assert_not_called()
+        self.assertIn("turnos libres", respuesta)
+        self.assertEqual(self.db.get_session("595981000222")['history'][-1]['content'], respuesta)
+
+    def test_pausa_anti_ban_entera_con_plazo_vencido(self):
+        # El plazo acota el timeout del envío, nunca la pausa anti-ban
+        token = plazos.iniciar_plazo(0)
+        try:
+            with patch.object(api_server.time, 'sleep') as dormir, patch.object(api_server.requests, 'post') as post:
+                post.return_value = MagicMock(status_code=200)
+                self.assertTrue(api_server.enviar_mensaje_wasender("595981000111", "hola"))
+        finally:
+            plazos.soltar_plazo(token)
+        dormir.assert_called_once_with(api_server.WASENDER_THROTTLE_SEG)
+        self.assertEqual(post.call_args.kwargs['timeout'], api_server.WASENDER_TIMEOUT_MINIMO_SEG)
+
+    def test_error_de_db_no_es_turno_ocupado(self):
+        # Lock vencido al reservar: se avisa que no quedó confirmado, sin lista de espera
+        salida = salida_llm.interpretar('{"respuesta": "Listo", "memoria": {}, "cita": {"nombre": "Ana", '
+                                        '"servicio": "Corte", "fecha": "2099-03-01", "hora": "10:00"}}')
+        with patch.object(api_server, 'db', self.db), \
+                patch.object(api_server, 'procesar_cita', side_effect=sqlite3.OperationalError("database is locked")), \
+                patch.object(api_server.lista_espera, 'anotar') as anotar:
+            respuesta = api_server.finalizar_turno(salida, "595981000222", {"state": {}, "history": []})
+        anotar.assert_not_called()
+        self.assertIn("todavía no quedó confirmado", respuesta)
+
+class GroqFalso:
+    """chat.completions.create async: responde (o levanta) `respuesta`"""
+    def __init__(self, respuesta):
+        self.respuesta = respuesta
+        self.llamadas = 0
+        self.chat = types.SimpleNamespace(completions=self)
+
+    async def create(self, **kwargs):
+        self.llamadas += 1
+        if isinstance(self.respuesta, Exception):
+            raise self.respuesta
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(
+            message=types.SimpleNamespace(content=self.respuesta), finish_reason="stop")], usage=None)
+
+class TestPipelineAsync(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database(os.path.join(self.tmp.name, "agenda.db"), compartido=False)
+        self.admision = ControlAdmision(self.db, pendientes=lambda: 0)
+        self.enviados = []
+        self.parches = [patch.object(api_server, 'db', self.db), patch.object(api_server, 'admision', self.admision),
+                        patch.object(api_server, 'GROQ_API_KEYS', ['clave-1', 'clave-2']),
+                        patch.object(api_server, 'rotacion_claves', RotacionClaves(2)),
+                        patch.object(api_server, 'WASENDER_THROTTLE_SEG', 0)]
+        for parche in self.parches:
+            parche.start()
+        self.pipeline = PipelineAsync(api_server, hilos_db=2)
+        self.pipeline.iniciar()
+        self.pipeline._http = MagicMock(post=self._post)
+        self.pipeline._groq = {0: GroqFalso(RuntimeError("503 de Groq")),
+                               1: GroqFalso('{"respuesta": "Hola, ¿qué servicio querés?", "memoria": {}, "cita": null}')}
+
+    def tearDown(self):
+        self.pipeline.loop.call_soon_threadsafe(self.pipeline.loop.stop)
+        for parche in reversed(self.parches):
+            parche.stop()
+        self.tmp.cleanup()
+
+    async def _post(self, url, json, headers, timeout):
+        self.enviados.append(json['text'])
+        return types.SimpleNamespace(status_code=200, text='')
+
+    def test_clave_caida_rota_a_la_siguiente(self):
+        # Misma rotación que generar_respuesta_ia: la key que falla se enfría y responde la otra
+        self.pipeline.encolar("595981000111", [MensajeEntrante("595981000111", "hola", None, None, None)],
+                              time.perf_counter())
+        self.pipeline.esperar()
+        self.assertEqual(self.enviados, ["Hola, ¿qué servicio querés?"])
+        self.assertEqual([g.llamadas for g in self.pipeline._groq.values()], [1, 1])
+        self.assertEqual(api_server.rotacion_claves.actual(), 1)
+        historial = self.db.get_session("595981000111")['history']
+        self.assertEqual([m['content'] for m in historial[-2:]], ["hola", "Hola, ¿qué servicio querés?"])
+
+    def test_turno_limitado_se_responde_al_recargar(self):
+        self.db.set_config('admision_rafaga', '1')
+        self.db.set_config('admision_tokens_minuto', '600')
+        for texto in ("uno", "dos"):
+            self.pipeline.encolar("595981000111", [MensajeEntrante("595981000111", texto, None, None, None)],
+                                  time.perf_counter())
+        self.pipeline.esperar()
+        self.assertEqual(self.enviados, ["Hola, ¿qué servicio querés?", api_server.MENSAJE_DIFERIDO])
+        # El reintento (a los 0.1s, programado con espera_recarga fuera del loop) responde lo retenido
+        time.sleep(0.5)
+        self.pipeline.esperar()
+        self.assertEqual(len(self.enviados), 3)
+        self.assertFalse(self.admision.hay_retenidos("595981000111"))
+
+class TestRecordatorios(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database(os.path.join(self.tmp.name, "agenda.db"), compartido=False)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _recordatorios(self, bus=None):
+        return Recordatorios(self.db, bus or BusEventos(), lambda to, texto: (to, {}, {}), "http://wasender.invalid")
+
+    def _cita(self, horas, cliente):
+        momento = datetime.datetime.now(ZONA_LOCAL) + datetime.timedelta(hours=horas)
+        return self.db.agregar_cita(momento.strftime('%Y-%m-%d'), momento.strftime('%H:%M'), cliente, "1", "Corte")
+
+    def test_heap_y_marca_de_agua(self):
+        lejana = self._cita(26, "Ana")
+        # Reservada dentro de la anticipación (2 h): se avisa ya aunque la marca sea posterior a "cita - 2 h"
+        cercana = self._cita(1, "Beto")
+        recordatorios = self._recordatorios()
+        recordatorios._marca = time.time() - 60
+        recordatorios._cargar()
+        self.assertEqual(recordatorios.programados(), 2)
+        lote = recordatorios._tomar_vencidos()
+        self.assertEqual([cita_id for _, cita_id in lote], [cercana])
+        self.assertEqual(recordatorios.programados(), 1)
+        recordatorios._guardar_marca(lote[0][0])
+
+        # Reinicio: lo avisado antes de la marca no se repite, lo pendiente sí
+        despues = self._recordatorios()
+        despues._marca = float(self.db.get_config('recordatorios_marca'))
+        despues._cargar()
+        self.assertEqual(list(despues._vigentes), [lejana])
+        # Cancelada: sale de los vigentes y la entrada del heap se descarta sola
+        despues._evento('cita_eliminada', {'id': lejana})
+        self.assertEqual(despues.programados(), 0)
+
+    def test_fallo_de_wasender_no_avanza_la_marca(self):
+        primera, segunda = self._cita(1, "Ana"), self._cita(1.5, "Beto")
+        recordatorios = self._recordatorios()
+        recordatorios._marca = time.time() - 60
+        recordatorios._http = MagicMock()
+        recordatorios._http.post.side_effect = [MagicMock(status_code=500, text=''), MagicMock(status_code=200)]
+        recordatorios.intervalo = 0
+        recordatorios._cargar()
+        lote = recordatorios._tomar_vencidos()
+        recordatorios._enviar_lote(lote)
+        # La primera falló: queda reintentándose y un reinicio la vuelve a programar
+        self.assertEqual(list(recordatorios._vigentes), [primera])
+        despues = self._recordatorios()
+        despues._marca = float(self.db.get_config('recordatorios_marca'))
+        despues._cargar()
+        self.assertEqual(sorted(despues._vigentes), sorted([primera, segunda]))
+        # Cancelada mientras se reintentaba: ya no frena la marca
+        recordatorios._evento('cita_eliminada', {'id': primera})
+        recordatorios._guardar_marca(lote[1][0])
+        self.assertEqual(recordatorios._marca, lote[1][0])
+
+    def test_plantilla_con_placeholder_desconocido(self):
+        cita = {'cliente': "Ana", 'fecha': datetime.datetime.now(ZONA_LOCAL).date().isoformat(),
+                'hora': "10:00", 'servicio': None}
+        recordatorios = self._recordatorios()
+        self.db.set_config('recordatorio_mensaje', "Hola {cliente}, tu {servicio} es {cuando} ({direccion})")
+        self.assertEqual(recordatorios._texto(cita), "Hola Ana, tu corte es de hoy ({direccion})")
+        self.db.set_config('recordatorio_mensaje', "Hola {0} {")
+        self.assertTrue(recordatorios._texto(cita).startswith("⏰ ¡Hola Ana!"))
+
+    def test_un_solo_oyente_entre_reinicios(self):
+        bus = MagicMock()
+        recordatorios = self._recordatorios(bus)
+        for _ in range(2):
+            recordatorios.iniciar()
+            recordatorios.detener()
+            recordatorios._hilo.join(timeout=5)
+        self.assertEqual(bus.agregar_oyente.call_count, 1)
+
+class TestAnalitica(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database(os.path.join(self.tmp.name, "agenda.db"), compartido=False)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _rollups(self):
+        conn = self.db.get_connection()
+        dias = [tuple(r) for r in conn.execute("SELECT * FROM analitica_dia ORDER BY fecha")]
+        servicios = [tuple(r) for r in conn.execute("SELECT * FROM analitica_servicio ORDER BY fecha, servicio")]
+        conn.close()
+        return dias, servicios
+
+    def test_incremental_igual_a_reconstruir(self):
+        self.db.set_config('precios', json.dumps({"Corte": 40000, "Barba": 25000}))
+        self.db.agregar_cita("2099-04-01", "10:00", "Ana", "1", "Corte")
+        self.db.agregar_cita("2099-04-01", "11:00", "Beto", "2", "Barba")
+        cancelada = self.db.agregar_cita("2099-04-02", "10:00", "Caro", "3", "Corte")
+        self.db.agregar_cita("2099-04-02", "11:00", "Dani", "4", None)
+        self.db.eliminar_cita(cancelada)
+        self.db.agregar_mensaje("1", "hola", es_bot=False)
+        self.db.agregar_mensaje("1", "¡Hola! ¿Qué servicio?", es_bot=True, tipo_turno='llm')
+        self.db.agregar_mensaje("2", analitica.PREFIJO_CONFLICTO + " ese horario", es_bot=True, tipo_turno='conflicto')
+        incremental = self._rollups()
+
+        self.db.reconstruir_analitica()
+        self.assertEqual(self._rollups(), incremental)
+
+        conn = self.db.get_connection()
+        resumen = analitica.consultar(conn, "2099-04-01", "2099-04-30", agrupar='mes')
+        conn.close()
+        totales = resumen['totales']
+        self.assertEqual((totales['citas_reservadas'], totales['citas_canceladas']), (3, 1))
+        self.assertEqual(totales['ingresos_estimados'], 40000 + 25000 + analitica.PRECIO_DEFECTO)
+        self.assertEqual({s['servicio']: (s['citas_reservadas'], s['citas_canceladas']) for s in resumen['servicios']},
+                         {"Corte": (1, 1), "Barba": (1, 0), "Sin servicio": (1, 0)})
+
+class TestSesionesTTL(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database(os.path.join(self.tmp.name, "agenda.db"), compartido=False)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _envejecer(self, cliente, horas):
+        with self.db.escritura('test') as conn:
+            conn.execute("UPDATE sesiones_bot SET updated_at = datetime('now', ?) WHERE cliente_id = ?",
+                         (f"-{horas} hours", cliente))
+            conn.execute("UPDATE mensajes SET timestamp = datetime('now', ?) WHERE cliente_nombre = ?",
+                         (f"-{horas} hours", cliente))
+
+    def test_vencimiento_perezoso_y_barrido(self):
+        self.db.set_config('sesion_ttl_horas', '6')
+        for cliente in ("viejo", "nuevo"):
+            self.db.agregar_mensaje(cliente, "quiero un corte", es_bot=False)
+            self.db.save_session_state(cliente, {"nombre": cliente.title(), "servicio": "Corte"})
+        self.db.save_session_state("vacio", {})
+        self._envejecer("viejo", 7)
+
+        # La sesión vieja se lee como nueva (estado e historial) aunque la fila siga ahí
+        self.assertEqual(self.db.get_session("viejo"), {"state": {}, "history": []})
+        nuevo = self.db.get_session("nuevo")
+        self.assertEqual(nuevo['state']['nombre'], "Nuevo")
+        self.assertEqual(len(nuevo['history']), 1)
+
+        # El barrido borra la vencida y la vacía; la activa queda
+        self.assertEqual(self.db.barrer_sesiones(lote=1), 2)
+        conn = self.db.get_connection()
+        quedan = [r[0] for r in conn.execute("SELECT cliente_id FROM sesiones_bot")]
+        conn.close()
+        self.assertEqual(quedan, ["nuevo"])
+
+    def test_cache_de_fragmento_respeta_el_ttl(self):
+        self.db.set_config('sesion_ttl_horas', '6')
+        self.db.activar_cache_sesiones()
+        self.db.save_session_state("c1", {"nombre": "Ana"})
+        self.assertEqual(self.db.get_session("c1")['state'], {"nombre": "Ana"})
+        with self.db._cache_lock:
+            self.db._cache_sesiones["c1"]['tocada'] -= 7 * 3600
+        self._envejecer("c1", 7)
+        self.assertEqual(self.db.get_session("c1")['state'], {})
+
+class TestFragmentos(unittest.TestCase):
+    @unittest.skipUnless(hasattr(os, 'fork'), "sin fork")
+    def test_conexiones_no_se_heredan_al_forkear(self):
+        # El master abre sockets a los fragmentos (soltar_sesion); un worker forkeado después arranca sin ellos
+        with tempfile.TemporaryDirectory() as tmp:
+            enrutador = fragmentos.Enrutador(Database(os.path.join(tmp, "agenda.db"), compartido=False))
+            enrutador._conexiones['f0'] = (threading.Lock(), MagicMock())
+            pid = os.fork()
+            if pid == 0:
+                os._exit(0 if enrutador._conexiones == {} else 1)
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+            self.assertIn('f0', enrutador._conexiones)
+
+    def test_oferta_suelta_la_sesion_del_fragmento_dueno(self):
+        # La oferta la escribe el proceso que liberó el turno; el fragmento que cachea la sesión la relee
+        with tempfile.TemporaryDirectory() as tmp:
+            ruta = os.path.join(tmp, "agenda.db")
+            dueno, otro = Database(ruta, compartido=False), Database(ruta, compartido=False)
+            dueno.activar_cache_sesiones()
+            self.assertEqual(dueno.get_session("c1")['history'], [])
+            hacia_fragmento, en_fragmento = Pipe()
+            hilo = threading.Thread(target=fragmentos._atender, args=(en_fragmento, MagicMock(), dueno))
+            hilo.start()
+            espera = ListaEspera(otro, BusEventos(), lambda to, texto: True,
+                                 lambda cliente: hacia_fragmento.send(('soltar', cliente)))
+            espera.anotar("c1", "2099-05-01", "10:00")
+            self.assertEqual(espera.ofrecer("2099-05-01", "10:00"), 1)
+            hacia_fragmento.close()
+            hilo.join(timeout=5)
+            self.assertIn("Se liberó un turno", dueno.get_session("c1")['history'][-1]['content'])
+
+@unittest.skipUnless(shutil.which('gunicorn') and hasattr(os, 'fork'), "gunicorn no instalado")
+class TestGunicorn(unittest.TestCase):
+    def test_arranque_y_apagado(self):
+        # Master sin hilos: fragmentos y tareas de fondo en sus procesos; SIGTERM apaga todo limpio
+        raiz = os.path.dirname(os.path.abspath(__file__))
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            puerto = s.getsockname()[1]
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ, PORT=str(puerto), DB_PATH=os.path.join(tmp, "agenda.db"), WEB_CONCURRENCY='2',
+                       FRAGMENTOS='1', FRAGMENTOS_DIR=tmp, RECORDATORIOS='1', WASENDER_URL='http://127.0.0.1:9')
+            env.pop('FRAGMENTOS_CLAVE', None)
+            ruta_log = os.path.join(tmp, "gunicorn.log")
+            with open(ruta_log, 'w') as salida:
+                proceso = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'api_server:app'],
+                                           cwd=raiz, env=env, stdout=salida, stderr=subprocess.STDOUT)
+            try:
+                url = f"http://127.0.0.1:{puerto}"
+                registro = fragmentos.RegistroFragmentos(Database(env['DB_PATH'], compartido=False))
+                limite = time.monotonic() + 30
+                while time.monotonic() < limite:
+                    try:
+                        if requests.get(f"{url}/metrics", timeout=1).ok and registro.vivos():
+                            break
+                    except requests.RequestException:
+                        pass
+                    time.sleep(0.2)
+                self.assertEqual(list(registro.vivos()), ['f0'])
+                r = requests.post(f"{url}/wasender/webhook", timeout=5, json={
+                    'event': 'messages.upsert', 'data': {'messages': {
+                        'key': {'id': 'GUNI1', 'remoteJid': '595981000333@s.whatsapp.net', 'fromMe': False},
+                        'message': {'conversation': 'hola'}}}})
+                self.assertEqual(r.status_code, 200)
+                proceso.send_signal(signal.SIGTERM)
+                self.assertEqual(proceso.wait(timeout=60), 0)
+            finally:
+                if proceso.poll() is None:
+                    proceso.kill()
+                    proceso.wait()
+            with open(ruta_log, encoding='utf-8') as f:
+                log_gunicorn = f.read()
+            self.assertIn("Tareas de fondo en el proceso", log_gunicorn)
+            self.assertIn("Recordatorios activos", log_gunicorn)
+            self.assertNotIn("Traceback", log_gunicorn)
+
+class TestRespaldos(unittest.TestCase):
+    def test_snapshot_y_restauracion(self):
+        # Snapshot en caliente (comprimido y verificado); restaurar vuelve al estado de la foto
+        with tempfile.TemporaryDirectory() as tmp:
+            base = Database(os.path.join(tmp, "agenda.db"), compartido=False)
+            base.agregar_cita("2099-02-01", "10:00", "Ana", "1", "Corte")
+            # WAL: la lectura abierta del snapshot no frena a los escritores
+            conn = base.get_connection()
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+            conn.close()
+            destino = os.path.join(tmp, "respaldos")
+            foto = respaldos.respaldar(base.db_path, destino, comprimir=True, suave=False)
+            self.assertTrue(foto.ruta.endswith('.db.gz'))
+            base.agregar_cita("2099-02-01", "11:00", "Beto", "2", "Barba")
+            respaldos.restaurar(foto.ruta, base.db_path)
+            self.assertEqual([c['hora'] for c in base.obtener_citas_por_fecha("2099-02-01")], ["10:00"])
+            # restaurar guardó antes el estado previo
+            self.assertEqual(len(respaldos.listar(destino)), 2)
+            self.assertEqual(respaldos.podar(destino, conservar=1), 1)
+
+class TestSeleccionMotor(unittest.TestCase):
+    def test_postgres_solo_con_db_backend_explicito(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            entorno = {'DB_PATH': os.path.join(tmp, "agenda.db"), 'DATABASE_URL': "postgres://u:c@host/base"}
+            with patch.dict(os.environ, entorno):
+                os.environ.pop('DB_BACKEND', None)
+                # Un DATABASE_URL suelto no cambia de motor
+                self.assertIs(type(database.crear_db()), Database)
+                os.environ['DB_BACKEND'] = 'mysql'
+                self.assertRaises(ValueError, database.crear_db)
+
+@unittest.skipUnless(os.environ.get('TEST_DATABASE_URL'), "TEST_DATABASE_URL no definido (PostgreSQL local)")
+class TestAlmacenamientoPostgres(PruebasAlmacenamiento, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from database_postgres import DatabasePostgres
+        cls.db = DatabasePostgres(os.environ['TEST_DATABASE_URL'], compartido=False)
+
 if __name__ == '__main__':
     unittest.main()
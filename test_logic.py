@@ -1,5 +1,11 @@
 import unittest
 from api_server import procesar_memoria_ia
+from entrada_webhook import normalizar_payload, agrupar_por_remitente
+from fragmentos import AnilloHash
+import datetime
+import resolutor_fechas
+import salida_llm
+import enrutador_modelos
 
 class TestBotLogic(unittest.TestCase):
     def test_hour_normalization(self):
@@ -51,5 +57,92 @@ class TestBotLogic(unittest.TestCase):
         new_state = procesar_memoria_ia(response, state)
         self.assertEqual(new_state.get('hora_intencion'), "08:00")
 
+    def test_webhook_batch_all_messages(self):
+        # Lote WaSender: no se pierde ningún mensaje después del [0]
+        data = {'data': {'messages': [
+            {'key': {'remoteJid': '595981@c.us', 'id': 'A1'}, 'messageBody': 'hola', 'pushName': 'Ana'},
+            {'key': {'remoteJid': '595982@c.us', 'id': 'B1'}, 'message': {'conversation': 'precio?'}},
+            {'key': {'remoteJid': '595981@c.us', 'id': 'A2'}, 'message': {'extendedTextMessage': {'text': 'corte mañana'}}},
+            {'key': {'remoteJid': '595983@c.us', 'id': 'C1'}, 'message': {}},
+        ]}}
+        mensajes = list(normalizar_payload(data))
+        self.assertEqual([m.msg_id for m in mensajes], ['A1', 'B1', 'A2'])
+        grupos = agrupar_por_remitente(mensajes)
+        self.assertEqual(list(grupos), ['595981', '595982'])
+        self.assertEqual([m.mensaje for m in grupos['595981']], ['hola', 'corte mañana'])
+
+    def test_hash_ring_rebalance(self):
+        # Sacar un fragmento solo mueve a los remitentes que eran suyos
+        clientes = [f"5959{n:08d}" for n in range(2000)]
+        anillo = AnilloHash(['f0', 'f1', 'f2', 'f3'])
+        antes = {c: anillo.nodo(c) for c in clientes}
+        self.assertEqual(set(antes.values()), {'f0', 'f1', 'f2', 'f3'})
+        anillo.quitar('f2')
+        for c in clientes:
+            if antes[c] != 'f2':
+                self.assertEqual(anillo.nodo(c), antes[c])
+            else:
+                self.assertNotEqual(anillo.nodo(c), 'f2')
+
+    def test_date_resolver(self):
+        # Miércoles 17/12/2025 a las 10:00 (UTC-4)
+        ahora = datetime.datetime(2025, 12, 17, 10, 0, tzinfo=resolutor_fechas.ZONA_LOCAL)
+        r = resolutor_fechas.resolver("el viernes a las 5", ahora)
+        self.assertEqual((r.fecha(), r.hora()), ('2025-12-19', '17:00'))
+        r = resolutor_fechas.resolver("mañana 10 de la mañana", ahora)
+        self.assertEqual((r.fecha(), r.hora()), ('2025-12-18', '10:00'))
+        r = resolutor_fechas.resolver("pasado mañana a las 4 y media", ahora)
+        self.assertEqual((r.fecha(), r.hora()), ('2025-12-19', '16:30'))
+        r = resolutor_fechas.resolver("el 5/1 9:30", ahora)
+        self.assertEqual((r.fecha(), r.hora()), ('2026-01-05', '09:30'))
+        # "el 23" es fecha, no hora; "3 perros" no es nada
+        r = resolutor_fechas.resolver("el 23 después del almuerzo", ahora)
+        self.assertEqual((r.fecha(), r.hora()), ('2025-12-23', '13:00'))
+        self.assertFalse(resolutor_fechas.resolver("tengo 3 perros", ahora))
+        # Mismo día de la semana: hoy o el próximo, queda marcado como ambiguo
+        self.assertTrue(resolutor_fechas.resolver("el miércoles", ahora).ambigua)
+
+    def test_date_resolver_duraciones(self):
+        # "en 2 horas" es una duración desde ahora, no las 14:00
+        ahora = datetime.datetime(2025, 12, 17, 10, 0, tzinfo=resolutor_fechas.ZONA_LOCAL)
+        r = resolutor_fechas.resolver("puedo ir en 2 horas", ahora)
+        self.assertEqual((r.fecha(), r.hora()), ('2025-12-17', '12:00'))
+        self.assertEqual(resolutor_fechas.resolver("dentro de media hora", ahora).hora(), '10:30')
+        self.assertEqual(resolutor_fechas.resolver("hoy en una hora y media", ahora).hora(), '11:30')
+        self.assertEqual(resolutor_fechas.resolver("en 45 minutos", ahora).hora(), '10:45')
+        self.assertFalse(resolutor_fechas.resolver("hoy en 2 horas", ahora).ambigua)
+        # "17 hs" sigue siendo hora; "2 horas" suelto no alcanza para la memoria de la sesión
+        self.assertEqual(resolutor_fechas.resolver("a las 17 hs", ahora).hora(resolutor_fechas.UMBRAL_MEMORIA), '17:00')
+        r = resolutor_fechas.resolver("tardo 2 horas", ahora)
+        self.assertIsNone(r.hora(resolutor_fechas.UMBRAL_MEMORIA))
+
+    def test_salida_llm_tolerante(self):
+        # JSON limpio, sucio (comillas simples, coma colgando, cortado) y etiquetas viejas: una sola lectura
+        limpio = salida_llm.interpretar('{"respuesta": "Hola", "memoria": {"hora": "17:00"}, "cita": null}')
+        self.assertEqual((limpio.respuesta, limpio.memoria, limpio.resultado), ("Hola", {"hora": "17:00"}, 'json'))
+        sucio = salida_llm.interpretar("```json\n{'respuesta': 'Dale', 'memoria': {'nombre': 'Ana',}, 'cita': {'nombre': 'Ana', "
+                                       "'servicio': 'Corte', 'fecha': '2025-12-24', 'hora': '19:00'}}```")
+        self.assertEqual(sucio.resultado, 'reparado')
+        self.assertEqual((sucio.memoria, sucio.cita['hora']), ({"nombre": "Ana"}, "19:00"))
+        cortado = salida_llm.interpretar('{"respuesta": "Perfecto Ana, te anoto para el vie')
+        self.assertEqual(cortado.respuesta, "Perfecto Ana, te anoto para el vie")
+        viejo = salida_llm.interpretar("Listo [CITA]Ana|Corte|2025-12-24|19:00[/CITA]")
+        self.assertEqual((viejo.respuesta, viejo.cita['nombre']), ("Listo", "Ana"))
+        self.assertEqual(salida_llm.interpretar("sin estructura").resultado, 'sin_estructura')
+
+    def test_enrutador_modelos(self):
+        # La ruta sale de lo que falta en memoria; solo una respuesta inválida escala al modelo fuerte
+        prompt = [{"role": "system", "content": "x" * 400}]
+        self.assertEqual(enrutador_modelos.elegir(["NOMBRE", "SERVICIO", "FECHA Y HORA"], prompt).nombre, 'saludo')
+        self.assertEqual(enrutador_modelos.elegir([], prompt).nombre, 'confirmacion')
+        largo = [{"role": "user", "content": "x" * 20000}]
+        self.assertEqual(enrutador_modelos.elegir(["NOMBRE"], largo).nombre, 'contexto')
+        datos = enrutador_modelos.RUTAS['datos']
+        valida = salida_llm.interpretar('{"respuesta": "¿A qué hora?", "memoria": {}, "cita": null}')
+        self.assertIsNone(enrutador_modelos.revisar(datos, valida, 0.1))
+        incompleta = salida_llm.interpretar('{"respuesta": "Listo", "cita": {"nombre": "Ana", "hora": "19:00"}}')
+        self.assertEqual(enrutador_modelos.revisar(datos, incompleta, 0.1).nombre, 'escalado')
+        self.assertIsNone(enrutador_modelos.revisar(enrutador_modelos.RUTAS['escalado'], incompleta, 0.1))
+
 if __name__ == '__main__':
     unittest.main()